@@ -0,0 +1,200 @@
+"""
+خادم Bot API وهمي محلي (مكتبة بايثون القياسية فقط) لاختبارات الحمل دون اتصال بتيليجرام.
+
+يدعم: getMe, getUpdates (long polling مع offset/timeout), sendMessage, sendPhoto, sendMediaGroup,
+editMessageText, answerCallbackQuery, deleteWebhook/setWebhook.
+يُوجَّه البوت إليه بـ TELEGRAM_API_URL=http://127.0.0.1:<port>
+
+التشغيل المنفرد (لتجربة يدوية):
+    python benchmarks/fake_bot_api.py --port 8081
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "AmanexBench", "username": "amanex_bench_bot"}
+
+class FakeBotAPI:
+    """
+    يحتفظ بطابور التحديثات الواردة (يضيفها المحاكي عبر push_update) ويسجّل كل طلب صادر من البوت.
+    on_send(method, params) يُستدعى لكل طلب إرسال ليتمكن المحاكي من قياس زمن الرد.
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 on_send: Optional[Callable[[str, Dict[str, Any]], None]] = None):
+        self.latency = latency          # تأخير مصطنع لكل طلب إرسال (محاكاة زمن الشبكة)
+        self.on_send = on_send
+        self.sent: Dict[str, int] = {}
+        self.polls = 0
+        self._updates: deque = deque()
+        self._update_id = itertools.count(1)
+        self._message_id = itertools.count(1)
+        self._cond = threading.Condition()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeBotAPI":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-bot-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    # ---------- جهة المحاكي ----------
+    def push_update(self, update: Dict[str, Any]) -> int:
+        with self._cond:
+            update["update_id"] = next(self._update_id)
+            self._updates.append(update)
+            self._cond.notify_all()
+        return update["update_id"]
+
+    def wait_for_poll(self, timeout: float = 30) -> bool:
+        """ينتظر أول getUpdates (بعد skip_pending) حتى لا تُتجاهل تحديثات البداية."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.polls < 2:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self._cond.wait(left)
+        return True
+
+    # ---------- تنفيذ الطرق ----------
+    def _message(self, chat_id, **extra) -> Dict[str, Any]:
+        msg = {"message_id": next(self._message_id), "date": int(time.time()),
+               "chat": {"id": int(chat_id), "type": "private"}, "from": BOT_USER}
+        msg.update(extra)
+        return msg
+
+    def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(params.get("offset", 0) or 0)
+        timeout = float(params.get("timeout", 0) or 0)
+        limit = int(params.get("limit", 100) or 100)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.polls += 1
+            self._cond.notify_all()
+            if offset < 0:
+                # skip_pending: يطلب آخر تحديث فقط؛ نعتبر كل ما سبق مُستهلكاً
+                last = list(self._updates)[-1:]
+                self._updates.clear()
+                return last
+            while self._updates and self._updates[0]["update_id"] < offset:
+                self._updates.popleft()
+            while not self._updates:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return []
+                self._cond.wait(left)
+            return list(itertools.islice(self._updates, limit))
+
+    def call(self, method: str, params: Dict[str, Any]) -> Any:
+        if method == "getUpdates":
+            return self._get_updates(params)
+        if method == "getMe":
+            return BOT_USER
+        if method in ("deleteWebhook", "setWebhook"):
+            return True
+
+        if self.latency:
+            time.sleep(self.latency)
+        with self._cond:
+            self.sent[method] = self.sent.get(method, 0) + 1
+        if self.on_send:
+            self.on_send(method, params)
+
+        chat_id = params.get("chat_id", 0)
+        if method == "answerCallbackQuery":
+            return True
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            return [self._message(chat_id, photo=[{"file_id": m.get("media"), "file_unique_id": "u",
+                                                   "width": 1, "height": 1}]) for m in media]
+        if method == "sendPhoto":
+            return self._message(chat_id, caption=params.get("caption", ""),
+                                 photo=[{"file_id": params.get("photo"), "file_unique_id": "u", "width": 1, "height": 1}])
+        if method in ("sendMessage", "editMessageText"):
+            return self._message(chat_id, text=params.get("text", ""))
+        raise KeyError(method)
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True     # الترويسة والجسم في كتابتين: بدونها تأخير ACK ≈40ms لكل طلب
+
+            def log_message(self, *args):
+                pass
+
+            def _params(self) -> Dict[str, Any]:
+                parts = urlsplit(self.path)
+                params: Dict[str, Any] = dict(parse_qsl(parts.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                if not length:
+                    return params
+                body = self.rfile.read(length)
+                ctype = self.headers.get("Content-Type", "")
+                if ctype.startswith("application/x-www-form-urlencoded"):
+                    params.update(parse_qsl(body.decode()))
+                elif ctype.startswith("multipart/form-data"):
+                    msg = BytesParser(policy=HTTP).parsebytes(
+                        b"Content-Type: " + ctype.encode() + b"\r\n\r\n" + body)
+                    for part in msg.iter_parts():
+                        name = part.get_param("name", header="content-disposition")
+                        if name and not part.get_filename():
+                            params[name] = part.get_content()
+                elif ctype.startswith("application/json"):
+                    params.update(json.loads(body))
+                return params
+
+            def _reply(self, status: int, payload: Dict[str, Any]):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _dispatch(self):
+                method = urlsplit(self.path).path.rsplit("/", 1)[-1]
+                try:
+                    result = api.call(method, self._params())
+                except KeyError:
+                    self._reply(404, {"ok": False, "error_code": 404, "description": "Not Found: method not found"})
+                    return
+                self._reply(200, {"ok": True, "result": result})
+
+            do_GET = _dispatch
+            do_POST = _dispatch
+
+        return Handler
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Local fake Telegram Bot API")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency", type=float, default=0.0, help="artificial seconds per send call")
+    args = ap.parse_args()
+    api = FakeBotAPI(args.host, args.port, args.latency).start()
+    print(f"fake Bot API listening on {api.url}  (TELEGRAM_API_URL={api.url})", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        api.stop()
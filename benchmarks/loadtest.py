@@ -0,0 +1,295 @@
+"""
+اختبار حمل دون اتصال: يشغّل البوت الحقيقي (bot.py) مقابل خادم Bot API وهمي محلي (fake_bot_api.py)
+ويحاكي N مستخدماً متزامناً: معالج البيع كاملاً، الشراء مع إثبات الدفع، وبحث الإدمن.
+
+كل مستخدم يعمل بحلقة مغلقة: يرسل خطوة، ينتظر أول رد من البوت له، ثم يرسل التالية.
+المخرجات لكل حجم قاعدة بيانات (محور التوسع: عدد الإعلانات المزروعة):
+  - updates/s و sends/s (تحديثات مُعالجة ورسائل صادرة في الثانية)
+  - p50/p95/p99 لزمن المعالج (تنفيذ التحديث داخل البوت) ولزمن الرد كما يراه المستخدم
+
+الاستخدام:
+    python benchmarks/loadtest.py --users 50 --rounds 3 --listings 1000,10000,100000,1000000
+    python benchmarks/loadtest.py --runtime async --users 200
+
+كل حجم يعمل في عملية مستقلة وقاعدة بيانات مؤقتة جديدة، وتُحفظ النتائج JSON في benchmarks/results/
+(مع رقم الـ commit) لمقارنتها بين الإصدارات.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+ADMIN_ID = 1000
+FIRST_USER_ID = 10_000
+SEED_BATCH = 10_000
+SEED_SUBS = [("games", "PUBG Mobile"), ("games", "Free Fire"), ("games", "Clash of Clans"),
+             ("social", "Instagram"), ("social", "TikTok"), ("other", "Other")]
+
+def percentile(samples: List[float], p: float) -> float:
+    if not samples:
+        return 0.0
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(round(p / 100.0 * (len(s) - 1))))]
+
+def summarize_ms(samples: List[float]) -> Dict[str, float]:
+    return {"p50": percentile(samples, 50) * 1000, "p95": percentile(samples, 95) * 1000,
+            "p99": percentile(samples, 99) * 1000, "n": len(samples)}
+
+# ==========================[ تشغيل حجم واحد ]==========================
+class Driver:
+    """يحقن تحديثات المستخدمين في الخادم الوهمي وينتظر الردود الموجهة لكل مستخدم."""
+    def __init__(self, api, timeout: float):
+        self.api = api
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._replies: Dict[int, int] = {}
+        self._cq_owner: Dict[str, int] = {}
+        self._ids = iter(range(1, 1 << 62))
+        self.rtt: List[float] = []
+        self.timeouts = 0
+
+    def on_send(self, method: str, params: Dict[str, Any]):
+        if method == "answerCallbackQuery":
+            uid = self._cq_owner.pop(str(params.get("callback_query_id")), None)
+        else:
+            uid = int(params.get("chat_id", 0) or 0)
+        if uid is None:
+            return
+        with self._cond:
+            self._replies[uid] = self._replies.get(uid, 0) + 1
+            self._cond.notify_all()
+
+    def _user(self, uid: int) -> Dict[str, Any]:
+        return {"id": uid, "is_bot": False, "first_name": f"U{uid}", "username": f"user{uid}"}
+
+    def _message(self, uid: int, text: Optional[str] = None, photo: Optional[str] = None) -> Dict[str, Any]:
+        m = {"message_id": next(self._ids), "date": int(time.time()),
+             "chat": {"id": uid, "type": "private"}, "from": self._user(uid)}
+        if photo:
+            m["photo"] = [{"file_id": photo, "file_unique_id": photo, "width": 90, "height": 90}]
+        else:
+            m["text"] = text
+            if text.startswith("/"):
+                m["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": m}
+
+    def _callback(self, uid: int, data: str) -> Dict[str, Any]:
+        cq_id = str(next(self._ids))
+        self._cq_owner[cq_id] = uid
+        return {"callback_query": {"id": cq_id, "from": self._user(uid), "chat_instance": "bench", "data": data,
+                                   "message": {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"},
+                                               "text": "page"}}}
+
+    def step(self, uid: int, text: Optional[str] = None, photo: Optional[str] = None,
+             callback: Optional[str] = None):
+        update = self._callback(uid, callback) if callback else self._message(uid, text, photo)
+        with self._cond:
+            seen = self._replies.get(uid, 0)
+        t0 = time.perf_counter()
+        self.api.push_update(update)
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while self._replies.get(uid, 0) <= seen:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    self.timeouts += 1
+                    return
+                self._cond.wait(left)
+            self.rtt.append(time.perf_counter() - t0)
+
+def seed_listings(bot, n: int) -> float:
+    """يزرع n إعلاناً نشطاً عبر create_listing (نفس مسار الكتابة في البوت) على دفعات معاملات."""
+    t0 = time.perf_counter()
+    for start in range(0, n, SEED_BATCH):
+        with bot.db_write():
+            for i in range(start, min(n, start + SEED_BATCH)):
+                cat, sub = SEED_SUBS[i % len(SEED_SUBS)]
+                bot.create_listing(
+                    seller_id=FIRST_USER_ID - 1 - (i % 500), category=cat, subcategory=sub,
+                    description=f"seed listing {i} level {i % 90} skins {i % 37} rank gold",
+                    images=[f"seed-{i}-a", f"seed-{i}-b"], price=f"{5 + i % 200} USDT",
+                    pay_methods=["MTN", "TrustWallet"], pay_details={"MTN": "0999", "TrustWallet": "T..."},
+                    seller_contact="@seed", status="active")
+        if n >= 100_000:
+            print(f"  seeded {min(n, start + SEED_BATCH)}/{n}", file=sys.stderr, flush=True)
+    return time.perf_counter() - t0
+
+def run_single(args) -> Dict[str, Any]:
+    work = tempfile.mkdtemp(prefix="amanex-bench-")
+    sys.path.insert(0, HERE)
+    from fake_bot_api import FakeBotAPI
+
+    driver_ref: Dict[str, Driver] = {}
+    api = FakeBotAPI(latency=args.api_latency, on_send=lambda m, p: driver_ref["d"].on_send(m, p)).start()
+    driver = driver_ref["d"] = Driver(api, args.step_timeout)
+
+    # يجب ضبط البيئة قبل استيراد bot (الإعدادات تُقرأ عند الاستيراد)
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCHMARK", "ADMIN_ID": str(ADMIN_ID),
+        "DB_FILE": os.path.join(work, "bench.db"), "TELEGRAM_API_URL": api.url,
+        "BOT_MODE": "polling", "BOT_RUNTIME": args.runtime, "BACKUP_DIR": os.path.join(work, "backups"),
+    })
+    if args.workers is not None:
+        os.environ["UPDATE_WORKERS"] = str(args.workers)
+    if not args.telegram_limits:
+        # الخادم الوهمي بلا حد إغراق: نرفع حدود الطابور الصادر لقياس البوت نفسه لا حد 1 رسالة/ثانية/محادثة
+        os.environ.update({"TG_GLOBAL_RATE": "1000000", "TG_CHAT_RATE": "1000000", "TG_CHAT_BURST": "1000000"})
+    os.chdir(work)
+    sys.path.insert(0, ROOT)
+    import logging
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.telebot.logger.setLevel(logging.WARNING)
+
+    bot.init_db()
+    bot.migrate_db()
+    seed_secs = seed_listings(bot, args.listings)
+    with bot.db_read() as c:
+        c.execute("SELECT id FROM listings WHERE status='active' AND category='games' AND subcategory='PUBG Mobile' "
+                  "ORDER BY id DESC LIMIT 200")
+        buy_ids = [r["id"] for r in c.fetchall()]
+
+    handler_samples: List[float] = []
+    process = bot.update_engine.process
+
+    def timed_process(updates):
+        t0 = time.perf_counter()
+        try:
+            process(updates)
+        finally:
+            handler_samples.append(time.perf_counter() - t0)
+    bot.update_engine.process = timed_process
+
+    threading.Thread(target=bot.main, name="bot", daemon=True).start()
+    if not api.wait_for_poll():
+        raise RuntimeError("bot did not start polling")
+
+    mtn = bot.PAYMENT_LABELS["MTN"]
+
+    def seller(uid: int):
+        for r in range(args.rounds):
+            for kw in ({"text": "/start"}, {"text": "📤 بيع حساب"}, {"text": "🎮 ألعاب"}, {"text": "PUBG Mobile"},
+                       {"text": f"bench account {uid}-{r} level 70 many skins"},
+                       {"photo": f"ph-{uid}-{r}-1"}, {"photo": f"ph-{uid}-{r}-2"}, {"text": "تم"},
+                       {"text": "25 USDT"}, {"text": mtn}, {"text": "0999000000"}, {"text": "✅ انتهيت"},
+                       {"text": f"@seller{uid}"}):
+                driver.step(uid, **kw)
+
+    def buyer(uid: int):
+        for r in range(args.rounds):
+            lid = buy_ids[(uid + r) % len(buy_ids)] if buy_ids else 1
+            for kw in ({"text": "📥 شراء حساب"}, {"text": "🎮 ألعاب"}, {"text": "PUBG Mobile"},
+                       {"callback": f"buy_{lid}"}, {"text": mtn}, {"photo": f"proof-{uid}-{r}"},
+                       {"text": f"@buyer{uid}"}):
+                driver.step(uid, **kw)
+
+    def admin(uid: int):
+        for r in range(args.rounds):
+            for kw in ({"text": "/admin"}, {"text": "🔎 بحث عرض"}, {"text": str(1 + r)},
+                       {"text": "🧾 طلبات مدفوعة"}, {"text": "/findorder 1"}, {"text": bot.BACK_BTN}):
+                driver.step(uid, **kw)
+
+    roles = [seller, buyer]
+    threads = []
+    for i in range(args.users):
+        uid = FIRST_USER_ID + i
+        threads.append(threading.Thread(target=roles[i % len(roles)], args=(uid,), daemon=True))
+    if args.admin:
+        threads.append(threading.Thread(target=admin, args=(ADMIN_ID,), daemon=True))
+
+    sent_before = sum(api.sent.values())
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    bot.update_engine.join(30)
+    bot.outbox.join(30)
+    wall = time.perf_counter() - t0
+    sends = sum(api.sent.values()) - sent_before
+    db_bytes = sum(os.path.getsize(p) for p in (os.environ["DB_FILE"], os.environ["DB_FILE"] + "-wal")
+                   if os.path.exists(p))
+    api.stop()
+
+    return {
+        "listings": args.listings, "users": args.users, "rounds": args.rounds, "runtime": args.runtime,
+        "seed_secs": round(seed_secs, 2), "db_mb": round(db_bytes / 1e6, 1),
+        "wall_secs": round(wall, 3), "updates": len(handler_samples),
+        "updates_per_sec": round(len(handler_samples) / wall, 1), "sends_per_sec": round(sends / wall, 1),
+        "handler_ms": summarize_ms(handler_samples), "reply_ms": summarize_ms(driver.rtt),
+        "timeouts": driver.timeouts,
+    }
+
+# ==========================[ تشغيل كل الأحجام ]==========================
+def git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return "unknown"
+
+def print_table(rows: List[Dict[str, Any]]):
+    print(f"{'listings':>9} {'db MB':>7} {'upd/s':>8} {'send/s':>8} "
+          f"{'h p50':>7} {'h p95':>7} {'h p99':>7} {'r p50':>7} {'r p95':>7} {'r p99':>7} {'t/o':>4}")
+    for r in rows:
+        h, rt = r["handler_ms"], r["reply_ms"]
+        print(f"{r['listings']:>9} {r['db_mb']:>7} {r['updates_per_sec']:>8} {r['sends_per_sec']:>8} "
+              f"{h['p50']:>7.2f} {h['p95']:>7.2f} {h['p99']:>7.2f} "
+              f"{rt['p50']:>7.2f} {rt['p95']:>7.2f} {rt['p99']:>7.2f} {r['timeouts']:>4}")
+    print("(h = handler latency inside the bot, r = user-visible reply latency; milliseconds)")
+
+def main():
+    ap = argparse.ArgumentParser(description="Amanex offline load test against a fake Bot API")
+    ap.add_argument("--users", type=int, default=20, help="concurrent simulated users (sellers/buyers alternate)")
+    ap.add_argument("--rounds", type=int, default=2, help="flows each user runs")
+    ap.add_argument("--listings", default="1000,10000", help="comma separated DB sizes (seeded listings)")
+    ap.add_argument("--runtime", choices=("sync", "async"), default="sync")
+    ap.add_argument("--workers", type=int, default=None, help="UPDATE_WORKERS for the sync runtime")
+    ap.add_argument("--no-admin", dest="admin", action="store_false", help="skip the admin lookup user")
+    ap.add_argument("--api-latency", type=float, default=0.0, help="artificial seconds per Bot API send")
+    ap.add_argument("--telegram-limits", action="store_true",
+                    help="keep the real per-chat/global send rate limits (reply latency then reflects them)")
+    ap.add_argument("--step-timeout", type=float, default=30.0)
+    ap.add_argument("--out", default=os.path.join(HERE, "results"), help="directory for the JSON report")
+    ap.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.single:
+        args.listings = int(args.listings)
+        print(json.dumps(run_single(args)))
+        return
+
+    rows = []
+    for n in [int(x) for x in args.listings.split(",") if x.strip()]:
+        print(f"== {n} listings ==", file=sys.stderr, flush=True)
+        cmd = [sys.executable, os.path.abspath(__file__), "--single", "--listings", str(n)]
+        for flag in ("users", "rounds", "runtime", "workers", "api_latency", "step_timeout"):
+            value = getattr(args, flag)
+            if value is not None:
+                cmd += ["--" + flag.replace("_", "-"), str(value)]
+        if not args.admin:
+            cmd.append("--no-admin")
+        if args.telegram_limits:
+            cmd.append("--telegram-limits")
+        out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout
+        rows.append(json.loads(out.strip().splitlines()[-1]))
+
+    print_table(rows)
+    os.makedirs(args.out, exist_ok=True)
+    report = {"commit": git_rev(), "date": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+              "python": platform.python_version(), "results": rows}
+    path = os.path.join(args.out, f"loadtest-{datetime.utcnow():%Y%m%d-%H%M%S}-{report['commit']}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"report: {path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+فحص خطط الاستعلامات: يستدعي دوال قاعدة البيانات الساخنة في bot.py كما هي، يلتقط كل جملة SQL
+تنفّذها فعلاً (set_trace_callback)، ومعها جمل كل trigger في المخطط (EXPLAIN QUERY PLAN لا يُظهر
+برامج الـ triggers ضمن خطة الجملة التي تطلقها، فتُفحص أجسامها منفردة بعد استبدال new./old. بمعاملات)،
+ثم يشغّل EXPLAIN QUERY PLAN عليها ويفشل (exit 1) إن وُجد:
+  - SCAN لجدول دون فهرس (قراءة الجدول كاملاً)
+  - USE TEMP B-TREE FOR ORDER BY (فرز بعد التصفية بدل قراءة الفهرس بالترتيب)، عدا ترتيب FTS بالصلة
+
+    python benchmarks/query_plans.py              # قاعدة جديدة فارغة (المخطط لا يعتمد على البيانات بدون ANALYZE)
+    python benchmarks/query_plans.py --db amanex_bot.db -v
+    make check                                    # نفس الفحص مع compileall (للتشغيل قبل كل دمج)
+
+رمز الخروج: 0 = كل الاستعلامات مفهرسة، 1 = استعلام بلا فهرس، 2 = الفحص نفسه لم يلتقط استعلاماً سيئاً معروفاً.
+
+عند إضافة استعلام جديد إلى bot.py أضف استدعاءه إلى hot_calls().
+"""
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+from typing import Any, Callable, List, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# جمل لا تُفحص: التحكم بالمعاملات والـ pragmas (وفحص sqlite_master صغير ومرة واحدة).
+# "-- TRIGGER name" أسطر يطبعها التتبع عند إطلاق trigger وليست جملاً؛ أجسام الـ triggers تُفحص
+# من sqlite_master في trigger_statements(). جمل INSERT تُفحص (خطة INSERT … SELECT هي خطة الـ SELECT).
+IGNORED_SQL = re.compile(r"^\s*(--|(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|PRAGMA)\b)", re.I)
+TRIGGER_ROW_REF = re.compile(r"\b(?:new|old)\.\w+", re.I)
+FULL_SCAN = re.compile(r"^SCAN (?!CONSTANT ROW)(?!sqlite_)(\w+)(?!.*\bUSING\b.*\bINDEX\b)(?!.*VIRTUAL TABLE)")
+TEMP_SORT = re.compile(r"USE TEMP B-TREE FOR (?:RIGHT PART OF )?ORDER BY")
+
+# استعلامات معروفة السوء: يجب أن يلتقطها الفحص وإلا فالأنماط أعلاه لم تعد تطابق مخرجات SQLite
+CANARIES = (
+    "SELECT id FROM listings WHERE description = 'x'",                 # SCAN listings
+    "SELECT id FROM listings WHERE status = 'active' ORDER BY created_at",  # TEMP B-TREE FOR ORDER BY
+)
+
+def plan_problems(conn, sql: str, params: tuple = ()) -> Tuple[List[str], List[str]]:
+    """(خطة الاستعلام، الأسطر المخالفة منها)."""
+    plan = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+    # ترتيب نتائج FTS حسب الصلة (bm25) يستلزم فرزاً بطبيعته
+    ranked = any("VIRTUAL TABLE" in p for p in plan)
+    return plan, [p for p in plan if FULL_SCAN.match(p) or (TEMP_SORT.search(p) and not ranked)]
+
+def trigger_statements(conn) -> List[Tuple[str, str, int]]:
+    """
+    (اسم الـ trigger، جملة من جسمه، عدد المعاملات): كل new.col / old.col يصبح "?"
+    فتُفحص خطة الجملة كما ينفّذها SQLite لصف واحد (القيم لا تغيّر المخطط).
+    """
+    out = []
+    for name, sql in conn.execute("SELECT name, sql FROM sqlite_master WHERE type='trigger' ORDER BY name"):
+        body = sql[re.search(r"\bBEGIN\b", sql, re.I).end():sql.upper().rstrip().rfind("END")]
+        for stmt in body.split(";"):
+            if stmt.strip():
+                stmt, n = TRIGGER_ROW_REF.subn("?", stmt)
+                out.append((name, stmt.strip(), n))
+    return out
+
+def hot_calls(bot) -> List[Tuple[str, Callable[[], Any]]]:
+    """
+    كل دالة قراءة/كتابة ساخنة بمعاملات نموذجية (القيم لا تهم المخطط)، مع إعلان وطلب مزروعين
+    حتى تُنفَّذ المسارات التي لا تعمل إلا عند وجود صف (مثل قراءة الصور وطرق الدفع).
+    """
+    users = bot.SqliteSessionBackend()
+    user = bot.types.User(id=1, is_bot=False, first_name="Plan")
+    cat, sub = "games", "PUBG Mobile"
+    seed = bot.create_listing(1, cat, sub, "pubg plan", ["img"], "10 USDT", ["MTN"], {"MTN": "x"}, "@s")
+    order = bot.create_order(seed["id"], 1, "MTN", "proof", "@x")
+    return [
+        ("get_listing_by_id",           lambda: bot.get_listing_by_id(seed["id"])),
+        ("get_listing_by_seq",          lambda: bot.get_listing_by_seq(seed["seq"])),
+        ("get_order_by_seq",            lambda: bot.get_order_by_seq(order["seq"])),
+        ("get_user_listings",           lambda: bot.get_user_listings(1)),
+        ("get_user_orders",             lambda: bot.get_user_orders(1)),
+        ("get_pending_listings",        lambda: bot.get_pending_listings()),
+        ("get_paid_orders",             lambda: bot.get_paid_orders()),
+        ("get_stats",                   lambda: bot.get_stats()),
+        ("browse newest",               lambda: bot._load_active_listings(cat, sub, 6)),
+        ("browse newest next page",     lambda: bot._load_active_listings(cat, sub, 6, before_id=2)),
+        ("browse newest prev page",     lambda: bot._load_active_listings(cat, sub, 6, after_id=1)),
+        ("browse by payment method",    lambda: bot._load_active_listings(cat, sub, 6, before_id=2,
+                                                                          pay_method="MTN")),
+        ("browse cheapest first",       lambda: bot._load_active_listings(cat, sub, 6, sort="price")),
+        ("browse cheapest next page",   lambda: bot._load_active_listings(cat, sub, 6, before_id=1,
+                                                                          sort="price")),
+        ("browse max price",            lambda: bot._load_active_listings(cat, sub, 6, sort="price",
+                                                                          max_price=(10.0, "USDT"))),
+        ("search",                      lambda: bot.search_active_listings("pubg", pay_method="MTN",
+                                                                           max_price=(10.0, "USDT"))),
+        ("save_user_if_not_exists",     lambda: bot.save_user_if_not_exists(user)),
+        ("update_listing_status",       lambda: bot.update_listing_status(1, "active")),
+        ("pending ids",                 lambda: bot.get_pending_listing_ids()),
+        ("pending ids by category",     lambda: bot.get_pending_listing_ids(cat)),
+        ("bulk status",                 lambda: bot.bulk_update_listing_status([seed["id"], 2, 3], "sold")),
+        ("session load",                lambda: users.load(1)),
+        ("session save",                lambda: users.save_many({1: ("{}", 0.0), 2: None})),
+        ("session purge",               lambda: users.purge_idle(0.0)),
+        ("sequence bump",               lambda: bot.create_order(1, 1, "MTN", "proof", "@x")),
+    ]
+
+def main():
+    ap = argparse.ArgumentParser(description="Fail if a hot bot.py query falls back to a full scan")
+    ap.add_argument("--db", help="check against a scratch copy of this database instead of a fresh one")
+    ap.add_argument("-v", "--verbose", action="store_true", help="print every plan")
+    args = ap.parse_args()
+
+    work = tempfile.mkdtemp(prefix="amanex-plans-")
+    db = os.path.join(work, "amanex_bot.db")
+    if args.db:
+        with sqlite3.connect(f"file:{os.path.abspath(args.db)}?mode=ro", uri=True) as s, sqlite3.connect(db) as d:
+            s.backup(d)
+    os.environ.update({"BOT_TOKEN": "0:PLANS", "ADMIN_ID": "1", "DB_FILE": db, "BOT_MODE": "polling",
+                       "BOT_RUNTIME": "sync", "UPDATE_RECORD_FILE": "", "BACKUP_DIR": os.path.join(work, "backups"),
+                       "METRICS_ENABLED": "0"})
+    os.chdir(work)
+    sys.path.insert(0, ROOT)
+    import logging
+    import bot
+    logging.getLogger().setLevel(logging.WARNING)
+
+    bot.init_db()
+    bot.migrate_db()
+    conn = bot.db_conn()
+    for sql in CANARIES:
+        if not plan_problems(conn, sql)[1]:
+            print(f"checker did not flag a known full scan: {sql}")
+            sys.exit(2)
+    failures = 0
+
+    def check(name: str, sql: str, params: tuple = ()):
+        nonlocal failures
+        plan, bad = plan_problems(conn, sql, params)
+        failures += bool(bad)
+        if bad or args.verbose:
+            print(f"{'FAIL' if bad else 'ok  '} {name}: {' '.join(sql.split())[:160]}")
+            for p in plan:
+                print(f"       {'!!' if p in bad else '  '} {p}")
+
+    for trigger, sql, n_params in trigger_statements(conn):
+        check(f"trigger {trigger}", sql, (None,) * n_params)
+    for name, call in hot_calls(bot):
+        statements: List[str] = []
+        conn.set_trace_callback(statements.append)
+        try:
+            call()
+        finally:
+            conn.set_trace_callback(None)
+        for sql in statements:
+            if not IGNORED_SQL.match(sql):
+                check(name, sql)
+    if failures:
+        print(f"{failures} statement(s) without a usable index")
+        sys.exit(1)
+    print("all hot queries use indexes")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+إعادة تشغيل تحديثات مسجّلة من الإنتاج (UPDATE_RECORD_FILE في bot.py) عبر المعالجات الحقيقية،
+مقابل نسخة مؤقتة من amanex_bot.db، والصادر كله إلى مُرسل وهمي (لا اتصال بتيليجرام).
+يطبع زمن المعالج p50/p95/p99 إجمالاً ولكل (flow, step)، ويحفظ النتيجة لمقارنتها قبل/بعد تعديل:
+
+    python benchmarks/replay.py updates.jsonl.2 updates.jsonl.1 updates.jsonl --speed 10 --json before.json
+    python benchmarks/replay.py updates.jsonl --speed 0 --baseline before.json
+
+--speed 1 = الإيقاع الأصلي، 10 = أسرع بعشر مرات، 0 = بأقصى سرعة.
+الملفات تُمرَّر من الأقدم للأحدث (النسخ الدوّارة .N أقدم من الملف الحالي).
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+def percentile(samples: List[float], p: float) -> float:
+    if not samples:
+        return 0.0
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(round(p / 100.0 * (len(s) - 1))))]
+
+def summarize_ms(samples: List[float]) -> Dict[str, float]:
+    return {"p50": percentile(samples, 50) * 1000, "p95": percentile(samples, 95) * 1000,
+            "p99": percentile(samples, 99) * 1000, "n": len(samples)}
+
+def read_records(paths: List[str]) -> Iterator[Dict[str, Any]]:
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+class StubSender:
+    """يحل محل TeleBot في الطابور الصادر: يعدّ الاستدعاءات حسب الطريقة ولا يرسل شيئاً."""
+    def __init__(self):
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def __getattr__(self, method: str):
+        def send(*args, **kwargs):
+            with self._lock:
+                self.calls[method] += 1
+        return send
+
+def scratch_copy(src: str, dst: str):
+    """نسخة متسقة حتى لو كانت القاعدة مفتوحة (backup API)، والأصل لا يُلمس."""
+    with sqlite3.connect(f"file:{src}?mode=ro", uri=True) as s, sqlite3.connect(dst) as d:
+        s.backup(d)
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay recorded Telegram updates through the bot handlers")
+    ap.add_argument("files", nargs="+", help="recorded JSONL files, oldest first")
+    ap.add_argument("--db", default=os.path.join(ROOT, "amanex_bot.db"), help="database to copy into a scratch dir")
+    ap.add_argument("--speed", type=float, default=0.0, help="1 = original pacing, N = N times faster, 0 = no pacing")
+    ap.add_argument("--admin-id", default=os.getenv("ADMIN_ID", "1"), help="ADMIN_ID the stream was recorded with")
+    ap.add_argument("--workers", type=int, default=None, help="UPDATE_WORKERS (default: bot default)")
+    ap.add_argument("--json", dest="json_out", help="write the summary here")
+    ap.add_argument("--baseline", help="earlier --json summary to compare against")
+    args = ap.parse_args()
+    args.files = [os.path.abspath(p) for p in args.files]
+    for name in ("db", "json_out", "baseline"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    records = list(read_records(args.files))
+    if not records:
+        sys.exit("no updates in the given files")
+
+    work = tempfile.mkdtemp(prefix="amanex-replay-")
+    db = os.path.join(work, "amanex_bot.db")
+    if os.path.exists(args.db):
+        scratch_copy(args.db, db)
+    # الإعدادات تُقرأ عند استيراد bot؛ وبلا تسجيل حتى لا يُعاد تسجيل ما نعيد تشغيله
+    os.environ.update({"BOT_TOKEN": "0:REPLAY", "ADMIN_ID": str(args.admin_id), "DB_FILE": db,
+                       "BOT_MODE": "polling", "BOT_RUNTIME": "sync", "UPDATE_RECORD_FILE": "",
+                       "BACKUP_DIR": os.path.join(work, "backups")})
+    if args.workers is not None:
+        os.environ["UPDATE_WORKERS"] = str(args.workers)
+    os.chdir(work)
+    sys.path.insert(0, ROOT)
+    import logging
+    import bot
+    from telebot import types
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.telebot.logger.setLevel(logging.WARNING)
+
+    stub = StubSender()
+    bot.outbox.tg = stub
+    bot.init_db()
+    bot.migrate_db()
+    bot.user_states.start()
+    bot.update_engine.start()
+
+    update_samples: List[float] = []
+    step_samples: Dict[str, List[float]] = defaultdict(list)
+    process, record_step = bot.update_engine.process, bot.router._record
+
+    def timed_process(updates):
+        t0 = time.perf_counter()
+        try:
+            process(updates)
+        finally:
+            update_samples.append(time.perf_counter() - t0)
+
+    def timed_step(flow, step, elapsed):
+        step_samples[f"{flow}/{step}"].append(elapsed)
+        record_step(flow, step, elapsed)
+
+    bot.update_engine.process = timed_process
+    bot.router._record = timed_step
+
+    t_first = records[0]["t"]
+    t0 = time.perf_counter()
+    for rec in records:
+        if args.speed > 0:
+            delay = (rec["t"] - t_first) / args.speed - (time.perf_counter() - t0)
+            if delay > 0:
+                time.sleep(delay)
+        bot.bot.process_new_updates([types.Update.de_json(rec["update"])])
+    bot.update_engine.join()
+    wall = time.perf_counter() - t0
+    bot.user_states.close()
+
+    summary = {
+        "files": args.files, "updates": len(records), "speed": args.speed, "wall_secs": round(wall, 3),
+        "updates_per_sec": round(len(records) / wall, 1), "update_ms": summarize_ms(update_samples),
+        "steps": {k: summarize_ms(v) for k, v in sorted(step_samples.items())},
+        "sends": dict(stub.calls),
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    def row(name: str, cur: Dict[str, float], base: Dict[str, float] = None):
+        line = f"{name[:40]:<40} {cur['n']:>7} {cur['p50']:>8.2f} {cur['p95']:>8.2f} {cur['p99']:>8.2f}"
+        if base:
+            line += "   Δp50 {:+.2f}  Δp95 {:+.2f}  Δp99 {:+.2f}".format(
+                cur["p50"] - base["p50"], cur["p95"] - base["p95"], cur["p99"] - base["p99"])
+        print(line)
+
+    print(f"{len(records)} updates in {wall:.2f}s ({summary['updates_per_sec']} updates/s), "
+          f"sends: {sum(stub.calls.values())}")
+    print(f"{'handler (ms)':<40} {'n':>7} {'p50':>8} {'p95':>8} {'p99':>8}")
+    row("<all updates>", summary["update_ms"], baseline and baseline.get("update_ms"))
+    for name, cur in sorted(summary["steps"].items(), key=lambda kv: -kv[1]["n"]):
+        row(name, cur, baseline and baseline.get("steps", {}).get(name))
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+
+if __name__ == "__main__":
+    main()
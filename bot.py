@@ -19,13 +19,27 @@ Amanex Bot — وسيط بيع/شراء حسابات (نسخة مُحدّثة)
 
 import os
 import sys
+import html
 import json
 import time
+import atexit
+import gzip
+import asyncio
 import shutil
 import sqlite3
 import logging
-from datetime import datetime
-from typing import Dict, Any, Optional, List
+import re
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Any, Optional, List, Tuple
+
+try:
+    import fcntl   # قفل ملكية مخزن الجلسات (غير متوفر على Windows: يُتجاوز الفحص)
+except ImportError:
+    fcntl = None
 
 from dotenv import load_dotenv
 import telebot
@@ -33,9 +47,14 @@ from telebot import types
 
 from telebot.apihelper import ApiTelegramException
 
+_IMPORT_T0 = time.perf_counter()   # زمن تنفيذ جسم الوحدة يظهر في تقرير الإقلاع
+
 # =========================[ تحميل متغيرات البيئة ]====================
 # تأكد أن لديك ملف .env في نفس المجلد يحتوي القيم المطلوبة.
-load_dotenv()
+# يُحمَّل فقط عند التشغيل المباشر (python bot.py)؛ server.py يحمّله قبل استيراد bot،
+# أما الأدوات (benchmarks/) فتستورد bot دون .env الإنتاج فلا تتسرب إليها مفاتيح لم تضبطها.
+if __name__ == "__main__":
+    load_dotenv()
 
 # =========================[ إعدادات أساسية ]=========================
 # يُقرأ التوكن ومعرّف الإدمن من متغيرات البيئة
@@ -58,23 +77,459 @@ TONKEEPER_NOTE    = os.getenv("TONKEEPER_NOTE", "USDT فقط عبر شبكة TRC
 TRUSTWALLET_ADDRESS = os.getenv("TRUSTWALLET_ADDRESS", "").strip()
 TRUSTWALLET_NOTE    = os.getenv("TRUSTWALLET_NOTE", "USDT فقط عبر شبكة TRC20").strip()
 
-DB_FILE = "amanex_bot.db"
+DB_FILE = os.getenv("DB_FILE", "amanex_bot.db").strip()
 DEBUG   = True
 
+# طريقة استقبال التحديثات: polling (الافتراضي) أو webhook عبر Flask في server.py.
+# في الحالتين عملية واحدة تملك البوت (حالات المحادثة، مسارات المستخدمين، الكاش، حدود الإرسال كلها
+# في الذاكرة): gunicorn بـ worker واحد، والتوازي داخله عبر UpdateEngine (UPDATE_WORKERS).
+BOT_MODE       = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL    = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")   # مثال: https://amanex.onrender.com
+WEBHOOK_PATH   = os.getenv("WEBHOOK_PATH", "/telegram/webhook").strip()
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()            # يُرسله تيليجرام في X-Telegram-Bot-Api-Secret-Token
+
+# /stats في server.py (JSON للوحات المراقبة): يتطلب "Authorization: Bearer <STATS_TOKEN>"، وفارغ = معطّل
+STATS_TOKEN = os.getenv("STATS_TOKEN", "").strip()
+
+# عنوان Bot API (للاختبار مقابل خادم محلي مثل benchmarks/fake_bot_api.py) — فارغ = api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip().rstrip("/")
+
+# بيئة التشغيل: sync (خيوط TeleBot) أو async (AsyncTeleBot على asyncio، مع polling فقط)
+BOT_RUNTIME = os.getenv("BOT_RUNTIME", "sync").strip().lower()
+
 # =======================[ تهيئة اللوجر والبوت ]======================
 telebot.logger.setLevel(logging.INFO if not DEBUG else logging.DEBUG)
-if not BOT_TOKEN:
-    print("❌ BOT_TOKEN غير مضبوط. ضع متغير البيئة BOT_TOKEN في .env.")
-    sys.exit(1)
-if not ADMIN_ID:
-    print("❌ ADMIN_ID غير مضبوط. ضع متغير البيئة ADMIN_ID (رقم حسابك العددي).")
-    sys.exit(1)
 
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
+def config_errors() -> List[str]:
+    """أخطاء الإعداد التي تمنع التشغيل (تُفحص عند بدء البوت، لا عند استيراد الوحدة)."""
+    errors = []
+    if not BOT_TOKEN:
+        errors.append("❌ BOT_TOKEN غير مضبوط. ضع متغير البيئة BOT_TOKEN في .env.")
+    if not ADMIN_ID:
+        errors.append("❌ ADMIN_ID غير مضبوط. ضع متغير البيئة ADMIN_ID (رقم حسابك العددي).")
+    if BOT_MODE not in ("polling", "webhook"):
+        errors.append("❌ BOT_MODE يجب أن يكون polling أو webhook.")
+    if BOT_MODE == "webhook" and not (WEBHOOK_URL and WEBHOOK_SECRET):
+        errors.append("❌ وضع webhook يتطلب WEBHOOK_URL و WEBHOOK_SECRET في .env.")
+    if BOT_MODE == "webhook" and int(os.getenv("WEB_CONCURRENCY", "1") or "1") > 1:
+        # الجلسات وطوابير المستخدمين والكاش وحدود الإرسال في ذاكرة العملية: worker واحد فقط
+        errors.append("❌ وضع webhook يعمل بـ worker واحد فقط (WEB_CONCURRENCY=1)؛ التوازي عبر UPDATE_WORKERS.")
+    if BOT_RUNTIME not in ("sync", "async"):
+        errors.append("❌ BOT_RUNTIME يجب أن يكون sync أو async.")
+    if BOT_RUNTIME == "async" and BOT_MODE == "webhook":
+        errors.append("❌ وضع async يعمل مع polling فقط (webhook يمر عبر Flask المتزامن في server.py).")
+    return errors
+
+def check_config():
+    errors = config_errors()
+    if errors:
+        print("\n".join(errors))
+        sys.exit(1)
+
+# threaded=False: تنفيذ المعالجات تتولاه UpdateEngine (مسار تسلسلي لكل مستخدم).
+# الإنشاء لا يتصل بالشبكة ولا يشغّل خيوطاً؛ التوكن يُفحص في check_config عند البدء.
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=False, validate_token=False)
+
+# =========================[ المقاييس (Prometheus) ]=====================
+# عدّادات ومدرّجات زمنية داخل العملية تُعرض بصيغة Prometheus النصية على /metrics في server.py.
+# METRICS_ENABLED=0 يجعل كل التسجيل عمليات فارغة (فحص علم واحد) ويُرجع /metrics بـ 404.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").strip() != "0"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple = (), n: float = 1):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + n
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for lv, v in sorted(self._values.items()):
+                out.append(f"{self.name}{_fmt_labels(self.labels, lv)} {v}")
+        return out
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self._values: Dict[Tuple, List[float]] = {}    # labels -> [عدّ كل حد..., المجموع, العدد]
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple, value: float):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            v = self._values.get(labels)
+            if v is None:
+                v = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    v[i] += 1
+                    break
+            v[-2] += value
+            v[-1] += 1
+
+    @contextmanager
+    def time(self, labels: Tuple = ()):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(labels, time.perf_counter() - t0)
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for lv, v in sorted(self._values.items()):
+                acc = 0
+                for i, b in enumerate(self.buckets):
+                    acc += v[i]
+                    le = 'le="%s"' % b
+                    out.append(f"{self.name}_bucket{_fmt_labels(self.labels, lv, le)} {acc}")
+                le = 'le="+Inf"'
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, lv, le)} {v[-1]}")
+                out.append(f"{self.name}_sum{_fmt_labels(self.labels, lv)} {v[-2]}")
+                out.append(f"{self.name}_count{_fmt_labels(self.labels, lv)} {v[-1]}")
+        return out
+
+class Gauge:
+    """قيمة تُقرأ لحظة العرض من دالة (لا حالة تُحدَّث في المسار الساخن)."""
+    def __init__(self, name: str, doc: str, fn: Callable[[], float]):
+        self.name, self.doc, self.fn = name, doc, fn
+
+    def render(self) -> List[str]:
+        try:
+            value = self.fn()
+        except Exception as e:
+            logging.warning("gauge %s failed: %s", self.name, e)
+            return []
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Any] = []
+
+    def counter(self, name: str, doc: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._add(Counter(name, doc, labels))
+
+    def histogram(self, name: str, doc: str, labels: Tuple[str, ...] = ()) -> Histogram:
+        return self._add(Histogram(name, doc, labels))
+
+    def gauge(self, name: str, doc: str, fn: Callable[[], float]) -> Gauge:
+        return self._add(Gauge(name, doc, fn))
+
+    def _add(self, m):
+        self._metrics.append(m)
+        return m
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+M_UPDATE_SECONDS  = metrics.histogram("amanex_update_seconds", "Time to process one Telegram update.", ("type",))
+M_HANDLER_SECONDS = metrics.histogram("amanex_handler_seconds", "Text/photo handler latency by flow and step.", ("flow", "step"))
+M_DB_SECONDS      = metrics.histogram("amanex_db_seconds", "Latency of database helpers.", ("op",))
+M_TG_SECONDS      = metrics.histogram("amanex_telegram_api_seconds", "Outbound Telegram Bot API call latency.", ("method",))
+M_TG_ERRORS       = metrics.counter("amanex_telegram_api_errors_total", "Failed Telegram Bot API calls by error code.", ("method", "code"))
+M_TG_429          = metrics.counter("amanex_telegram_api_429_total", "Telegram flood-control (429) responses.", ("method",))
+
+def db_timed(op: str):
+    """يقيس زمن دالة قاعدة بيانات تحت amanex_db_seconds{op=...}."""
+    def deco(fn):
+        def wrapper(*args, **kwargs):
+            if not METRICS_ENABLED:
+                return fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                M_DB_SECONDS.observe((op,), time.perf_counter() - t0)
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+    return deco
 
 # =========================[ حالات المستخدم ]=========================
 # user_states[user_id] = dict(...)
-user_states: Dict[int, Dict[str, Any]] = {}
+# الحالات تعيش في ذاكرة محدودة (LRU) وتنتهي بعد خمول، وتُكتب بشكل مؤجل إلى جدول user_sessions
+# حتى لا تضيع عند إعادة التشغيل، وتُعاد قراءتها عند أول رسالة من المستخدم.
+# الذاكرة هي المرجع، لذلك عملية واحدة فقط تملك المخزن لكل قاعدة بيانات: start() يحجز قفل ملف
+# بجانب DB_FILE ويرفض البدء إن كانت عملية أخرى (worker ثانٍ، أو polling مع webhook) تملكه.
+SESSION_BACKEND    = os.getenv("SESSION_BACKEND", "sqlite").strip().lower()   # sqlite | memory
+SESSION_MAX_ACTIVE = int(os.getenv("SESSION_MAX_ACTIVE", "5000"))
+SESSION_IDLE_TTL   = int(os.getenv("SESSION_IDLE_TTL", str(6 * 3600)))       # بالثواني
+SESSION_FLUSH_SECS = float(os.getenv("SESSION_FLUSH_SECS", "2"))
+
+class MemorySessionBackend:
+    """بدون تخزين دائم: ما يخرج من الذاكرة يضيع (للتجارب والأدوات)."""
+    def load(self, uid: int) -> Optional[Tuple[str, float]]:
+        return None
+
+    def save_many(self, items: Dict[int, Optional[Tuple[str, float]]]):
+        pass
+
+    def purge_idle(self, before: float):
+        pass
+
+class SqliteSessionBackend:
+    """يحفظ الحالات كـ JSON في جدول user_sessions (صف لكل مستخدم)."""
+    @db_timed("session_load")
+    def load(self, uid: int) -> Optional[Tuple[str, float]]:
+        with db_read() as c:
+            c.execute("SELECT state_json, updated_at FROM user_sessions WHERE telegram_id=?", (uid,))
+            row = c.fetchone()
+        return (row["state_json"], row["updated_at"]) if row else None
+
+    @db_timed("session_save")
+    def save_many(self, items: Dict[int, Optional[Tuple[str, float]]]):
+        upserts = [(uid, v[0], v[1]) for uid, v in items.items() if v is not None]
+        deletes = [(uid,) for uid, v in items.items() if v is None]
+        with db_write() as c:
+            if upserts:
+                c.executemany("INSERT OR REPLACE INTO user_sessions (telegram_id, state_json, updated_at) VALUES (?,?,?)", upserts)
+            if deletes:
+                c.executemany("DELETE FROM user_sessions WHERE telegram_id=?", deletes)
+
+    def purge_idle(self, before: float):
+        with db_write() as c:
+            c.execute("DELETE FROM user_sessions WHERE updated_at < ?", (before,))
+
+class SessionStore:
+    """
+    مخزن حالات المحادثة بنفس واجهة القاموس القديمة (get / [] / pop / in / len).
+    - LRU محدود بـ max_active مع انتهاء الحالة بعد idle_ttl ثانية من الخمول.
+    - كل حالة تُقرأ تُعتبر "ملموسة" (المعالجات تعدّلها في مكانها)، وخيط الكتابة المؤجلة
+      يحفظ فقط ما تغيّر فعلاً مقارنةً بآخر JSON محفوظ.
+    - الحالة المطرودة من الذاكرة تُحفظ ثم تُعاد قراءتها بكسل عند الرسالة التالية.
+    - صحيح في عملية واحدة فقط: عملية أخرى تقرأ user_sessions ترى حالة متأخرة بمقدار flush_interval
+      وتكتب فوقها. owner_lock (مسار ملف) يفرض ذلك عند start().
+    """
+    _PURGE_EVERY = 300.0
+
+    def __init__(self, backend, max_active: int, idle_ttl: int, flush_interval: float,
+                 owner_lock: Optional[str] = None):
+        self._backend = backend
+        self.owner_lock = owner_lock
+        self._owner_fd = None
+        self.max_active = max(1, max_active)
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self._lock = threading.RLock()
+        # uid -> [state أو None (لا حالة — تجنّب قراءة DB مجدداً), آخر نشاط]
+        self._mem: "OrderedDict[int, List[Any]]" = OrderedDict()
+        self._persisted: Dict[int, str] = {}                          # آخر JSON محفوظ لكل مستخدم في الذاكرة
+        self._touched: set = set()
+        self._pending: Dict[int, Optional[Tuple[str, float]]] = {}    # كتابات المطرودين/المحذوفين
+        self._last_purge = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    # ---------- واجهة القاموس ----------
+    def get(self, uid: int, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(uid)
+            if entry is not None:
+                if now - entry[1] > self.idle_ttl:
+                    self._drop(uid)
+                    return default
+                entry[1] = now
+                self._mem.move_to_end(uid)
+                if entry[0] is None:
+                    return default
+                self._touched.add(uid)
+                return entry[0]
+            if uid in self._pending:
+                raw = self._pending.pop(uid)
+                state = json.loads(raw[0]) if raw and now - raw[1] <= self.idle_ttl else None
+                self._insert(uid, state, now)
+                if state is None:
+                    # الحذف لم يُكتب بعد؛ نُبقيه معلّقاً
+                    self._pending[uid] = None
+                    return default
+                self._touched.add(uid)
+                return state
+
+        raw = self._backend.load(uid)   # خارج القفل حتى لا تنتظر بقية المحادثات قراءة DB
+        with self._lock:
+            entry = self._mem.get(uid)
+            if entry is not None:
+                return entry[0] if entry[0] is not None else default
+            state = None
+            if raw and now - raw[1] <= self.idle_ttl:
+                state = json.loads(raw[0])
+                self._persisted[uid] = raw[0]
+            self._insert(uid, state, now)
+            return state if state is not None else default
+
+    def __getitem__(self, uid: int) -> Dict[str, Any]:
+        state = self.get(uid)
+        if state is None:
+            raise KeyError(uid)
+        return state
+
+    def __setitem__(self, uid: int, state: Dict[str, Any]):
+        with self._lock:
+            self._pending.pop(uid, None)
+            if uid in self._mem:
+                self._mem[uid] = [state, time.time()]
+                self._mem.move_to_end(uid)
+            else:
+                self._insert(uid, state, time.time())
+            self._touched.add(uid)
+
+    def pop(self, uid: int, default=None):
+        state = self.get(uid)
+        with self._lock:
+            if uid in self._mem:
+                self._mem[uid][0] = None
+                self._touched.add(uid)
+        return state if state is not None else default
+
+    def __contains__(self, uid: int) -> bool:
+        return self.get(uid) is not None
+
+    def peek(self, uid: int) -> Optional[Dict[str, Any]]:
+        """قراءة للاطلاع فقط (للتسجيل مثلاً): لا تغيّر ترتيب LRU ولا وقت النشاط ولا تُحمّل الحالة في الذاكرة."""
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(uid)
+            if entry is not None:
+                return entry[0] if now - entry[1] <= self.idle_ttl else None
+            if uid in self._pending:
+                raw = self._pending[uid]
+                return json.loads(raw[0]) if raw and now - raw[1] <= self.idle_ttl else None
+        raw = self._backend.load(uid)
+        return json.loads(raw[0]) if raw and now - raw[1] <= self.idle_ttl else None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(1 for e in self._mem.values() if e[0] is not None)
+
+    # ---------- داخلي ----------
+    def _insert(self, uid: int, state, now: float):
+        self._mem[uid] = [state, now]
+        while len(self._mem) > self.max_active:
+            old_uid, (old_state, seen) = self._mem.popitem(last=False)
+            self._touched.discard(old_uid)
+            js = json.dumps(old_state, ensure_ascii=False) if old_state is not None else None
+            if js != self._persisted.pop(old_uid, None):
+                self._pending[old_uid] = (js, seen) if js is not None else None
+
+    def _drop(self, uid: int):
+        self._mem.pop(uid, None)
+        self._touched.discard(uid)
+        if self._persisted.pop(uid, None) is not None:
+            self._pending[uid] = None
+
+    def _expire_idle(self, now: float):
+        while self._mem:
+            uid, entry = next(iter(self._mem.items()))
+            if now - entry[1] <= self.idle_ttl:
+                break
+            self._drop(uid)
+
+    # ---------- الكتابة المؤجلة ----------
+    def flush(self):
+        """يكتب الحالات المتغيّرة دفعة واحدة (معاملة واحدة)."""
+        now = time.time()
+        with self._lock:
+            self._expire_idle(now)
+            writes = dict(self._pending)
+            self._pending.clear()
+            retry = set()
+            for uid in self._touched:
+                state, seen = self._mem[uid]
+                try:
+                    js = json.dumps(state, ensure_ascii=False) if state is not None else None
+                except (RuntimeError, TypeError, ValueError):
+                    # تُعدَّل الآن من خيط آخر — نعيد المحاولة في الدورة القادمة
+                    retry.add(uid)
+                    continue
+                if js != self._persisted.get(uid):
+                    writes[uid] = (js, seen) if js is not None else None
+            self._touched = retry
+        if writes:
+            try:
+                self._backend.save_many(writes)
+            except Exception as e:
+                logging.exception("session flush failed: %s", e)
+                with self._lock:
+                    for uid, v in writes.items():
+                        if uid not in self._mem:
+                            self._pending.setdefault(uid, v)
+                        else:
+                            self._touched.add(uid)
+                return
+            with self._lock:
+                for uid, v in writes.items():
+                    if uid not in self._mem:
+                        continue
+                    if v is None:
+                        self._persisted.pop(uid, None)
+                    else:
+                        self._persisted[uid] = v[0]
+        if now - self._last_purge >= self._PURGE_EVERY:
+            self._last_purge = now
+            try:
+                self._backend.purge_idle(now - self.idle_ttl)
+            except Exception as e:
+                logging.exception("session purge failed: %s", e)
+
+    def start(self):
+        """يحجز ملكية المخزن، ويشغّل خيط الكتابة المؤجلة ويضمن تفريغ ما تبقى عند الخروج."""
+        if self._thread:
+            return
+        self._acquire_owner()
+        self._thread = threading.Thread(target=self._run, name="session-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+    def _acquire_owner(self):
+        # القفل يُحرَّر تلقائياً عند انتهاء العملية (حتى لو انهارت)، فلا ملف قفل عالق
+        if not self.owner_lock or fcntl is None:
+            return
+        fd = open(self.owner_lock, "a")
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fd.close()
+            raise RuntimeError(f"session store {self.owner_lock} is owned by another process; "
+                               "run a single bot process (one gunicorn worker in webhook mode)")
+        self._owner_fd = fd
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.exception("session flusher error: %s", e)
+
+user_states = SessionStore(
+    SqliteSessionBackend() if SESSION_BACKEND == "sqlite" else MemorySessionBackend(),
+    SESSION_MAX_ACTIVE, SESSION_IDLE_TTL, SESSION_FLUSH_SECS,
+    owner_lock=DB_FILE + ".owner.lock" if SESSION_BACKEND == "sqlite" else None,
+)
 
 # ثابتات واجهة
 MAIN_MENU_BUTTONS = ["📤 بيع حساب", "📥 شراء حساب", "👤 حساباتي", "📄 شروط الخدمة", "☎️ تواصل مع الدعم"]
@@ -89,15 +544,6 @@ def now_utc_str() -> str:
 def today_ymd() -> str:
     return datetime.utcnow().strftime("%Y%m%d")
 
-def backup_db_copy(suffix: Optional[str] = None) -> str:
-    """ينسخ DB إلى ملف .bak.timestamp لحماية البيانات."""
-    if not os.path.exists(DB_FILE):
-        return ""
-    ts = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
-    name = f"{DB_FILE}.bak.{suffix or ts}"
-    shutil.copyfile(DB_FILE, name)
-    return name
-
 def dict_get(d, k, default=None):
     return d[k] if (d and k in d) else default
 
@@ -164,17 +610,172 @@ def parse_payment_selection(text: str) -> Optional[str]:
         return "Tonkeeper"
     return None
 
+# ===========[ السعر: مبلغ رقمي + عملة (للفرز والتصفية داخل SQL) ]===========
+# العملة عند غيابها من النص (مثال: "25" فقط)
+PRICE_DEFAULT_CURRENCY = os.getenv("PRICE_DEFAULT_CURRENCY", "USD").upper()
+
+# الأطول أولاً حتى لا تطابق "usd" داخل "usdt"
+CURRENCY_ALIASES = sorted({
+    "usdt": "USDT", "تيذر": "USDT", "تيثر": "USDT",
+    "usd": "USD", "$": "USD", "دولار": "USD",
+    "syp": "SYP", "s.p": "SYP", "sp": "SYP", "ل.س": "SYP", "ل س": "SYP", "ليرة": "SYP", "ليره": "SYP",
+}.items(), key=lambda kv: -len(kv[0]))
+
+_DIGITS_TABLE = str.maketrans("٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹٫٬", "01234567890123456789.,")
+_PRICE_NUM_RE = re.compile(r"\d+(?:[.,]\d+)*")
+_THOUSANDS_RE = re.compile(r"\d{1,3}(?:,\d{3})+(?:\.\d+)?")    # 1,000 / 12,500.5
+_DOT_THOUSANDS_RE = re.compile(r"\d{1,3}(?:\.\d{3}){2,}")        # 1.000.000
+
+def parse_price(text: str) -> Optional[Tuple[float, str]]:
+    """
+    "25 USDT" / "1,000 SYP" / "٥٠ ألف ليرة" / "$9.5" -> (المبلغ، رمز العملة).
+    يعيد None إن لم يوجد رقم صالح.
+    """
+    t = (text or "").translate(_DIGITS_TABLE).lower()
+    m = _PRICE_NUM_RE.search(t)
+    if not m:
+        return None
+    num = m.group(0)
+    if _THOUSANDS_RE.fullmatch(num):
+        num = num.replace(",", "")
+    elif _DOT_THOUSANDS_RE.fullmatch(num):
+        num = num.replace(".", "")
+    else:
+        num = num.replace(",", ".")
+    try:
+        amount = float(num)
+    except ValueError:
+        return None
+    rest = t[m.end():]
+    if re.match(r"\s*(?:k\b|ألف|الف)", rest):
+        amount *= 1000
+    currency = next((code for alias, code in CURRENCY_ALIASES if alias in t), PRICE_DEFAULT_CURRENCY)
+    return amount, currency
+
+def format_amount(amount: float) -> str:
+    return f"{amount:,.2f}".rstrip("0").rstrip(".")
+
 # =========================[ قاعدة البيانات ]=========================
-def db_conn():
-    conn = sqlite3.connect(DB_FILE)
+# اتصال واحد لكل خيط يُفتح مرة واحدة ويُعاد استخدامه بدلاً من فتح/إغلاق اتصال في كل دالة.
+# وضع WAL يسمح للقرّاء بالعمل أثناء الكتابة، والـ pragmas تُضبط عند فتح كل اتصال.
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_SYNCHRONOUS     = os.getenv("DB_SYNCHRONOUS", "NORMAL").strip().upper()
+DB_CACHE_SIZE_KB   = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE       = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+
+_db_local = threading.local()
+_db_all_conns: List[sqlite3.Connection] = []
+_db_all_lock = threading.Lock()
+
+def _open_db_conn() -> sqlite3.Connection:
+    # isolation_level=None: نتحكم بالمعاملات صراحةً عبر db_write()
+    conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT_MS / 1000,
+                           isolation_level=None, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
     return conn
 
-def migrate_db():
-    """إنشاء الجداول إن لم توجد + إضافة الأعمدة الناقصة بهدوء + إنشاء فهارس."""
-    conn = db_conn()
-    c = conn.cursor()
+def db_conn() -> sqlite3.Connection:
+    """يعيد اتصال الخيط الحالي (يُفتح عند أول استخدام فقط)."""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = _open_db_conn()
+        _db_local.conn = conn
+        _db_local.depth = 0
+        with _db_all_lock:
+            _db_all_conns.append(conn)
+    return conn
+
+@contextmanager
+def db_read():
+    """مؤشر قراءة على اتصال الخيط الحالي (بدون معاملة صريحة)."""
+    cur = db_conn().cursor()
+    try:
+        yield cur
+    finally:
+        cur.close()
 
+@contextmanager
+def db_write():
+    """معاملة كتابة BEGIN IMMEDIATE … COMMIT؛ الاستدعاء المتداخل ينضم للمعاملة الخارجية."""
+    conn = db_conn()
+    outer = _db_local.depth == 0
+    if outer:
+        conn.execute("BEGIN IMMEDIATE")
+    _db_local.depth += 1
+    cur = conn.cursor()
+    try:
+        yield cur
+    except BaseException:
+        _db_local.depth -= 1
+        if outer:
+            conn.execute("ROLLBACK")
+        raise
+    else:
+        _db_local.depth -= 1
+        if outer:
+            conn.execute("COMMIT")
+    finally:
+        cur.close()
+
+def init_db():
+    """يُستدعى مرة واحدة عند الإقلاع: تفعيل WAL (إعداد دائم في الملف) وإغلاق الاتصالات عند الخروج."""
+    mode = db_conn().execute("PRAGMA journal_mode = WAL").fetchone()[0]
+    if str(mode).lower() != "wal":
+        logging.warning("SQLite journal_mode is %s (WAL not available)", mode)
+    atexit.register(close_db_connections)
+
+def close_db_connections():
+    with _db_all_lock:
+        conns = list(_db_all_conns)
+        _db_all_conns.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            pass
+    _db_local.__dict__.clear()
+
+# ======================[ هجرة المخطط (user_version) ]======================
+# كل خطوة في MIGRATIONS تنقل المخطط نسخة واحدة للأمام، ورقم النسخة يُحفظ في PRAGMA user_version
+# (ترويسة ملف القاعدة). عند التطابق لا يُنفَّذ شيء سوى قراءة هذا الرقم.
+# لا تعدّل خطوة صدرت: أضف خطوة جديدة في آخر القائمة. الخطوات تبقى idempotent لأن القواعد
+# السابقة لنظام النسخ (user_version = 0) قد تحتوي بعض ما تنشئه.
+
+def schema_version(c: sqlite3.Cursor) -> int:
+    c.execute("PRAGMA user_version")
+    return c.fetchone()[0]
+
+def migrate_db() -> Tuple[int, int]:
+    """يطبّق خطوات الهجرة الناقصة داخل معاملة واحدة؛ يعيد (النسخة قبل، النسخة بعد)."""
+    with db_read() as c:
+        current = schema_version(c)
+    if current >= SCHEMA_VERSION:
+        if current > SCHEMA_VERSION:
+            logging.warning("Database schema v%d is newer than this code (v%d)", current, SCHEMA_VERSION)
+        return current, current
+    with db_write() as c:
+        start = current = schema_version(c)   # عملية أخرى ربما هاجرت قبلنا
+        for version in range(current + 1, SCHEMA_VERSION + 1):
+            MIGRATIONS[version - 1](c)
+            c.execute(f"PRAGMA user_version = {version}")
+    logging.info("Database schema migrated v%d -> v%d", start, SCHEMA_VERSION)
+    return start, SCHEMA_VERSION
+
+def _ensure_column(c: sqlite3.Cursor, table: str, column: str, coltype: str) -> bool:
+    """يضيف العمود إن لم يوجد؛ يعيد True إن أُضيف الآن."""
+    c.execute(f"PRAGMA table_info({table})")
+    if column in [r["name"] for r in c.fetchall()]:
+        return False
+    c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {coltype}")
+    return True
+
+def _migration_baseline(c: sqlite3.Cursor):
+    """v1: الجداول الأساسية والأعمدة المضافة قديماً وفهرس البحث النصي."""
     # sequences: عدادات دائمة
     c.execute("""
         CREATE TABLE IF NOT EXISTS sequences (
@@ -242,199 +843,1729 @@ def migrate_db():
         )
     """)
 
+    # user_sessions: حالات المحادثة الجارية (تُكتب بشكل مؤجل من SessionStore)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            telegram_id INTEGER PRIMARY KEY,
+            state_json TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
     # أعمدة قديمة: تأكد من وجود seller_contact و buyer_contact و seq و tracking_code و ...
-    def ensure_column(table: str, column: str, coltype: str):
-        c.execute(f"PRAGMA table_info({table})")
-        cols = [r["name"] for r in c.fetchall()]
-        if column not in cols:
-            c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {coltype}")
-
-    ensure_column("listings", "seq", "INTEGER")
-    ensure_column("listings", "tracking_code", "TEXT")
-    ensure_column("listings", "seller_contact", "TEXT")
-    ensure_column("orders",   "seq", "INTEGER")
-    ensure_column("orders",   "tracking_code", "TEXT")
-    ensure_column("orders",   "buyer_contact", "TEXT")
+    _ensure_column(c, "listings", "seq", "INTEGER")
+    _ensure_column(c, "listings", "tracking_code", "TEXT")
+    _ensure_column(c, "listings", "seller_contact", "TEXT")
+    _ensure_column(c, "orders",   "seq", "INTEGER")
+    _ensure_column(c, "orders",   "tracking_code", "TEXT")
+    _ensure_column(c, "orders",   "buyer_contact", "TEXT")
 
     # فهارس مفيدة
     c.execute("CREATE INDEX IF NOT EXISTS idx_listings_status ON listings(status)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_listings_cat_sub ON listings(category, subcategory)")
     c.execute("CREATE INDEX IF NOT EXISTS idx_orders_status ON orders(status)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_updated ON user_sessions(updated_at)")
 
-    conn.commit()
-    conn.close()
+    _migrate_fts(c)
+
+def _migration_structured_price(c: sqlite3.Cursor):
+    """v3: السعر كمبلغ رقمي + عملة، مع ملء الإعلانات الموجودة من نص السعر."""
+    _ensure_column(c, "listings", "price_amount", "REAL")
+    _ensure_column(c, "listings", "price_currency", "TEXT")
+    _backfill_price_amounts(c)
+    # فرز/تصفية التصفح بالسعر: جزئي على النشطة فقط، و id (rowid) ضمنياً في آخر الفهرس لترقيم keyset
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_listings_price
+        ON listings(category, subcategory, price_currency, price_amount) WHERE status='active'
+    """)
+
+def _migration_hot_indexes(c: sqlite3.Cursor):
+    """v4: فهرس يطابق كل استعلام ساخن (تحقق: python benchmarks/query_plans.py)."""
+    # /findlist و /findorder وخطوات بحث الإدمن
+    c.execute("CREATE INDEX IF NOT EXISTS idx_listings_seq ON listings(seq)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_seq ON orders(seq)")
+    # تصفح الفئة: النشطة فقط، والترتيب بـ id (rowid في آخر الفهرس) بلا فرز بعد التصفية
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_listings_active_cat_sub
+        ON listings(category, subcategory) WHERE status='active'
+    """)
+    # "👤 حساباتي": فهارس مغطّية — id ثانياً للترتيب ثم أعمدة العرض فلا يُقرأ الجدول
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_listings_seller
+        ON listings(seller_telegram_id, id, seq, tracking_code, category, subcategory, price, status)
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_orders_buyer
+        ON orders(buyer_telegram_id, id, seq, tracking_code, listing_id, payment_method, status)
+    """)
+    # قراءة طرق الإعلان بترتيب اختيار البائع دون فرز
+    c.execute("CREATE INDEX IF NOT EXISTS idx_listing_pm_position ON listing_payment_methods(listing_id, position)")
+
+def _stat_bump(name: str, key: str, n: str = "1", amount: str = "0", where: str = "1") -> str:
+    """جملة upsert لعدّاد واحد في stats_counters (تُستخدم داخل الـ triggers)."""
+    return f"""
+            INSERT INTO stats_counters (name, key, n, amount)
+            SELECT '{name}', COALESCE({key}, ''), {n}, COALESCE({amount}, 0) WHERE {where}
+            ON CONFLICT (name, key) DO UPDATE SET n = n + excluded.n, amount = amount + excluded.amount;"""
+
+# سعر الإعلان المطلوب وعملته وقت إنشاء الطلب (بحث بالمفتاح الأساسي)
+_ORDER_AMOUNT = "(SELECT price_amount FROM listings WHERE id = new.listing_id)"
+_ORDER_VOLUME_KEY = ("substr(new.created_at, 1, 10) || ' ' || "
+                     "(SELECT price_currency FROM listings WHERE id = new.listing_id)")
+
+def _migration_stats_counters(c: sqlite3.Cursor):
+    """
+    v5: عدّادات لوحة الإحصائيات تحدّثها triggers عند الإدراج وتغيّر الحالة والحذف،
+    فتقرأ /stats صفوفاً قليلة بالمفتاح بدل تجميع جداول listings/orders كاملة.
+      listings/<status>      عدد الإعلانات بكل حالة
+      supply/<cat>/<sub>     الإعلانات النشطة لكل فئة/منصة
+      orders/<status>        عدد الطلبات بكل حالة
+      orders_by_method/<m>   الطلبات لكل طريقة دفع
+      orders_daily/<date>    عدد الطلبات يومياً
+      volume_daily/<date cur> مجموع أسعار الإعلانات المطلوبة يومياً لكل عملة
+      users/total            المستخدمون المسجّلون
+    """
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            n INTEGER NOT NULL DEFAULT 0,
+            amount REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+    """)
+    supply_old = "old.category || '/' || old.subcategory"
+    supply_new = "new.category || '/' || new.subcategory"
+    triggers = {
+        "stats_listings_ai": ("AFTER INSERT ON listings", [
+            _stat_bump("listings", "new.status"),
+            _stat_bump("supply", supply_new, where="new.status = 'active'"),
+        ]),
+        "stats_listings_au": (
+            "AFTER UPDATE OF status, category, subcategory ON listings "
+            "WHEN old.status IS NOT new.status OR old.category IS NOT new.category "
+            "OR old.subcategory IS NOT new.subcategory", [
+            _stat_bump("listings", "old.status", n="-1", where="old.status IS NOT new.status"),
+            _stat_bump("listings", "new.status", where="old.status IS NOT new.status"),
+            _stat_bump("supply", supply_old, n="-1", where="old.status = 'active'"),
+            _stat_bump("supply", supply_new, where="new.status = 'active'"),
+        ]),
+        "stats_listings_ad": ("AFTER DELETE ON listings", [
+            _stat_bump("listings", "old.status", n="-1"),
+            _stat_bump("supply", supply_old, n="-1", where="old.status = 'active'"),
+        ]),
+        "stats_orders_ai": ("AFTER INSERT ON orders", [
+            _stat_bump("orders", "new.status"),
+            _stat_bump("orders_by_method", "new.payment_method"),
+            _stat_bump("orders_daily", "substr(new.created_at, 1, 10)"),
+            _stat_bump("volume_daily", _ORDER_VOLUME_KEY, amount=_ORDER_AMOUNT,
+                       where=f"{_ORDER_AMOUNT} IS NOT NULL"),
+        ]),
+        "stats_orders_au": ("AFTER UPDATE OF status ON orders WHEN old.status IS NOT new.status", [
+            _stat_bump("orders", "old.status", n="-1"),
+            _stat_bump("orders", "new.status"),
+        ]),
+        "stats_orders_ad": ("AFTER DELETE ON orders", [
+            _stat_bump("orders", "old.status", n="-1"),
+        ]),
+        "stats_users_ai": ("AFTER INSERT ON users", [
+            _stat_bump("users", "'total'"),
+        ]),
+    }
+    for name, (event, body) in triggers.items():
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN{''.join(body)}\n        END")
+    _rebuild_stats(c)
+
+def _rebuild_stats(c: sqlite3.Cursor):
+    """يعيد حساب كل العدّادات من الجداول (مرة عند الترحيل فقط؛ بعدها تتكفّل الـ triggers)."""
+    c.execute("DELETE FROM stats_counters")
+    c.execute("""
+        INSERT INTO stats_counters (name, key, n)
+        SELECT 'listings', COALESCE(status, ''), COUNT(*) FROM listings GROUP BY 2
+        UNION ALL
+        SELECT 'supply', COALESCE(category || '/' || subcategory, ''), COUNT(*) FROM listings
+        WHERE status = 'active' GROUP BY 2
+        UNION ALL
+        SELECT 'orders', COALESCE(status, ''), COUNT(*) FROM orders GROUP BY 2
+        UNION ALL
+        SELECT 'orders_by_method', COALESCE(payment_method, ''), COUNT(*) FROM orders GROUP BY 2
+        UNION ALL
+        SELECT 'orders_daily', COALESCE(substr(created_at, 1, 10), ''), COUNT(*) FROM orders GROUP BY 2
+        UNION ALL
+        SELECT 'users', 'total', COUNT(*) FROM users
+    """)
+    c.execute("""
+        INSERT INTO stats_counters (name, key, n, amount)
+        SELECT 'volume_daily', substr(o.created_at, 1, 10) || ' ' || l.price_currency, COUNT(*), SUM(l.price_amount)
+        FROM orders o JOIN listings l ON l.id = o.listing_id
+        WHERE l.price_amount IS NOT NULL AND o.created_at IS NOT NULL
+        GROUP BY 2
+    """)
+
+def _backfill_price_amounts(c: sqlite3.Cursor):
+    """يملأ price_amount / price_currency للإعلانات التي لم يُحلَّل سعرها بعد."""
+    c.execute("SELECT id, price FROM listings WHERE price IS NOT NULL AND price_amount IS NULL")
+    updates = []
+    for r in c.fetchall():
+        parsed = parse_price(r["price"])
+        if parsed:
+            updates.append((parsed[0], parsed[1], r["id"]))
+    c.executemany("UPDATE listings SET price_amount=?, price_currency=? WHERE id=?", updates)
+    if updates:
+        logging.info("Backfilled structured price for %d listings", len(updates))
+
+def _migration_listing_children(c: sqlite3.Cursor):
+    """
+    v2: صور الإعلان وطرق الدفع في جداول فرعية مفهرسة بدل أعمدة JSON في listings
+    (يُمكّن تصفية "العروض التي تقبل طريقة كذا" داخل SQL دون فك JSON لكل صف).
+    تُنقل البيانات من images_json / payment_methods_json / payment_details_json؛
+    الأعمدة القديمة تبقى للتوافق لكن لم تعد تُقرأ أو تُكتب.
+    """
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS listing_images (
+            listing_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            PRIMARY KEY (listing_id, position)
+        ) WITHOUT ROWID
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS listing_payment_methods (
+            listing_id INTEGER NOT NULL,
+            method TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            details TEXT,
+            PRIMARY KEY (listing_id, method)
+        ) WITHOUT ROWID
+    """)
+    # للبحث من جهة الطريقة: "كل العروض التي تقبل X" مرتبة بالأحدث
+    c.execute("CREATE INDEX IF NOT EXISTS idx_listing_pm_method ON listing_payment_methods(method, listing_id)")
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_children_ad AFTER DELETE ON listings BEGIN
+            DELETE FROM listing_images WHERE listing_id = old.id;
+            DELETE FROM listing_payment_methods WHERE listing_id = old.id;
+        END
+    """)
+    c.execute("""
+        INSERT OR IGNORE INTO listing_images (listing_id, position, file_id)
+        SELECT l.id, j.key, j.value
+        FROM listings l, json_each(l.images_json) j
+        WHERE json_valid(l.images_json) AND json_type(l.images_json) = 'array' AND j.type = 'text'
+    """)
+    # إعلانات قديمة خزّنت المفتاح "Trust Wallet" بمسافة؛ المفتاح الحالي "TrustWallet"
+    c.execute("""
+        INSERT OR IGNORE INTO listing_payment_methods (listing_id, method, position, details)
+        SELECT l.id, REPLACE(j.value, ' ', ''), j.key,
+               CASE WHEN json_valid(l.payment_details_json)
+                    THEN json_extract(l.payment_details_json, '$."' || j.value || '"') END
+        FROM listings l, json_each(l.payment_methods_json) j
+        WHERE json_valid(l.payment_methods_json) AND json_type(l.payment_methods_json) = 'array' AND j.type = 'text'
+    """)
+    c.execute("SELECT (SELECT COUNT(*) FROM listing_images), (SELECT COUNT(*) FROM listing_payment_methods)")
+    n_images, n_methods = c.fetchone()
+    if n_images or n_methods:
+        logging.info("Migrated listing JSON columns: %d images, %d payment methods", n_images, n_methods)
+
+def _migrate_fts(c: sqlite3.Cursor):
+    """فهرس بحث نصي FTS5 على الوصف/الفئة/المنصة تحدّثه triggers؛ يُتجاوز بهدوء إن لم يتوفر FTS5."""
+    global _fts_available
+    c.execute("SELECT 1 FROM sqlite_master WHERE name='listings_fts'")
+    existed = c.fetchone() is not None
+    try:
+        c.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5(
+                description, category, subcategory,
+                content='listings', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logging.warning("FTS5 not available, /search falls back to LIKE: %s", e)
+        _fts_available = False
+        return
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_fts_ai AFTER INSERT ON listings BEGIN
+            INSERT INTO listings_fts(rowid, description, category, subcategory)
+            VALUES (new.id, new.description, new.category, new.subcategory);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_fts_ad AFTER DELETE ON listings BEGIN
+            INSERT INTO listings_fts(listings_fts, rowid, description, category, subcategory)
+            VALUES ('delete', old.id, old.description, old.category, old.subcategory);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS listings_fts_au AFTER UPDATE OF description, category, subcategory ON listings BEGIN
+            INSERT INTO listings_fts(listings_fts, rowid, description, category, subcategory)
+            VALUES ('delete', old.id, old.description, old.category, old.subcategory);
+            INSERT INTO listings_fts(rowid, description, category, subcategory)
+            VALUES (new.id, new.description, new.category, new.subcategory);
+        END
+    """)
+    if not existed:
+        # فهرسة العروض الموجودة قبل إنشاء الجدول
+        c.execute("INSERT INTO listings_fts(listings_fts) VALUES ('rebuild')")
+    _fts_available = True
+
+MIGRATIONS: List[Callable[[sqlite3.Cursor], None]] = [
+    _migration_baseline,            # v1
+    _migration_listing_children,    # v2
+    _migration_structured_price,    # v3
+    _migration_hot_indexes,         # v4
+    _migration_stats_counters,      # v5
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# عدد الأرقام التي تُحجز دفعة واحدة من جدول sequences (1 = بدون حجز مسبق).
+# مع قيمة أكبر من 1 قد تظهر فجوات في التسلسل بعد إعادة التشغيل (الأرقام المحجوزة غير المستخدمة تضيع).
+SEQ_BLOCK_SIZE = int(os.getenv("SEQ_BLOCK_SIZE", "1"))
+
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+def _bump_seq(c: sqlite3.Cursor, name: str, n: int = 1) -> int:
+    """يزيد العداد بمقدار n داخل معاملة الكتابة الحالية ويعيد القيمة الجديدة."""
+    c.execute("UPDATE sequences SET value = value + ? WHERE name = ?", (n, name))
+    if c.rowcount == 0:
+        c.execute("INSERT INTO sequences (name, value) VALUES (?, ?)", (name, n))
+        return n
+    c.execute("SELECT value FROM sequences WHERE name = ?", (name,))
+    return c.fetchone()["value"]
 
 def get_next_seq(name: str) -> int:
     """يزيد عداد sequences بالاسم المحدد ويعيد القيمة الجديدة."""
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("BEGIN IMMEDIATE")
-    c.execute("SELECT value FROM sequences WHERE name = ?", (name,))
-    row = c.fetchone()
-    if row is None:
-        value = 1
-        c.execute("INSERT INTO sequences (name, value) VALUES (?, ?)", (name, value))
-    else:
-        value = row["value"] + 1
-        c.execute("UPDATE sequences SET value = ? WHERE name = ?", (value, name))
-    conn.commit()
-    conn.close()
-    return value
+    with db_write() as c:
+        return _bump_seq(c, name)
+
+class SeqAllocator:
+    """
+    يحجز كتلاً من أرقام التسلسل في الذاكرة حتى لا تتسلسل كل عملية إنشاء على صف العداد.
+    take() تُستدعى قبل فتح معاملة الإنشاء؛ تعيد None عند تعطيل الحجز (block_size=1)
+    وعندها يُزاد العداد داخل معاملة الإنشاء نفسها.
+    """
+    def __init__(self, block_size: int):
+        self.block_size = max(1, block_size)
+        self._lock = threading.Lock()
+        self._blocks: Dict[str, List[int]] = {}  # name -> [التالي, آخر رقم محجوز]
+
+    def take(self, name: str) -> Optional[int]:
+        if self.block_size == 1:
+            return None
+        with self._lock:
+            block = self._blocks.get(name)
+            if not block or block[0] > block[1]:
+                with db_write() as c:
+                    last = _bump_seq(c, name, self.block_size)
+                block = [last - self.block_size + 1, last]
+                self._blocks[name] = block
+            value = block[0]
+            block[0] += 1
+            return value
+
+seq_allocator = SeqAllocator(SEQ_BLOCK_SIZE)
+
+def _insert_returning(c: sqlite3.Cursor, table: str, sql: str, params: tuple) -> sqlite3.Row:
+    """INSERT يعيد الصف المُدرج ضمن نفس المعاملة (RETURNING إن توفر، وإلا lastrowid)."""
+    if _HAS_RETURNING:
+        c.execute(sql + " RETURNING *", params)
+        return c.fetchall()[0]
+    c.execute(sql, params)
+    c.execute(f"SELECT * FROM {table} WHERE id = ?", (c.lastrowid,))
+    return c.fetchone()
 
 def make_tracking(prefix: str, seq: int) -> str:
     # مثال: 010-S20250814
     return f"{seq:03d}-{prefix}{today_ymd()}"
 
+# =====================[ الكتابة المؤجلة (group commit) ]=====================
+# إدراجات غير حرجة (تذاكر الدعم، تسجيل المستخدمين، ...) تُوضع في طابور ويكتبها خيط واحد دفعات
+# داخل معاملة واحدة: كل WRITE_BEHIND_BATCH صف أو بعد WRITE_BEHIND_MS من أول صف في الدفعة.
+# فلا يدفع المعالج ثمن fsync لكل تذكرة. الكتابات الحرجة (create_order, create_listing) تبقى متزامنة.
+WRITE_BEHIND_BATCH = int(os.getenv("WRITE_BEHIND_BATCH", "200"))
+WRITE_BEHIND_MS    = float(os.getenv("WRITE_BEHIND_MS", "50"))
+WRITE_BEHIND_MAX   = int(os.getenv("WRITE_BEHIND_MAX", "10000"))   # عند الامتلاء ينتظر المُرسِل (ضغط عكسي)
+
+class WriteBehind:
+    """
+    submit(sql, params) لا ينتظر الكتابة. الصفوف المتتالية بنفس الجملة تُكتب بـ executemany،
+    والترتيب محفوظ. إن فشلت دفعة تُعاد صفوفها فرادى حتى لا يُفقد الكل بسبب صف واحد.
+    on_done(ok) اختياري: يُستدعى من خيط الكاتب بعد commit الصف (True) أو فشله نهائياً (False).
+    قبل start() يُكتب كل صف فوراً في خيط المستدعي.
+    """
+    def __init__(self, batch: int, max_delay_ms: float, queue_max: int):
+        self.batch = max(1, batch)
+        self.max_delay = max_delay_ms / 1000.0
+        self.queue_max = max(1, queue_max)
+        self._cond = threading.Condition()
+        self._queue: deque = deque()
+        self._writing = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stop = False
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+
+    def submit(self, sql: str, params: tuple, on_done: Optional[Callable[[bool], None]] = None):
+        if not self._thread:
+            self._write([(sql, params, on_done)])
+            return
+        with self._cond:
+            while len(self._queue) >= self.queue_max:
+                self._cond.wait()
+            self._queue.append((sql, params, on_done))
+            self._cond.notify_all()
+
+    def depth(self) -> int:
+        return len(self._queue) + self._writing
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": self.depth(), "written": self.written, "batches": self.batches, "failed": self.failed}
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """ينتظر كتابة كل ما في الطابور."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._queue or self._writing:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._cond.wait(left)
+        return True
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def close(self, timeout: float = 10):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self.join(timeout)
+
+    def _next_batch(self) -> List[Tuple[str, tuple, Optional[Callable[[bool], None]]]]:
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            # ننتظر امتلاء الدفعة أو انقضاء المهلة من أول صف (أو الإيقاف)
+            deadline = time.monotonic() + self.max_delay
+            while len(self._queue) < self.batch and not self._stop:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            n = min(self.batch, len(self._queue))
+            items = [self._queue.popleft() for _ in range(n)]
+            self._writing = n
+            self._cond.notify_all()
+            return items
+
+    def _run(self):
+        while True:
+            items = self._next_batch()
+            try:
+                self._write(items)
+            finally:
+                with self._cond:
+                    self._writing = 0
+                    self._cond.notify_all()
+
+    @db_timed("write_behind_batch")
+    def _commit(self, items: List[Tuple[str, tuple, Any]]):
+        with db_write() as c:
+            i = 0
+            while i < len(items):
+                sql, j = items[i][0], i
+                while j < len(items) and items[j][0] == sql:
+                    j += 1
+                c.executemany(sql, [item[1] for item in items[i:j]])
+                i = j
+
+    def _write(self, items: List[Tuple[str, tuple, Any]]):
+        try:
+            self._commit(items)
+            self.written += len(items)
+            self.batches += 1
+            self._done(items, True)
+            return
+        except Exception as e:
+            if len(items) == 1:
+                self.failed += 1
+                logging.exception("write-behind row failed: %s", e)
+                self._done(items, False)
+                return
+            logging.warning("write-behind batch of %d failed (%s); retrying rows one by one", len(items), e)
+        for item in items:
+            self._write([item])
+
+    @staticmethod
+    def _done(items: List[Tuple[str, tuple, Any]], ok: bool):
+        for _, _, on_done in items:
+            if on_done is None:
+                continue
+            try:
+                on_done(ok)
+            except Exception as e:
+                logging.exception("write-behind callback failed: %s", e)
+
+write_behind = WriteBehind(WRITE_BEHIND_BATCH, WRITE_BEHIND_MS, WRITE_BEHIND_MAX)
+metrics.gauge("amanex_write_behind_depth", "Non-critical inserts waiting for the group-commit writer.",
+              lambda: write_behind.depth())
+
+# =====================[ المستخدمون المعروفون (كاش + upsert) ]=====================
+# ensure_user يُستدعى مع /start وكل زر رئيسي؛ المستخدم المعروف بنفس الاسم لا يلمس القاعدة،
+# والجديد يُرسل فوراً كـ upsert واحد إلى الكاتب المؤجل، وتغيّر username/الاسم يُجمَع ويُرسل دفعة
+# كل USER_PROFILE_FLUSH_SECS. المستخدم يُعتبر معروفاً فقط بعد commit صفّه.
+KNOWN_USERS_MAX         = int(os.getenv("KNOWN_USERS_MAX", "50000"))
+USER_PROFILE_FLUSH_SECS = float(os.getenv("USER_PROFILE_FLUSH_SECS", "30"))
+
+_USER_UPSERT_SQL = """
+    INSERT INTO users (telegram_id, username, full_name, joined_at) VALUES (?,?,?,?)
+    ON CONFLICT(telegram_id) DO UPDATE SET username=excluded.username, full_name=excluded.full_name
+    WHERE users.username IS NOT excluded.username OR users.full_name IS NOT excluded.full_name
+"""
+
+def _user_profile(u: telebot.types.User) -> Tuple[str, str]:
+    return u.username or "", (u.first_name or "") + ((" " + u.last_name) if u.last_name else "")
+
+def upsert_users(rows: List[Tuple[int, str, str]],
+                 on_done: Optional[Callable[[int, Tuple[str, str], bool], None]] = None):
+    """
+    (telegram_id, username, full_name) — إدراج الجديد وتحديث الاسم المتغيّر عبر الكاتب المؤجل.
+    on_done(uid, profile, ok) يُستدعى لكل صف بعد كتابته أو فشلها.
+    """
+    joined = now_utc_str()
+    for uid, username, full_name in rows:
+        done = (lambda ok, uid=uid, profile=(username, full_name): on_done(uid, profile, ok)) if on_done else None
+        write_behind.submit(_USER_UPSERT_SQL, (uid, username, full_name, joined), done)
+
+class KnownUsers:
+    """
+    مجموعة LRU محدودة بـ telegram_id المعروفين مع آخر (username, full_name) كُتب لكل منهم.
+    الإصابة بنفس الملف = لا شيء؛ الإخفاق = upsert يُرسل فوراً إلى الكاتب المؤجل، ولا يُضاف المستخدم
+    إلى المجموعة إلا بعد commit صفّه؛ تغيّر الملف = يُؤجَّل لدفعة flush (أو يُرسل فوراً إن لم يبدأ
+    خيط التفريغ، كما في الأدوات). إن فشلت كتابة صف يُحذف المستخدم من المجموعة فيُعاد في المرة التالية.
+    """
+    def __init__(self, max_size: int, flush_interval: float):
+        self.max_size = max(1, max_size)
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._known: "OrderedDict[int, Tuple[str, str]]" = OrderedDict()
+        self._dirty: Dict[int, Tuple[str, str]] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.hits = 0
+        self.misses = 0
+
+    def ensure(self, u: telebot.types.User):
+        profile = _user_profile(u)
+        with self._lock:
+            cached = self._known.get(u.id)
+            if cached is not None:
+                self._known.move_to_end(u.id)
+                self.hits += 1
+                if cached == profile:
+                    return
+                self._known[u.id] = profile
+                if self._thread:
+                    self._dirty[u.id] = profile
+                    return
+            else:
+                self.misses += 1
+        upsert_users([(u.id, *profile)], self._written)
+
+    def _written(self, uid: int, profile: Tuple[str, str], ok: bool):
+        with self._lock:
+            if not ok:
+                if self._known.get(uid) == profile:
+                    del self._known[uid]
+                return
+            self._known[uid] = profile
+            self._known.move_to_end(uid)
+            while len(self._known) > self.max_size:
+                self._known.popitem(last=False)
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if dirty:
+            upsert_users([(uid, *profile) for uid, profile in dirty.items()], self._written)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._known), "pending": len(self._dirty), "hits": self.hits, "misses": self.misses}
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name="user-profile-flusher", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.exception("user profile flush failed: %s", e)
+
+known_users = KnownUsers(KNOWN_USERS_MAX, USER_PROFILE_FLUSH_SECS)
+
 def save_user_if_not_exists(u: telebot.types.User):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("SELECT id FROM users WHERE telegram_id = ?", (u.id,))
-    if c.fetchone() is None:
-        c.execute(
-            "INSERT INTO users (telegram_id, username, full_name, joined_at) VALUES (?,?,?,?)",
-            (u.id, u.username or "", (u.first_name or "") + ((" " + u.last_name) if u.last_name else ""), now_utc_str())
-        )
-        conn.commit()
-    conn.close()
+    known_users.ensure(u)
+
+# =========================[ كاش القراءة ]============================
+# كاش داخل العملية للعروض النشطة (لكل فئة/منصة) وللعرض حسب id، يُبطَل بدقة عند الإنشاء وتغيير الحالة.
+# ملاحظة: مع عدة عمليات (gunicorn) لكل عملية كاشها، و TTL يحدّ من قِدم البيانات في العمليات الأخرى.
+LISTING_CACHE_TTL     = float(os.getenv("LISTING_CACHE_TTL", "30"))
+LISTING_CACHE_SIZE    = int(os.getenv("LISTING_CACHE_SIZE", "256"))     # عدد (فئة، منصة)
+LISTING_CACHE_ROWS    = int(os.getenv("LISTING_CACHE_ROWS", "200"))     # أحدث N عرض لكل (فئة، منصة)
+LISTING_ID_CACHE_SIZE = int(os.getenv("LISTING_ID_CACHE_SIZE", "2048"))
+
+_MISSING = object()
+
+class TTLCache:
+    """كاش LRU محدود الحجم مع انتهاء صلاحية وعدادات إصابة/إخفاق (آمن للخيوط)."""
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # يزيد مع كل إبطال؛ التحميل الذي بدأ قبل الإبطال لا يُخزَّن (قد يحمل لقطة قديمة)
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                if item[0] > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return item[1]
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, epoch: Optional[int] = None) -> bool:
+        with self._lock:
+            if epoch is not None and epoch != self._epoch:
+                return False
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+            return True
+
+    def get_or_load(self, key, loader):
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        epoch = self._epoch
+        value = loader()
+        if value is not None:
+            self.put(key, value, epoch)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._epoch += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._epoch += 1
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+_active_listings_cache = TTLCache(LISTING_CACHE_SIZE, LISTING_CACHE_TTL)   # (category, subcategory) -> (rows, complete)
+_listing_by_id_cache   = TTLCache(LISTING_ID_CACHE_SIZE, LISTING_CACHE_TTL)
+
+_CHILD_BATCH = 500   # حد المعاملات في IN (...) لكل استعلام
+
+def decode_listings(c: sqlite3.Cursor, rows: List[sqlite3.Row]) -> List[Dict[str, Any]]:
+    """
+    يحوّل صفوف الإعلانات إلى dicts ويُرفق images / payment_methods / payment_details
+    من الجداول الفرعية باستعلامين لكل دفعة (لا استعلام لكل صف).
+    """
+    out = [dict(r) for r in rows]
+    by_id: Dict[int, Dict[str, Any]] = {}
+    for d in out:
+        d["images"], d["payment_methods"], d["payment_details"] = [], [], {}
+        by_id[d["id"]] = d
+    ids = list(by_id)
+    for start in range(0, len(ids), _CHILD_BATCH):
+        part = ids[start:start + _CHILD_BATCH]
+        marks = ",".join("?" * len(part))
+        c.execute(f"""
+            SELECT listing_id, file_id FROM listing_images
+            WHERE listing_id IN ({marks}) ORDER BY listing_id, position
+        """, part)
+        for r in c.fetchall():
+            by_id[r["listing_id"]]["images"].append(r["file_id"])
+        c.execute(f"""
+            SELECT listing_id, method, details FROM listing_payment_methods
+            WHERE listing_id IN ({marks}) ORDER BY listing_id, position
+        """, part)
+        for r in c.fetchall():
+            d = by_id[r["listing_id"]]
+            d["payment_methods"].append(r["method"])
+            if r["details"] is not None:
+                d["payment_details"][r["method"]] = r["details"]
+    return out
+
+def decode_listing(c: sqlite3.Cursor, row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+    if row is None:
+        return None
+    return decode_listings(c, [row])[0]
+
+def invalidate_listing_caches(listing_id: int, category: str, subcategory: str):
+    _listing_by_id_cache.invalidate(listing_id)
+    _active_listings_cache.invalidate((category, subcategory))
 
 # ===============[ دوال التعامل مع البيانات (CRUD مُبسطة) ]=============
+@db_timed("create_listing")
 def create_listing(seller_id: int, category: str, subcategory: str, description: str,
                    images: List[str], price: str, pay_methods: List[str],
-                   pay_details: Dict[str, str], seller_contact: str, status: str="active") -> sqlite3.Row:
-    seq = get_next_seq("listings")
-    tracking = make_tracking("S", seq)
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO listings (seq, tracking_code, seller_telegram_id, category, subcategory, description,
-                              images_json, price, payment_methods_json, payment_details_json, seller_contact,
-                              status, created_at)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
-    """, (
-        seq, tracking, seller_id, category, subcategory, description,
-        json.dumps(images, ensure_ascii=False), price,
-        json.dumps(pay_methods, ensure_ascii=False),
-        json.dumps(pay_details, ensure_ascii=False),
-        seller_contact, status, now_utc_str()
-    ))
-    conn.commit()
-    c.execute("SELECT * FROM listings WHERE id = ?", (c.lastrowid,))
-    row = c.fetchone()
-    conn.close()
-    return row
-
-def get_active_listings_by_cat_sub(category: str, subcategory: str, limit: int=30) -> List[sqlite3.Row]:
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("""
-        SELECT * FROM listings
-        WHERE status='active' AND category=? AND subcategory=?
-        ORDER BY id DESC LIMIT ?
-    """, (category, subcategory, limit))
-    rows = c.fetchall()
-    conn.close()
-    return rows
-
-def get_listing_by_id(listing_id: int) -> Optional[sqlite3.Row]:
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("SELECT * FROM listings WHERE id=?", (listing_id,))
-    row = c.fetchone()
-    conn.close()
-    return row
-
-def get_listing_by_seq(seq: int) -> Optional[sqlite3.Row]:
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("SELECT * FROM listings WHERE seq=?", (seq,))
-    row = c.fetchone()
-    conn.close()
-    return row
+                   pay_details: Dict[str, str], seller_contact: str, status: str="active") -> Dict[str, Any]:
+    amount, currency = parse_price(price) or (None, None)
+    seq = seq_allocator.take("listings")
+    with db_write() as c:
+        if seq is None:
+            seq = _bump_seq(c, "listings")
+        tracking = make_tracking("S", seq)
+        row = _insert_returning(c, "listings", """
+            INSERT INTO listings (seq, tracking_code, seller_telegram_id, category, subcategory, description,
+                                  price, price_amount, price_currency, seller_contact, status, created_at)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?,?)
+        """, (
+            seq, tracking, seller_id, category, subcategory, description,
+            price, amount, currency, seller_contact, status, now_utc_str()
+        ))
+        listing_id = row["id"]
+        c.executemany("INSERT INTO listing_images (listing_id, position, file_id) VALUES (?,?,?)",
+                      [(listing_id, i, fid) for i, fid in enumerate(images)])
+        methods = list(dict.fromkeys(pay_methods))
+        c.executemany("INSERT INTO listing_payment_methods (listing_id, method, position, details) VALUES (?,?,?,?)",
+                      [(listing_id, m, i, pay_details.get(m)) for i, m in enumerate(methods)])
+    invalidate_listing_caches(listing_id, category, subcategory)
+    d = dict(row)
+    d["images"] = list(images)
+    d["payment_methods"] = methods
+    d["payment_details"] = {m: pay_details[m] for m in methods if m in pay_details}
+    return d
+
+# ترتيب صفحات التصفح: الاسم -> (أعمدة الترتيب، تنازلي؟). آخر عمود دائماً l.id حتى يكون المؤشر فريداً.
+BROWSE_SORTS = {
+    "new":   (("l.id",), True),
+    "price": (("l.price_currency", "l.price_amount", "l.id"), False),
+}
 
+@db_timed("load_active_listings")
+def _load_active_listings(category: str, subcategory: str, limit: int,
+                          before_id: Optional[int]=None, after_id: Optional[int]=None,
+                          pay_method: Optional[str]=None, sort: str="new",
+                          max_price: Optional[Tuple[float, str]]=None) -> List[Dict[str, Any]]:
+    """
+    ترقيم keyset بالمؤشر id في كلا الترتيبين: مع الفرز بالسعر يُقارَن (العملة، المبلغ، id) كقيمة صف
+    بقيم صف المؤشر نفسه، فيبقى الاستعلام نطاقاً على فهرس idx_listings_price.
+    """
+    cols, desc = BROWSE_SORTS[sort]
+    # التصفية بطريقة الدفع join على الجدول الفرعي (فهرس method, listing_id) بدل فك JSON في بايثون
+    src, args = "listings l", []
+    if pay_method:
+        src = "listing_payment_methods p JOIN listings l ON l.id = p.listing_id AND p.method = ?"
+        args = [pay_method]
+    where = ["l.status='active'", "l.category=?", "l.subcategory=?"]
+    args += [category, subcategory]
+    if sort == "price":
+        where.append("l.price_amount IS NOT NULL")
+    if max_price:
+        where += ["l.price_currency=?", "l.price_amount<=?"]
+        args += [max_price[1], max_price[0]]
+    backwards = after_id is not None   # الصفحة السابقة: نقرأ بعكس الترتيب ثم نقلب النتيجة
+    cursor = after_id if backwards else before_id
+    if cursor is not None:
+        op = "<" if desc != backwards else ">"
+        if len(cols) == 1:
+            where.append(f"l.id {op} ?")
+        else:
+            plain = ", ".join(col[2:] for col in cols)
+            where.append(f"({', '.join(cols)}) {op} (SELECT {plain} FROM listings WHERE id=?)")
+        args.append(cursor)
+    direction = "DESC" if desc != backwards else "ASC"
+    order = ", ".join(f"{col} {direction}" for col in cols)
+    with db_read() as c:
+        c.execute(f"""
+            SELECT l.* FROM {src}
+            WHERE {' AND '.join(where)}
+            ORDER BY {order} LIMIT ?
+        """, (*args, limit))
+        rows = c.fetchall()
+        return decode_listings(c, rows[::-1] if backwards else rows)
+
+def get_active_listings_by_cat_sub(category: str, subcategory: str, limit: int=30,
+                                   before_id: Optional[int]=None, after_id: Optional[int]=None,
+                                   pay_method: Optional[str]=None, sort: str="new",
+                                   max_price: Optional[Tuple[float, str]]=None) -> List[Dict[str, Any]]:
+    """
+    العروض النشطة من الأحدث للأقدم مع ترقيم keyset على id (بدون OFFSET):
+    before_id = الصفحة التالية (الأقدم)، after_id = الصفحة السابقة (الأحدث).
+    تُخدم من كاش أحدث LISTING_CACHE_ROWS عرض، وما يتجاوزه يُقرأ من DB مباشرة.
+    مع pay_method أو الفرز بالسعر أو max_price تُقرأ من DB مباشرة (التصفية والترتيب داخل SQL).
+    """
+    if pay_method or sort != "new" or max_price:
+        return _load_active_listings(category, subcategory, limit, before_id, after_id,
+                                     pay_method, sort, max_price)
+
+    def load():
+        rows = _load_active_listings(category, subcategory, LISTING_CACHE_ROWS + 1)
+        return rows[:LISTING_CACHE_ROWS], len(rows) <= LISTING_CACHE_ROWS
+
+    rows, complete = _active_listings_cache.get_or_load((category, subcategory), load)
+    if after_id is not None:
+        if complete or (rows and after_id >= rows[-1]["id"]):
+            return [r for r in rows if r["id"] > after_id][-limit:]
+    else:
+        older = [r for r in rows if before_id is None or r["id"] < before_id]
+        if complete or len(older) >= limit:
+            return older[:limit]
+    return _load_active_listings(category, subcategory, limit, before_id, after_id)
+
+_fts_available: Optional[bool] = None   # يُحدَّد في migrate_db (أو عند أول بحث)
+SEARCH_MAX_TERMS = 8
+
+def _fts_match_query(text: str) -> str:
+    """يحوّل نص المستخدم إلى استعلام MATCH آمن: كل كلمة بين علامتي تنصيص مع بحث بالبادئة."""
+    terms = re.findall(r"\w+", text)[:SEARCH_MAX_TERMS]
+    return " ".join(f'"{t}"*' for t in terms)
+
+@db_timed("search_listings")
+def search_active_listings(text: str, limit: int=10, offset: int=0, pay_method: Optional[str]=None,
+                           max_price: Optional[Tuple[float, str]]=None) -> List[Dict[str, Any]]:
+    """بحث نصي مرتّب (bm25) في العروض النشطة فقط؛ تطابق المنصة/الفئة أعلى وزناً من الوصف."""
+    global _fts_available
+    match = _fts_match_query(text)
+    if not match:
+        return []
+    filter_sql, filter_args = "", ()
+    if pay_method:
+        filter_sql = ("AND EXISTS (SELECT 1 FROM listing_payment_methods p"
+                   " WHERE p.listing_id = l.id AND p.method = ?)")
+        filter_args = (pay_method,)
+    if max_price:
+        filter_sql += " AND l.price_currency = ? AND l.price_amount <= ?"
+        filter_args += (max_price[1], max_price[0])
+    with db_read() as c:
+        if _fts_available is None:
+            c.execute("SELECT 1 FROM sqlite_master WHERE name='listings_fts'")
+            _fts_available = c.fetchone() is not None
+        if _fts_available:
+            c.execute(f"""
+                SELECT l.* FROM listings_fts f JOIN listings l ON l.id = f.rowid
+                WHERE listings_fts MATCH ? AND l.status='active' {filter_sql}
+                ORDER BY bm25(listings_fts, 1.0, 2.0, 4.0), l.id DESC
+                LIMIT ? OFFSET ?
+            """, (match, *filter_args, limit, offset))
+        else:
+            like = f"%{text.strip()}%"
+            c.execute(f"""
+                SELECT l.* FROM listings l
+                WHERE l.status='active' AND (l.description LIKE ? OR l.subcategory LIKE ? OR l.category LIKE ?)
+                {filter_sql}
+                ORDER BY l.id DESC LIMIT ? OFFSET ?
+            """, (like, like, like, *filter_args, limit, offset))
+        return decode_listings(c, c.fetchall())
+
+def get_listing_by_id(listing_id: int) -> Optional[Dict[str, Any]]:
+    @db_timed("get_listing_by_id")
+    def load():
+        with db_read() as c:
+            c.execute("SELECT * FROM listings WHERE id=?", (listing_id,))
+            return decode_listing(c, c.fetchone())
+    return _listing_by_id_cache.get_or_load(listing_id, load)
+
+@db_timed("get_listing_by_seq")
+def get_listing_by_seq(seq: int) -> Optional[Dict[str, Any]]:
+    with db_read() as c:
+        c.execute("SELECT * FROM listings WHERE seq=?", (seq,))
+        return decode_listing(c, c.fetchone())
+
+@db_timed("create_order")
 def create_order(listing_id: int, buyer_id: int, payment_method: str,
                  proof_file_id: str, buyer_contact: str, status: str="paid") -> sqlite3.Row:
-    seq = get_next_seq("orders")
-    tracking = make_tracking("B", seq)
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO orders (seq, tracking_code, listing_id, buyer_telegram_id, payment_method,
-                            payment_proof_file_id, buyer_contact, status, created_at)
-        VALUES (?,?,?,?,?,?,?,?,?)
-    """, (seq, tracking, listing_id, buyer_id, payment_method, proof_file_id,
-          buyer_contact, status, now_utc_str()))
-    conn.commit()
-    c.execute("SELECT * FROM orders WHERE id=?", (c.lastrowid,))
-    row = c.fetchone()
-    conn.close()
-    return row
-
+    seq = seq_allocator.take("orders")
+    with db_write() as c:
+        if seq is None:
+            seq = _bump_seq(c, "orders")
+        tracking = make_tracking("B", seq)
+        return _insert_returning(c, "orders", """
+            INSERT INTO orders (seq, tracking_code, listing_id, buyer_telegram_id, payment_method,
+                                payment_proof_file_id, buyer_contact, status, created_at)
+            VALUES (?,?,?,?,?,?,?,?,?)
+        """, (seq, tracking, listing_id, buyer_id, payment_method, proof_file_id,
+              buyer_contact, status, now_utc_str()))
+
+@db_timed("get_order_by_seq")
 def get_order_by_seq(seq: int) -> Optional[sqlite3.Row]:
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("SELECT * FROM orders WHERE seq=?", (seq,))
-    row = c.fetchone()
-    conn.close()
-    return row
+    with db_read() as c:
+        c.execute("SELECT * FROM orders WHERE seq=?", (seq,))
+        return c.fetchone()
 
+@db_timed("get_user_listings")
 def get_user_listings(uid: int) -> List[sqlite3.Row]:
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("""
-        SELECT seq, tracking_code, category, subcategory, price, status
-        FROM listings WHERE seller_telegram_id=? ORDER BY id DESC LIMIT 25
-    """, (uid,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
-
+    with db_read() as c:
+        c.execute("""
+            SELECT seq, tracking_code, category, subcategory, price, status
+            FROM listings WHERE seller_telegram_id=? ORDER BY id DESC LIMIT 25
+        """, (uid,))
+        return c.fetchall()
+
+@db_timed("get_user_orders")
 def get_user_orders(uid: int) -> List[sqlite3.Row]:
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("""
-        SELECT seq, tracking_code, listing_id, payment_method, status
-        FROM orders WHERE buyer_telegram_id=? ORDER BY id DESC LIMIT 25
-    """, (uid,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
-
+    with db_read() as c:
+        c.execute("""
+            SELECT seq, tracking_code, listing_id, payment_method, status
+            FROM orders WHERE buyer_telegram_id=? ORDER BY id DESC LIMIT 25
+        """, (uid,))
+        return c.fetchall()
+
+@db_timed("get_pending_listings")
+def get_pending_listings(limit: int=30) -> List[sqlite3.Row]:
+    with db_read() as c:
+        c.execute("""
+            SELECT id, seq, tracking_code, category, subcategory, price
+            FROM listings WHERE status='pending' ORDER BY id DESC LIMIT ?
+        """, (limit,))
+        return c.fetchall()
+
+@db_timed("get_paid_orders")
+def get_paid_orders(limit: int=30) -> List[sqlite3.Row]:
+    with db_read() as c:
+        c.execute("""
+            SELECT id, seq, tracking_code, listing_id, payment_method
+            FROM orders WHERE status='paid' ORDER BY id DESC LIMIT ?
+        """, (limit,))
+        return c.fetchall()
+
+# عدد الأيام التي تعرضها /stats من العدّادات اليومية
+STATS_DAYS = int(os.getenv("STATS_DAYS", "7"))
+_STATS_NAMES = ("listings", "supply", "orders", "orders_by_method", "users")
+
+@db_timed("get_stats")
+def get_stats(days: int = STATS_DAYS) -> Dict[str, Any]:
+    """
+    الإحصائيات من stats_counters (بحث بالمفتاح الأساسي، لا تجميع على orders/listings):
+    {"listings": {status: n}, "supply": {"cat/sub": n}, "orders": {status: n},
+     "orders_by_method": {method: n}, "users": {"total": n},
+     "daily": {date: {"orders": n, "volume": {currency: amount}}}}
+    """
+    since = (datetime.utcnow() - timedelta(days=max(1, days) - 1)).strftime("%Y-%m-%d")
+    stats: Dict[str, Any] = {name: {} for name in _STATS_NAMES}
+    daily: Dict[str, Dict[str, Any]] = {}
+    with db_read() as c:
+        c.execute(f"SELECT name, key, n FROM stats_counters WHERE name IN ({','.join('?' * len(_STATS_NAMES))})",
+                  _STATS_NAMES)
+        for r in c.fetchall():
+            if r["n"]:
+                stats[r["name"]][r["key"]] = r["n"]
+        c.execute("SELECT key, n FROM stats_counters WHERE name='orders_daily' AND key >= ?", (since,))
+        for r in c.fetchall():
+            daily.setdefault(r["key"], {"orders": 0, "volume": {}})["orders"] = r["n"]
+        c.execute("SELECT key, amount FROM stats_counters WHERE name='volume_daily' AND key >= ?", (since,))
+        for r in c.fetchall():
+            day, _, currency = r["key"].partition(" ")
+            daily.setdefault(day, {"orders": 0, "volume": {}})["volume"][currency] = r["amount"]
+    stats["daily"] = dict(sorted(daily.items(), reverse=True))
+    return stats
+
+@db_timed("update_listing_status")
 def update_listing_status(listing_id: int, status: str):
-    conn = db_conn()
-    c = conn.cursor()
-    c.execute("UPDATE listings SET status=? WHERE id=?", (status, listing_id))
-    conn.commit()
-    conn.close()
+    with db_write() as c:
+        c.execute("UPDATE listings SET status=? WHERE id=?", (status, listing_id))
+        c.execute("SELECT category, subcategory FROM listings WHERE id=?", (listing_id,))
+        row = c.fetchone()
+    if row:
+        invalidate_listing_caches(listing_id, row["category"], row["subcategory"])
+
+# حد عدد الإعلانات في أمر إدمن جماعي واحد (/approve 1-5000 مثلاً يُرفض بدل قفل القاعدة طويلاً)
+BULK_MAX = int(os.getenv("BULK_MAX", "1000"))
+
+@db_timed("get_pending_listing_ids")
+def get_pending_listing_ids(category: Optional[str] = None, limit: int = BULK_MAX) -> List[int]:
+    with db_read() as c:
+        if category:
+            c.execute("SELECT id FROM listings WHERE status='pending' AND category=? ORDER BY id LIMIT ?",
+                      (category, limit))
+        else:
+            c.execute("SELECT id FROM listings WHERE status='pending' ORDER BY id LIMIT ?", (limit,))
+        return [r["id"] for r in c.fetchall()]
+
+@db_timed("bulk_update_listing_status")
+def bulk_update_listing_status(listing_ids: List[int], status: str) -> List[sqlite3.Row]:
+    """
+    يغيّر حالة عدة إعلانات في معاملة واحدة (executemany) ويُرجع الصفوف التي تغيّرت فعلاً
+    (id, seq, tracking_code, seller_telegram_id, category, subcategory)؛ الغائبة أو التي بنفس الحالة تُتجاهل.
+    """
+    ids = sorted(set(listing_ids))
+    changed: List[sqlite3.Row] = []
+    with db_write() as c:
+        for start in range(0, len(ids), _CHILD_BATCH):
+            part = ids[start:start + _CHILD_BATCH]
+            c.execute(f"""
+                SELECT id, seq, tracking_code, seller_telegram_id, category, subcategory
+                FROM listings WHERE id IN ({','.join('?' * len(part))}) AND status IS NOT ?
+            """, (*part, status))
+            changed.extend(c.fetchall())
+        c.executemany("UPDATE listings SET status=? WHERE id=?", [(status, r["id"]) for r in changed])
+    for r in changed:
+        invalidate_listing_caches(r["id"], r["category"], r["subcategory"])
+    return changed
+
+# ==================[ الإرسال الصادر (طابور محدود المعدّل) ]==================
+# المعالجات لا تنتظر تيليجرام: كل رسالة تُوضع في طابور وتُرسلها خيوط خلفية
+# بحدود تيليجرام (≈30 رسالة/ثانية للبوت و≈1/ثانية لكل محادثة) مع احترام retry_after عند 429.
+# ترتيب الرسائل داخل المحادثة الواحدة محفوظ (لا تُرسل رسالتان لنفس المحادثة بالتوازي).
+OUTBOX_ENABLED  = os.getenv("OUTBOX_ENABLED", "1").strip() != "0"
+OUTBOX_WORKERS  = int(os.getenv("OUTBOX_WORKERS", "4"))
+TG_GLOBAL_RATE  = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE    = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST   = int(os.getenv("TG_CHAT_BURST", "3"))
+TG_MAX_RETRIES  = int(os.getenv("TG_MAX_RETRIES", "5"))
+
+class TokenBucket:
+    """دلو رموز بسيط؛ القفل مسؤولية المستدعي."""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """كم ثانية حتى يتوفر رمز واحد (0 = متاح الآن)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+class _OutJob:
+    __slots__ = ("chat_id", "method", "args", "kwargs", "fallback", "attempts")
+
+    def __init__(self, chat_id, method, args, kwargs, fallback=None):
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.fallback = fallback      # (method, args, kwargs) أو قائمة منها تُرسل بدلاً منه عند فشل غير مؤقت
+        self.attempts = 0
+
+class OutboundDispatcher:
+    """
+    طابور إرسال غير حاجب لاستدعاءات TeleBot (send_message / send_photo / reply_to ...).
+    قبل start() (أو عند OUTBOX_ENABLED=0) يُنفَّذ الإرسال مباشرة في خيط المستدعي.
+    """
+    def __init__(self, tg: telebot.TeleBot, workers: int, global_rate: float,
+                 chat_rate: float, chat_burst: int, max_retries: int):
+        self.tg = tg
+        self.workers = max(1, workers)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        self._queues: "OrderedDict[int, deque]" = OrderedDict()   # محادثات لديها رسائل معلّقة (round-robin)
+        self._busy: set = set()
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._hold_until: Dict[int, float] = {}
+        self._global = TokenBucket(global_rate, global_rate)
+        self._threads: List[threading.Thread] = []
+        self._depth = 0
+        self._last_sweep = time.monotonic()
+
+    # ---------- واجهة المعالجات ----------
+    def send_message(self, chat_id, text, **kwargs):
+        self.submit(chat_id, "send_message", chat_id, text, **kwargs)
+
+    def send_photo(self, chat_id, photo, fallback=None, **kwargs):
+        self.submit(chat_id, "send_photo", chat_id, photo, fallback=fallback, **kwargs)
+
+    def reply_to(self, message, text, **kwargs):
+        self.submit(message.chat.id, "reply_to", message, text, **kwargs)
+
+    def send_media_group(self, chat_id, media, fallback=None, **kwargs):
+        self.submit(chat_id, "send_media_group", chat_id, media, fallback=fallback, **kwargs)
+
+    def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self.submit(chat_id, "edit_message_text", text, chat_id, message_id, **kwargs)
+
+    def answer_callback_query(self, callback_query_id, text=None, **kwargs):
+        """رد الزر الفوري لا يمر بالطابور (لا يخضع لحد المحادثة ويجب أن يصل سريعاً)."""
+        try:
+            self._call(_OutJob(None, "answer_callback_query", (callback_query_id, text), kwargs))
+        except Exception as e:
+            logging.warning("answer_callback_query failed: %s", e)
+
+    def submit(self, chat_id, method: str, *args, fallback=None, **kwargs):
+        job = _OutJob(chat_id, method, args, kwargs, fallback)
+        if not self._threads:
+            self._run_sync(job)
+            return
+        with self._cond:
+            self._queues.setdefault(chat_id, deque()).append(job)
+            self._depth += 1
+            self._cond.notify()
+
+    def depth(self) -> int:
+        return self._depth
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """ينتظر حتى يفرغ الطابور (للإيقاف والأدوات)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._depth or self._busy:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._cond.wait(left)
+        return True
+
+    def start(self):
+        if self._threads or not OUTBOX_ENABLED:
+            return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        atexit.register(self.join, 10)
+
+    # ---------- التنفيذ ----------
+    def _call(self, job: _OutJob):
+        t0 = time.perf_counter()
+        try:
+            return getattr(self.tg, job.method)(*job.args, **job.kwargs)
+        except ApiTelegramException as e:
+            M_TG_ERRORS.inc((job.method, e.error_code))
+            if e.error_code == 429:
+                M_TG_429.inc((job.method,))
+            raise
+        except Exception:
+            M_TG_ERRORS.inc((job.method, "network"))
+            raise
+        finally:
+            M_TG_SECONDS.observe((job.method,), time.perf_counter() - t0)
+
+    def _fallback_jobs(self, job: _OutJob) -> List[_OutJob]:
+        specs = job.fallback or []
+        if isinstance(specs, tuple):
+            specs = [specs]
+        return [_OutJob(job.chat_id, method, args, kwargs) for method, args, kwargs in specs]
+
+    def _run_sync(self, job: _OutJob):
+        while True:
+            try:
+                self._call(job)
+                return
+            except ApiTelegramException as e:
+                if e.error_code == 429 and job.attempts < self.max_retries:
+                    job.attempts += 1
+                    time.sleep(_retry_after(e))
+                    continue
+                logging.warning("send %s to %s failed: %s", job.method, job.chat_id, e)
+            except Exception as e:
+                logging.warning("send %s to %s failed: %s", job.method, job.chat_id, e)
+            for fb in self._fallback_jobs(job):
+                self._run_sync(fb)
+            return
+
+    def _next_job(self) -> _OutJob:
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = None
+                picked = None
+                for chat_id in self._queues:
+                    if chat_id in self._busy:
+                        continue
+                    bucket = self._buckets.get(chat_id)
+                    if bucket is None:
+                        bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+                    d = max(self._hold_until.get(chat_id, 0) - now, bucket.delay(now))
+                    if d <= 0:
+                        picked = chat_id
+                        break
+                    wait = d if wait is None else min(wait, d)
+                if picked is not None:
+                    gd = self._global.delay(now)
+                    if gd <= 0:
+                        q = self._queues[picked]
+                        job = q.popleft()
+                        if q:
+                            self._queues.move_to_end(picked)
+                        else:
+                            del self._queues[picked]
+                        self._buckets[picked].consume()
+                        self._global.consume()
+                        self._busy.add(picked)
+                        self._depth -= 1
+                        return job
+                    wait = gd
+                self._cond.wait(wait)
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            retry: List[_OutJob] = []
+            try:
+                self._call(job)
+            except ApiTelegramException as e:
+                if e.error_code == 429 and job.attempts < self.max_retries:
+                    job.attempts += 1
+                    retry = [job]
+                    with self._cond:
+                        self._hold_until[job.chat_id] = time.monotonic() + _retry_after(e)
+                else:
+                    logging.warning("send %s to %s failed: %s", job.method, job.chat_id, e)
+                    retry = self._fallback_jobs(job)
+            except Exception as e:
+                # أخطاء الشبكة: إعادة محاولة مع تأخير متزايد
+                if job.attempts < self.max_retries:
+                    job.attempts += 1
+                    retry = [job]
+                    with self._cond:
+                        self._hold_until[job.chat_id] = time.monotonic() + min(30, 2 ** job.attempts)
+                else:
+                    logging.warning("send %s to %s failed: %s", job.method, job.chat_id, e)
+            with self._cond:
+                self._busy.discard(job.chat_id)
+                if retry:
+                    # تعود لرأس طابور المحادثة حتى يبقى الترتيب كما هو
+                    self._queues.setdefault(job.chat_id, deque()).extendleft(reversed(retry))
+                    self._depth += len(retry)
+                self._sweep()
+                self._cond.notify_all()
+
+    def _sweep(self):
+        """يحذف دلاء المحادثات الخاملة التي امتلأت من جديد (إعادة إنشائها مكافئة)."""
+        now = time.monotonic()
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        for chat_id in list(self._buckets):
+            if chat_id in self._queues or chat_id in self._busy:
+                continue
+            bucket = self._buckets[chat_id]
+            bucket.delay(now)
+            if bucket.tokens >= bucket.capacity and self._hold_until.get(chat_id, 0) <= now:
+                del self._buckets[chat_id]
+                self._hold_until.pop(chat_id, None)
+
+def _retry_after(e: ApiTelegramException) -> float:
+    params = (e.result_json or {}).get("parameters") or {}
+    return float(params.get("retry_after", 1))
+
+outbox = OutboundDispatcher(bot, OUTBOX_WORKERS, TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST, TG_MAX_RETRIES)
+
+# ==================[ تنفيذ التحديثات (مسار لكل مستخدم) ]==================
+# التحديثات تُوزَّع حسب المستخدم على طوابير تسلسلية: تحديثات مستخدمين مختلفين تُنفّذ بالتوازي
+# على UPDATE_WORKERS خيطاً، وتحديثات المستخدم نفسه واحداً تلو الآخر بترتيب وصولها
+# (فلا يتسابق خيطان على user_states لنفس المستخدم، مثل صورتين متتاليتين في خطوة الصور).
+UPDATE_WORKERS   = int(os.getenv("UPDATE_WORKERS", "8"))        # 0 = تنفيذ مباشر في خيط الاستقبال
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "2000"))   # عند الامتلاء ينتظر الاستقبال (ضغط عكسي)
+
+_UPDATE_FIELDS = ("message", "edited_message", "callback_query", "inline_query",
+                  "chosen_inline_result", "shipping_query", "pre_checkout_query",
+                  "my_chat_member", "chat_member", "chat_join_request")
+
+def _update_user_id(update: types.Update) -> Optional[int]:
+    for field in _UPDATE_FIELDS:
+        obj = getattr(update, field, None)
+        if obj is None:
+            continue
+        user = getattr(obj, "from_user", None)
+        if user is not None:
+            return user.id
+        chat = getattr(obj, "chat", None)
+        return chat.id if chat is not None else None
+    return None
+
+class UpdateEngine:
+    """
+    يحلّ محل process_new_updates في TeleBot (المُنشأ بـ threaded=False): submit() يضع كل
+    تحديث في طابور مستخدمه، والخيوط تأخذ رأس أي طابور لا يُنفَّذ له شيء حالياً (round-robin).
+    قبل start() (أو عند UPDATE_WORKERS=0) يُنفَّذ التحديث مباشرة في خيط المستدعي.
+    """
+    def __init__(self, tg: telebot.TeleBot, workers: int, queue_max: int):
+        self.tg = tg
+        self.workers = workers
+        self.queue_max = max(1, queue_max)
+        self._process = tg.process_new_updates      # التنفيذ الأصلي (المعالجات)
+        self._cond = threading.Condition()
+        self._queues: "OrderedDict[Any, deque]" = OrderedDict()    # مستخدمون لديهم تحديثات معلّقة
+        self._busy: set = set()
+        self._threads: List[threading.Thread] = []
+        self._depth = 0
+        self._max_depth = 0
+        self._processed = 0
+        self._busy_secs = 0.0
+        self._started = time.monotonic()
+
+    def submit(self, updates: List[types.Update]):
+        # إزاحة getUpdates تتقدم فور الاستلام (كان process_new_updates الأصلي يفعل ذلك)
+        for u in updates:
+            if u.update_id > self.tg.last_update_id:
+                self.tg.last_update_id = u.update_id
+        if not self._threads:
+            self.process(updates)
+            return
+        with self._cond:
+            for u in updates:
+                while self._depth >= self.queue_max:
+                    self._cond.wait()
+                uid = _update_user_id(u)
+                key = uid if uid is not None else ("update", u.update_id)
+                self._queues.setdefault(key, deque()).append(u)
+                self._depth += 1
+                self._max_depth = max(self._max_depth, self._depth)
+            self._cond.notify_all()
+
+    def process(self, updates: List[types.Update]):
+        """ينفّذ المعالجات لكل تحديث ويقيس زمنه حسب نوعه (message / callback_query ...)."""
+        for u in updates:
+            kind = next((f for f in _UPDATE_FIELDS if getattr(u, f, None) is not None), "other")
+            if update_recorder:
+                try:
+                    update_recorder.record(u)
+                except Exception as e:
+                    logging.warning("update recorder failed: %s", e)
+            with M_UPDATE_SECONDS.time((kind,)):
+                self._process([u])
+
+    def depth(self) -> int:
+        return self._depth
+
+    def stats(self) -> Dict[str, Any]:
+        """عمق الطوابير واستغلال المسارات (نسبة وقت انشغال الخيوط منذ start)."""
+        with self._cond:
+            elapsed = max(1e-9, time.monotonic() - self._started)
+            return {
+                "workers": len(self._threads),
+                "queued": self._depth,
+                "max_queued": self._max_depth,
+                "users_waiting": len(self._queues),
+                "lanes_busy": len(self._busy),
+                "processed": self._processed,
+                "utilization": self._busy_secs / (elapsed * max(1, len(self._threads))),
+            }
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """ينتظر انتهاء كل التحديثات المعلّقة (للإيقاف والأدوات)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._depth or self._busy:
+                left = None if deadline is None else deadline - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self._cond.wait(left)
+        return True
+
+    def start(self):
+        if self._threads or self.workers <= 0:
+            return
+        self._started = time.monotonic()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"updates-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        atexit.register(self.join, 10)
+
+    def _next(self) -> Tuple[Any, types.Update]:
+        with self._cond:
+            while True:
+                for key in self._queues:
+                    if key in self._busy:
+                        continue
+                    q = self._queues[key]
+                    update = q.popleft()
+                    if q:
+                        self._queues.move_to_end(key)
+                    else:
+                        del self._queues[key]
+                    self._busy.add(key)
+                    self._depth -= 1
+                    self._cond.notify_all()
+                    return key, update
+                self._cond.wait()
+
+    def _worker(self):
+        while True:
+            key, update = self._next()
+            t0 = time.perf_counter()
+            try:
+                self.process([update])
+            except Exception as e:
+                logging.exception("update %s failed: %s", update.update_id, e)
+            with self._cond:
+                self._busy.discard(key)
+                self._processed += 1
+                self._busy_secs += time.perf_counter() - t0
+                self._cond.notify_all()
+
+update_engine = UpdateEngine(bot, UPDATE_WORKERS, UPDATE_QUEUE_MAX)
+bot.process_new_updates = update_engine.submit
+async_runner = None   # AsyncUpdateRunner في وضع BOT_RUNTIME=async
+
+def update_backlog() -> int:
+    """تحديثات مستلمة لم تُنفَّذ بعد (في أي من المحرّكين)."""
+    return update_engine.depth() + (async_runner.stats()["queued"] if async_runner else 0)
+
+metrics.gauge("amanex_sessions_active", "Conversations held in memory by user_states.", lambda: len(user_states))
+metrics.gauge("amanex_update_backlog", "Received updates waiting for a handler.", update_backlog)
+metrics.gauge("amanex_outbox_depth", "Outgoing messages waiting in the send queue.", lambda: outbox.depth())
+
+# ==================[ تسجيل التحديثات الواردة (record/replay) ]==================
+# UPDATE_RECORD_FILE=updates.jsonl يسجّل كل تحديث قبل تنفيذه كسطر JSON {"t": وقت, "update": {...}}
+# في ملف يدور عند UPDATE_RECORD_MAX_MB (مع UPDATE_RECORD_BACKUPS نسخ .1 .2 ...).
+# الإخفاء يعتمد على خطوة المستخدم لحظة التنفيذ: نص خطوة وسيلة التواصل/بيانات الدفع/رسالة الدعم
+# يُستبدل بعلامة ثابتة تبقي المسار قابلاً لإعادة التشغيل (benchmarks/replay.py).
+UPDATE_RECORD_FILE    = os.getenv("UPDATE_RECORD_FILE", "").strip()       # فارغ = بدون تسجيل
+UPDATE_RECORD_MAX_MB  = float(os.getenv("UPDATE_RECORD_MAX_MB", "50"))
+UPDATE_RECORD_BACKUPS = int(os.getenv("UPDATE_RECORD_BACKUPS", "5"))
+UPDATE_RECORD_REDACT  = os.getenv("UPDATE_RECORD_REDACT", "contacts,payments,support,names").strip()  # أو none
+
+# (flow, step) -> فئة الإخفاء لنص الرسالة في تلك الخطوة
+REDACT_STEPS = {
+    ("sell", "seller_contact"):      "contacts",
+    ("buy", "await_buyer_contact"):  "contacts",
+    ("sell", "await_pay_detail"):    "payments",
+    ("support", "await_message"):    "support",
+}
+_PII_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+|\+?\d[\d\s-]{6,}\d")   # بريد أو رقم هاتف/حساب طويل
+
+class UpdateRecorder:
+    def __init__(self, path: str, max_mb: float, backups: int, redact: str):
+        from logging.handlers import RotatingFileHandler
+        self.redact = {c.strip() for c in redact.split(",") if c.strip() and c.strip() != "none"}
+        # delay: لا يُفتح الملف عند الاستيراد، بل مع أول تحديث يُسجَّل
+        handler = RotatingFileHandler(path, maxBytes=int(max_mb * 1024 * 1024), backupCount=backups,
+                                      encoding="utf-8", delay=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._log = logging.getLogger("amanex.updates")
+        self._log.propagate = False
+        self._log.setLevel(logging.INFO)
+        self._log.addHandler(handler)
+
+    def record(self, update: types.Update):
+        raw: Dict[str, Any] = {"update_id": update.update_id}
+        for field in _UPDATE_FIELDS:
+            obj = getattr(update, field, None)
+            if obj is not None and getattr(obj, "json", None) is not None:
+                raw[field] = json.loads(json.dumps(obj.json))    # نسخة عميقة قبل التعديل
+        if self.redact:
+            self._redact(raw, user_states.peek(_update_user_id(update)))
+        self._log.info(json.dumps({"t": round(time.time(), 3), "update": raw}, ensure_ascii=False))
+
+    def _redact(self, raw: Dict[str, Any], state: Optional[Dict[str, Any]]):
+        step_kind = REDACT_STEPS.get((state.get("flow"), state.get("step"))) if state else None
+        cq = raw.get("callback_query") or {}
+        messages = [m for m in (raw.get("message"), raw.get("edited_message")) if m]
+        # النص وتعليق الصورة قد يحملان بيانات دفع أو وسيلة تواصل (إثبات الدفع صورة مع تعليق)
+        for msg in messages:
+            for key in ("text", "caption"):
+                if not msg.get(key):
+                    continue
+                if step_kind in self.redact:
+                    msg[key] = f"<{step_kind}>"
+                elif "contacts" in self.redact:
+                    msg[key] = _PII_RE.sub("<contact>", msg[key])
+            contact = msg.get("contact")
+            if isinstance(contact, dict) and "contacts" in self.redact and contact.get("phone_number"):
+                contact["phone_number"] = "<contact>"
+        if "names" in self.redact:
+            for obj in (*messages, cq, cq.get("message")):
+                obj = obj or {}
+                for who in (obj.get("from"), obj.get("chat"), obj.get("contact")):
+                    if isinstance(who, dict):
+                        alias = f"u{who.get('id', who.get('user_id', ''))}"
+                        for k in ("first_name", "last_name", "username"):
+                            if who.get(k):
+                                who[k] = alias
+
+update_recorder: Optional[UpdateRecorder] = (
+    UpdateRecorder(UPDATE_RECORD_FILE, UPDATE_RECORD_MAX_MB, UPDATE_RECORD_BACKUPS, UPDATE_RECORD_REDACT)
+    if UPDATE_RECORD_FILE else None
+)
+
+# =====================[ النسخ الاحتياطي (أونلاين) ]=====================
+# النسخ عبر sqlite3 backup API على دفعات صفحات في خيط خلفي (لقطة متسقة حتى أثناء الكتابة)،
+# ثم ضغط gzip في BACKUP_DIR مع سياسة احتفاظ: آخر نسخة لكل ساعة/يوم لعدد محدد من الساعات/الأيام.
+BACKUP_DIR           = os.getenv("BACKUP_DIR", "backups").strip()
+BACKUP_STEP_PAGES    = int(os.getenv("BACKUP_STEP_PAGES", "256"))      # صفحات لكل خطوة نسخ
+BACKUP_STEP_SLEEP    = float(os.getenv("BACKUP_STEP_SLEEP", "0.005"))  # استراحة بين الخطوات لتمرير الكتّاب
+BACKUP_KEEP_HOURLY   = int(os.getenv("BACKUP_KEEP_HOURLY", "24"))
+BACKUP_KEEP_DAILY    = int(os.getenv("BACKUP_KEEP_DAILY", "7"))
+BACKUP_INTERVAL_SECS = int(os.getenv("BACKUP_INTERVAL_SECS", "0"))     # 0 = بدون جدولة (يدوي فقط)
+BACKUP_TS_FORMAT     = "%Y%m%d-%H%M%S"
+
+class BackupManager:
+    """
+    طابور نسخ احتياطي بخيط واحد: submit() يعيد رقم مهمة فوراً، والنسخ والضغط والتدوير
+    تجري في الخلفية. طلب جديد أثناء وجود مهمة منتظرة/جارية يعيد رقمها بدل تكرار النسخ.
+    """
+    def __init__(self, db_file: str, out_dir: str, interval: int = 0):
+        self.db_file = db_file
+        self.out_dir = out_dir
+        self.interval = interval
+        self.prefix = os.path.splitext(os.path.basename(db_file))[0] + "-"
+        self._jobs: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._queue: deque = deque()
+        self._cv = threading.Condition()
+        self._seq = 0
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    # ---------- الواجهة ----------
+    def submit(self, reason: str = "manual", notify_chat: Optional[int] = None) -> str:
+        with self._cv:
+            for jid, job in self._jobs.items():
+                if job["status"] in ("queued", "running"):
+                    return jid
+            self._seq += 1
+            jid = f"{datetime.utcnow().strftime('%H%M%S')}-{self._seq}"
+            self._jobs[jid] = {"status": "queued", "reason": reason, "notify_chat": notify_chat,
+                               "path": None, "bytes": 0, "error": None,
+                               "submitted": time.time(), "finished": None}
+            while len(self._jobs) > 50:   # سجل محدود للاستعلام عن المهام
+                self._jobs.popitem(last=False)
+            self._queue.append(jid)
+            self._cv.notify()
+        self.start()
+        return jid
+
+    def job(self, jid: str) -> Optional[Dict[str, Any]]:
+        with self._cv:
+            job = self._jobs.get(jid)
+            return dict(job) if job else None
+
+    def start(self):
+        """يشغّل خيط النسخ، وخيط الجدولة إن كان BACKUP_INTERVAL_SECS > 0."""
+        if self._threads:
+            return
+        self._threads.append(threading.Thread(target=self._worker, name="db-backup", daemon=True))
+        if self.interval > 0:
+            self._threads.append(threading.Thread(target=self._scheduler, name="db-backup-sched", daemon=True))
+        for t in self._threads:
+            t.start()
+
+    # ---------- الخيوط ----------
+    def _scheduler(self):
+        while not self._stop.wait(self.interval):
+            self.submit("scheduled")
+
+    def _worker(self):
+        while not self._stop.is_set():
+            with self._cv:
+                while not self._queue:
+                    self._cv.wait()
+                jid = self._queue.popleft()
+                job = self._jobs.get(jid)
+                if job is None:
+                    continue
+                job["status"] = "running"
+            try:
+                path = self.run_once()
+                job.update(status="done", path=path, bytes=os.path.getsize(path))
+                logging.info("backup %s done: %s (%d bytes)", jid, path, job["bytes"])
+            except Exception as e:
+                logging.exception("backup %s failed: %s", jid, e)
+                job.update(status="failed", error=str(e))
+            job["finished"] = time.time()
+            if job["notify_chat"]:
+                outbox.send_message(job["notify_chat"], backup_job_text(jid, job))
+
+    # ---------- النسخ ----------
+    def run_once(self) -> str:
+        """لقطة أونلاين متسقة -> ملف .db.gz، ثم تطبيق سياسة الاحتفاظ. تعيد مسار النسخة."""
+        if not os.path.exists(self.db_file):
+            raise FileNotFoundError(self.db_file)
+        os.makedirs(self.out_dir, exist_ok=True)
+        name = self.prefix + datetime.utcnow().strftime(BACKUP_TS_FORMAT)
+        tmp = os.path.join(self.out_dir, name + ".db.tmp")
+        final = os.path.join(self.out_dir, name + ".db.gz")
+
+        src = _open_db_conn()
+        dst = sqlite3.connect(tmp)
+        try:
+            # كل خطوة تقرأ BACKUP_STEP_PAGES صفحة ثم تفلت القفل؛ الاستراحة تمنح الكتّاب فرصة
+            src.backup(dst, pages=BACKUP_STEP_PAGES,
+                       progress=lambda status, remaining, total: time.sleep(BACKUP_STEP_SLEEP))
+        finally:
+            dst.close()
+            src.close()
+        try:
+            with open(tmp, "rb") as f_in, gzip.open(final + ".part", "wb", compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.replace(final + ".part", final)
+        finally:
+            for p in (tmp, final + ".part"):
+                if os.path.exists(p):
+                    os.remove(p)
+        self.prune()
+        return final
+
+    def prune(self) -> List[str]:
+        """يبقي أحدث نسخة لكل ساعة (آخر BACKUP_KEEP_HOURLY ساعة) ولكل يوم (آخر BACKUP_KEEP_DAILY يوم)."""
+        snaps = []
+        for fn in os.listdir(self.out_dir):
+            if not (fn.startswith(self.prefix) and fn.endswith(".db.gz")):
+                continue
+            try:
+                ts = datetime.strptime(fn[len(self.prefix):-len(".db.gz")], BACKUP_TS_FORMAT)
+            except ValueError:
+                continue
+            snaps.append((ts, fn))
+        snaps.sort(reverse=True)
+
+        keep = set()
+        hours, days = set(), set()
+        for ts, fn in snaps:
+            h, d = ts.strftime("%Y%m%d%H"), ts.strftime("%Y%m%d")
+            if h not in hours and len(hours) < BACKUP_KEEP_HOURLY:
+                hours.add(h)
+                keep.add(fn)
+            if d not in days and len(days) < BACKUP_KEEP_DAILY:
+                days.add(d)
+                keep.add(fn)
+
+        removed = []
+        for _, fn in snaps:
+            if fn not in keep:
+                os.remove(os.path.join(self.out_dir, fn))
+                removed.append(fn)
+        return removed
+
+def backup_job_text(jid: str, job: Dict[str, Any]) -> str:
+    if job["status"] == "done":
+        return f"✅ النسخة الاحتياطية <code>{jid}</code> جاهزة: <code>{job['path']}</code> ({job['bytes'] // 1024} KB)"
+    if job["status"] == "failed":
+        return f"⚠️ فشلت النسخة الاحتياطية <code>{jid}</code>: {html.escape(job['error'] or '')}"
+    return f"⏳ النسخة الاحتياطية <code>{jid}</code> قيد التنفيذ ({job['status']})."
+
+backups = BackupManager(DB_FILE, BACKUP_DIR, BACKUP_INTERVAL_SECS)
 
 # =======================[ لوحات المفاتيح (Reply) ]=====================
-def main_menu_kb() -> types.ReplyKeyboardMarkup:
+class FrozenMarkup(types.JsonSerializable):
+    """
+    لوحة جاهزة غير قابلة للتعديل: تُبنى وتُسلسل JSON مرة واحدة، ثم يعيد to_json()
+    النص المحفوظ لكل طلب صادر بدل إعادة بناء ReplyKeyboardMarkup وترميزها.
+    """
+    __slots__ = ("name", "_json")
+
+    def __init__(self, name: str, markup: types.JsonSerializable):
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "_json", markup.to_json())
+
+    def __setattr__(self, key, value):
+        raise AttributeError("FrozenMarkup is immutable")
+
+    def to_json(self) -> str:
+        return self._json
+
+    def __repr__(self) -> str:
+        return f"FrozenMarkup({self.name!r})"
+
+class KeyboardRegistry:
+    """
+    سجل اللوحات: اسم -> دالة بناء. تُبنى كل اللوحات الثابتة عند الإقلاع (warm)،
+    واللوحات المبنية من بيانات متغيرة (قائمة الألعاب) تبقى مخزنة حتى invalidate(name).
+    """
+    def __init__(self):
+        self._builders: Dict[str, Callable[[], types.JsonSerializable]] = {}
+        self._frozen: Dict[str, FrozenMarkup] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str):
+        def deco(builder):
+            self._builders[name] = builder
+            return builder
+        return deco
+
+    def get(self, name: str) -> FrozenMarkup:
+        kb = self._frozen.get(name)
+        if kb is None:
+            with self._lock:
+                kb = self._frozen.get(name)
+                if kb is None:
+                    kb = FrozenMarkup(name, self._builders[name]())
+                    self._frozen[name] = kb
+        return kb
+
+    def invalidate(self, name: Optional[str] = None):
+        with self._lock:
+            if name is None:
+                self._frozen.clear()
+            else:
+                self._frozen.pop(name, None)
+
+    def warm(self):
+        for name in list(self._builders):
+            self.get(name)
+        logging.info("keyboards: %d prebuilt", len(self._frozen))
+
+keyboards = KeyboardRegistry()
+
+# قائمة الألعاب (تتغير بتعديل هذه القائمة عبر set_games_catalog ثم يُعاد بناء لوحتها)
+GAMES_CATALOG: List[str] = [
+    "PUBG Mobile", "Free Fire", "Clash of Clans", "Clash Royale",
+    "Call of Duty: Mobile", "Fortnite", "Genshin Impact", "Roblox",
+    "Valorant", "Mobile Legends", "Lords Mobile", "Township", "Other"
+]
+
+def set_games_catalog(games: List[str]):
+    global GAMES_CATALOG
+    GAMES_CATALOG = list(games)
+    keyboards.invalidate("games_sub")
+
+@keyboards.register("main_menu")
+def _build_main_menu():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
     kb.row("📤 بيع حساب", "📥 شراء حساب")
     kb.row("👤 حساباتي", "📄 شروط الخدمة", "☎️ تواصل مع الدعم")
     return kb
 
-def sell_category_kb() -> types.ReplyKeyboardMarkup:
+@keyboards.register("sell_category")
+def _build_sell_category():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     kb.row("📱 تواصل اجتماعي", "🎮 ألعاب")
     kb.row("✏️ غير ذلك", BACK_BTN)
     return kb
 
-def social_sub_kb() -> types.ReplyKeyboardMarkup:
+@keyboards.register("social_sub")
+def _build_social_sub():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     kb.row("Facebook", "Instagram")
     kb.row("TikTok", "Telegram")
     kb.row("YouTube", "Other", BACK_BTN)
     return kb
 
-def games_sub_kb() -> types.ReplyKeyboardMarkup:
-    games = [
-        "PUBG Mobile", "Free Fire", "Clash of Clans", "Clash Royale",
-        "Call of Duty: Mobile", "Fortnite", "Genshin Impact", "Roblox",
-        "Valorant", "Mobile Legends", "Lords Mobile", "Township", "Other"
-    ]
+@keyboards.register("games_sub")
+def _build_games_sub():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     row = []
-    for i, g in enumerate(games, 1):
+    for i, g in enumerate(GAMES_CATALOG, 1):
         row.append(g)
         if i % 2 == 0:
             kb.row(*row)
@@ -444,7 +2575,7 @@ def games_sub_kb() -> types.ReplyKeyboardMarkup:
     kb.row(BACK_BTN)
     return kb
 
-def payment_methods_kb(multi: bool=True) -> types.ReplyKeyboardMarkup:
+def _build_payment_methods(multi: bool):
     """يبني لوحة طرق الدفع بالمسميات الجديدة (مع الملاحظات)."""
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=not multi)
     kb.row(PAYMENT_LABELS["SyriaTel"], PAYMENT_LABELS["MTN"])
@@ -456,19 +2587,62 @@ def payment_methods_kb(multi: bool=True) -> types.ReplyKeyboardMarkup:
         kb.row(BACK_BTN)
     return kb
 
-def buy_flow_kb() -> types.ReplyKeyboardMarkup:
+keyboards.register("payment_multi")(lambda: _build_payment_methods(True))
+keyboards.register("payment_single")(lambda: _build_payment_methods(False))
+
+@keyboards.register("buy_flow")
+def _build_buy_flow():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
     kb.row("📱 تواصل اجتماعي", "🎮 ألعاب")
-    kb.row("✏️ غير ذلك", BACK_BTN)
+    kb.row("🔎 بحث", "✏️ غير ذلك")
+    kb.row(BACK_BTN)
     return kb
 
-def admin_menu_kb() -> types.ReplyKeyboardMarkup:
+@keyboards.register("admin_menu")
+def _build_admin_menu():
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
     kb.row("🔎 بحث عرض", "🔎 بحث طلب")
     kb.row("📦 عروض قيد الانتظار", "🧾 طلبات مدفوعة")
-    kb.row("📥 نسخ DB احتياطية", BACK_BTN)
+    kb.row("📊 الإحصائيات", "📥 نسخ DB احتياطية")
+    kb.row(BACK_BTN)
     return kb
 
+@keyboards.register("back_only")
+def _build_back_only():
+    return types.ReplyKeyboardMarkup(resize_keyboard=True).row(BACK_BTN)
+
+@keyboards.register("remove")
+def _build_remove():
+    return types.ReplyKeyboardRemove()
+
+# واجهة الاستدعاء كما كانت — تعيد الآن نسخة جاهزة مشتركة بدل بناء لوحة جديدة
+def main_menu_kb() -> FrozenMarkup:
+    return keyboards.get("main_menu")
+
+def sell_category_kb() -> FrozenMarkup:
+    return keyboards.get("sell_category")
+
+def social_sub_kb() -> FrozenMarkup:
+    return keyboards.get("social_sub")
+
+def games_sub_kb() -> FrozenMarkup:
+    return keyboards.get("games_sub")
+
+def payment_methods_kb(multi: bool=True) -> FrozenMarkup:
+    return keyboards.get("payment_multi" if multi else "payment_single")
+
+def buy_flow_kb() -> FrozenMarkup:
+    return keyboards.get("buy_flow")
+
+def admin_menu_kb() -> FrozenMarkup:
+    return keyboards.get("admin_menu")
+
+def back_only_kb() -> FrozenMarkup:
+    return keyboards.get("back_only")
+
+def remove_kb() -> FrozenMarkup:
+    return keyboards.get("remove")
+
 # =========================[ أدوات رسائل جاهزة ]=======================
 WELCOME_TEXT = (
     "🚀 ابدأ تجارتك الإلكترونية بثقة و أمان مع أول بوت عربي للوساطة الرقمية!\n\n"
@@ -494,14 +2668,44 @@ SUPPORT_HOWTO = (
     "أرسل كلمة <b>إلغاء</b> لإلغاء العملية."
 )
 
+# =====================[ عرض الإعلانات (ألبومات الصور) ]=================
+# حد تيليجرام لعدد العناصر في الألبوم الواحد (sendMediaGroup)
+MEDIA_GROUP_MAX = 10
+
+def send_listing_media(chat_id: int, images: List[str], caption: str, reply_markup=None):
+    """
+    يرسل صور الإعلان كألبومات (حتى 10 صور لكل ألبوم) والوصف على أول صورة،
+    بدلاً من استدعاء لكل صورة. عند فشل ألبوم يُرسل محتواه صورةً صورة.
+    الألبوم لا يقبل أزراراً، لذا عند وجود reply_markup مع عدة صور يُرسل الوصف كرسالة بعده.
+    """
+    if not images:
+        outbox.send_message(chat_id, caption, reply_markup=reply_markup)
+        return
+    if len(images) == 1:
+        outbox.send_photo(chat_id, images[0], caption=caption, reply_markup=reply_markup,
+                          fallback=("send_message", (chat_id, caption), {"reply_markup": reply_markup}))
+        return
+
+    album_caption = None if reply_markup else caption
+    for start in range(0, len(images), MEDIA_GROUP_MAX):
+        chunk = images[start:start + MEDIA_GROUP_MAX]
+        first_caption = album_caption if start == 0 else None
+        media = [types.InputMediaPhoto(fid, caption=first_caption if i == 0 else None)
+                 for i, fid in enumerate(chunk)]
+        fallback = [("send_photo", (chat_id, fid), {"caption": first_caption} if (first_caption and i == 0) else {})
+                    for i, fid in enumerate(chunk)]
+        outbox.send_media_group(chat_id, media, fallback=fallback)
+    if reply_markup:
+        outbox.send_message(chat_id, caption, reply_markup=reply_markup)
+
 # =====================[ إشعارات للإدمن (رسائل)]=======================
-def notify_admin_new_listing(listing: sqlite3.Row):
+def notify_admin_new_listing(listing: Dict[str, Any]):
     """إرسال تفاصيل الإعلان الجديد للإدمن (مع الصور إن وجدت)."""
     if not listing:
         return
-    images = json.loads(listing["images_json"] or "[]")
-    pm = json.loads(listing["payment_methods_json"] or "[]")
-    pd = json.loads(listing["payment_details_json"] or "{}")
+    images = listing["images"]
+    pm = listing["payment_methods"]
+    pd = listing["payment_details"]
 
     pm_names = [method_display_short(k) for k in pm]
 
@@ -522,12 +2726,7 @@ def notify_admin_new_listing(listing: sqlite3.Row):
     )
 
     try:
-        if images:
-            bot.send_photo(ADMIN_ID, images[0], caption=caption)
-            for fid in images[1:]:
-                bot.send_photo(ADMIN_ID, fid)
-        else:
-            bot.send_message(ADMIN_ID, caption)
+        send_listing_media(ADMIN_ID, images, caption)
     except Exception as e:
         logging.exception("notify_admin_new_listing failed: %s", e)
 
@@ -550,9 +2749,9 @@ def notify_admin_new_order(order: sqlite3.Row):
 
     try:
         if order["payment_proof_file_id"]:
-            bot.send_photo(ADMIN_ID, order["payment_proof_file_id"], caption=caption)
+            outbox.send_photo(ADMIN_ID, order["payment_proof_file_id"], caption=caption)
         else:
-            bot.send_message(ADMIN_ID, caption)
+            outbox.send_message(ADMIN_ID, caption)
     except Exception as e:
         logging.exception("notify_admin_new_order failed: %s", e)
 
@@ -568,7 +2767,40 @@ def ensure_user(u: telebot.types.User):
 def on_start(msg: types.Message):
     ensure_user(msg.from_user)
     reset_state(msg.from_user.id)
-    bot.send_message(msg.chat.id, WELCOME_TEXT, reply_markup=main_menu_kb())
+    outbox.send_message(msg.chat.id, WELCOME_TEXT, reply_markup=main_menu_kb())
+
+# ----------------------- /search -----------------------
+@bot.message_handler(commands=["search"])
+def on_search(msg: types.Message):
+    ensure_user(msg.from_user)
+    parts = (msg.text or "").split(maxsplit=1)
+    state = {"flow": "buy", "step": "search_query"}
+    user_states[msg.from_user.id] = state
+    if len(parts) < 2 or not parts[1].strip():
+        outbox.send_message(msg.chat.id, "🔎 اكتب ما تبحث عنه (اسم اللعبة، المستوى، المنصة...):", reply_markup=back_only_kb())
+        return
+    run_search(msg, state, parts[1].strip())
+
+def stats_text(stats: Dict[str, Any]) -> str:
+    def counts(d: Dict[str, int], label: Callable[[str], str] = str) -> str:
+        return " | ".join(f"{html.escape(label(k) or '-')}: {v}" for k, v in sorted(d.items(), key=lambda kv: -kv[1])) or "-"
+    lines = [
+        "📊 <b>الإحصائيات</b>",
+        f"👥 المستخدمون: {stats['users'].get('total', 0)}",
+        f"📦 الإعلانات: {counts(stats['listings'])}",
+        f"🧾 الطلبات: {counts(stats['orders'])}",
+        f"💳 الطلبات حسب طريقة الدفع: {counts(stats['orders_by_method'], method_display_short)}",
+        "",
+        "🛒 العروض النشطة حسب الفئة:",
+    ]
+    lines += [f"- {html.escape(k)}: {v}" for k, v in sorted(stats["supply"].items(), key=lambda kv: -kv[1])] or ["-"]
+    lines += ["", f"📅 آخر {STATS_DAYS} أيام:"]
+    for day, d in stats["daily"].items():
+        volume = " + ".join(f"{format_amount(a)} {cur}" for cur, a in sorted(d["volume"].items()))
+        lines.append(f"- {day}: {d['orders']} طلب" + (f" | {volume}" if volume else ""))
+    if not stats["daily"]:
+        lines.append("- لا طلبات.")
+    return "\n".join(lines)
 
 # ----------------------- /admin ------------------------
 @bot.message_handler(commands=["admin"])
@@ -576,18 +2808,27 @@ def on_admin(msg: types.Message):
     if msg.from_user.id != ADMIN_ID:
         return
     user_states[msg.from_user.id] = {"flow": "admin", "step": "menu"}
-    bot.send_message(msg.chat.id, "لوحة تحكم الإدمن — اختر إجراء:", reply_markup=admin_menu_kb())
+    outbox.send_message(msg.chat.id, "لوحة تحكم الإدمن — اختر إجراء:", reply_markup=admin_menu_kb())
 
 # ----------------- أوامر إدمن سريعة -------------------
+@bot.message_handler(commands=["stats"])
+def on_stats(msg: types.Message):
+    if msg.from_user.id != ADMIN_ID:
+        return
+    outbox.reply_to(msg, stats_text(get_stats()))
+
 @bot.message_handler(commands=["backupdb"])
 def on_backupdb(msg: types.Message):
     if msg.from_user.id != ADMIN_ID:
         return
-    path = backup_db_copy()
-    if path:
-        bot.reply_to(msg, f"✅ تم إنشاء نسخة: <code>{path}</code>")
-    else:
-        bot.reply_to(msg, "⚠️ لا يوجد ملف قاعدة بيانات لنسخه.")
+    parts = (msg.text or "").split()
+    # /backupdb <job_id> : حالة مهمة سابقة
+    if len(parts) > 1:
+        job = backups.job(parts[1])
+        outbox.reply_to(msg, backup_job_text(parts[1], job) if job else "⚠️ لا توجد مهمة بهذا الرقم.")
+        return
+    jid = backups.submit("manual", notify_chat=msg.chat.id)
+    outbox.reply_to(msg, f"⏳ بدأ النسخ الاحتياطي — رقم المهمة: <code>{jid}</code>\nسنرسل لك المسار عند الانتهاء.")
 
 @bot.message_handler(commands=["findlist"])
 def on_findlist(msg: types.Message):
@@ -595,14 +2836,14 @@ def on_findlist(msg: types.Message):
         return
     parts = msg.text.strip().split()
     if len(parts) != 2 or not parts[1].isdigit():
-        bot.reply_to(msg, "الاستخدام: /findlist <seq>")
+        outbox.reply_to(msg, "الاستخدام: /findlist <seq>")
         return
     seq = int(parts[1])
     row = get_listing_by_seq(seq)
     if not row:
-        bot.reply_to(msg, "لم يتم العثور على إعلان بهذا الرقم.")
+        outbox.reply_to(msg, "لم يتم العثور على إعلان بهذا الرقم.")
         return
-    images = json.loads(row["images_json"] or "[]")
+    images = row["images"]
     caption = (
         f"📦 عرض\n"
         f"SEQ: {row['seq']:03d}\n"
@@ -613,12 +2854,7 @@ def on_findlist(msg: types.Message):
         f"الحالة: {row['status']}\n"
         f"الوصف:\n{row['description']}"
     )
-    if images:
-        bot.send_photo(msg.chat.id, images[0], caption=caption)
-        for f in images[1:]:
-            bot.send_photo(msg.chat.id, f)
-    else:
-        bot.send_message(msg.chat.id, caption)
+    send_listing_media(msg.chat.id, images, caption)
 
 @bot.message_handler(commands=["findorder"])
 def on_findorder(msg: types.Message):
@@ -626,12 +2862,12 @@ def on_findorder(msg: types.Message):
         return
     parts = msg.text.strip().split()
     if len(parts) != 2 or not parts[1].isdigit():
-        bot.reply_to(msg, "الاستخدام: /findorder <seq>")
+        outbox.reply_to(msg, "الاستخدام: /findorder <seq>")
         return
     seq = int(parts[1])
     row = get_order_by_seq(seq)
     if not row:
-        bot.reply_to(msg, "لم يتم العثور على طلب بهذا الرقم.")
+        outbox.reply_to(msg, "لم يتم العثور على طلب بهذا الرقم.")
         return
     caption = (
         f"🧾 طلب\n"
@@ -645,47 +2881,124 @@ def on_findorder(msg: types.Message):
         f"وسيلة تواصل المشتري: {row['buyer_contact'] or '-'}"
     )
     if row["payment_proof_file_id"]:
-        bot.send_photo(msg.chat.id, row["payment_proof_file_id"], caption=caption)
+        outbox.send_photo(msg.chat.id, row["payment_proof_file_id"], caption=caption)
     else:
-        bot.send_message(msg.chat.id, caption)
+        outbox.send_message(msg.chat.id, caption)
+
+# approve/reject/mark_sold: رقم واحد أو قائمة ونطاقات (12,15,20-40) أو "pending [فئة]"
+_ID_SPEC_RE = re.compile(r"^\d+(-\d+)?(,\d+(-\d+)?)*$")
+
+def parse_listing_selector(args: List[str]) -> Tuple[Optional[List[int]], List[str]]:
+    """
+    يقرأ محدِّد الإعلانات من بداية معاملات الأمر ويُرجع (المعرّفات، بقية المعاملات).
+    المعرّفات None إن كان المحدِّد غير صالح أو تجاوز BULK_MAX.
+    """
+    if not args:
+        return None, []
+    if args[0].lower() == "pending":
+        # الكلمة التالية فئة فقط إن كانت فئة معروفة، وإلا تبقى في البقية: سبب في /reject،
+        # وخطأ استخدام في غيره (فلا تتحوّل فئة مكتوبة خطأً إلى "كل الإعلانات المعلّقة")
+        if len(args) > 1 and args[1].lower() in bulk_categories():
+            return get_pending_listing_ids(args[1].lower()), args[2:]
+        return get_pending_listing_ids(), args[1:]
+    spec = args[0].replace("،", ",").strip(",")
+    if not _ID_SPEC_RE.match(spec):
+        return None, args[1:]
+    ids: set = set()
+    for part in spec.split(","):
+        lo, _, hi = part.partition("-")
+        lo, hi = int(lo), int(hi or lo)
+        if hi < lo or hi - lo + 1 > BULK_MAX:
+            return None, args[1:]
+        ids.update(range(lo, hi + 1))
+        if len(ids) > BULK_MAX:
+            return None, args[1:]
+    return sorted(ids), args[1:]
+
+def bulk_categories() -> List[str]:
+    return [key for key, *_ in SELL_CATEGORIES.values()]
+
+def _ids_preview(ids: List[int], limit: int = 30) -> str:
+    shown = ", ".join(str(i) for i in ids[:limit])
+    return shown + (f" … (+{len(ids) - limit})" if len(ids) > limit else "")
+
+# رسالة البائع لكل حالة: (عنوان، سطر لكل إعلان)
+_SELLER_STATUS_NOTICE = {
+    "active":   "✅ تمت الموافقة على إعلاناتك وأصبحت ظاهرة للمشترين:",
+    "rejected": "⛔️ تم رفض إعلاناتك التالية:",
+    "sold":     "🏁 تم وسم إعلاناتك التالية كمباعة:",
+}
+
+def apply_bulk_status(msg: types.Message, command: str, status: str, done_text: str,
+                      extra_usage: str = "", reason: bool = False, order_seq: bool = False):
+    """
+    ينفّذ أمر إدمن جماعي: تحديث واحد للقاعدة، رد ملخّص واحد، ورسالة واحدة لكل بائع عبر outbox
+    (الطابور يحترم حدود الإرسال فلا يُغرق تيليجرام عند مئات الإعلانات).
+    بقية المعاملات بعد المحدِّد: سبب إن كان reason، أو رقم طلب واحد إن كان order_seq، وإلا خطأ استخدام.
+    """
+    args = (msg.text or "").split()[1:]
+    ids, rest = parse_listing_selector(args)
+    if ids is None or (rest and not reason and not (order_seq and len(rest) == 1 and rest[0].isdigit())):
+        usage = html.escape(f"/{command} <ids> {extra_usage}".strip())
+        outbox.reply_to(msg, f"الاستخدام: {usage}\n"
+                             f"مثال: /{command} 12 أو /{command} 12,15,20-40 أو /{command} pending games\n"
+                             f"الفئات: {', '.join(bulk_categories())}\n"
+                             f"(حد أقصى {BULK_MAX} إعلان في الأمر الواحد)")
+        return
+    order = None
+    if order_seq and rest:
+        # رقم الطلب يربط البيع بطلب محدد: لإعلان واحد فقط، ويجب أن يكون الطلب على هذا الإعلان
+        order = get_order_by_seq(int(rest[0]))
+        if len(ids) != 1 or not order or order["listing_id"] != ids[0]:
+            outbox.reply_to(msg, "⚠️ رقم الطلب يُستخدم مع إعلان واحد فقط، ويجب أن يكون طلباً على هذا الإعلان.")
+            return
+    changed = bulk_update_listing_status(ids, status) if ids else []
+    note = " ".join(rest) if reason else ""
+
+    by_seller: Dict[int, List[sqlite3.Row]] = {}
+    for r in changed:
+        if r["seller_telegram_id"]:
+            by_seller.setdefault(r["seller_telegram_id"], []).append(r)
+    for seller, rows in by_seller.items():
+        lines = [_SELLER_STATUS_NOTICE[status]]
+        for r in rows:
+            where = html.escape(f"{r['category']}/{r['subcategory']}")
+            lines.append(f"- <code>{r['tracking_code']}</code> ({where})")
+        if note:
+            lines.append(f"السبب: {html.escape(note)}")
+        outbox.send_message(seller, "\n".join(lines))
+
+    changed_ids = [r["id"] for r in changed]
+    skipped = len(ids) - len(changed_ids)
+    summary = f"{done_text}: {len(changed_ids)} إعلان"
+    if changed_ids:
+        summary += f"\nID: {_ids_preview(changed_ids)}"
+    if skipped:
+        summary += f"\nتم تجاهل {skipped} (غير موجود أو بالحالة نفسها)."
+    if note:
+        summary += f"\nالسبب: {html.escape(note)}"
+    if order:
+        summary += f"\n🧾 الطلب: {order['seq']:03d} | {order['tracking_code']}"
+    summary += f"\n📨 إشعارات للبائعين: {len(by_seller)}"
+    outbox.reply_to(msg, summary)
 
-# اختياري: approve/reject/mark_sold (أساسيات)
 @bot.message_handler(commands=["approve"])
 def on_approve(msg: types.Message):
     if msg.from_user.id != ADMIN_ID:
         return
-    parts = msg.text.strip().split()
-    if len(parts) != 2 or not parts[1].isdigit():
-        bot.reply_to(msg, "الاستخدام: /approve <listing_id>")
-        return
-    listing_id = int(parts[1])
-    update_listing_status(listing_id, "active")
-    bot.reply_to(msg, f"✅ تم تفعيل الإعلان ID {listing_id}.")
+    apply_bulk_status(msg, "approve", "active", "✅ تم تفعيل")
 
 @bot.message_handler(commands=["reject"])
 def on_reject(msg: types.Message):
     if msg.from_user.id != ADMIN_ID:
         return
-    parts = msg.text.strip().split(maxsplit=2)
-    if len(parts) < 2 or not parts[1].isdigit():
-        bot.reply_to(msg, "الاستخدام: /reject <listing_id> [سبب]")
-        return
-    listing_id = int(parts[1])
-    update_listing_status(listing_id, "rejected")
-    reason = parts[2] if len(parts) > 2 else ""
-    bot.reply_to(msg, f"⛔️ تم رفض الإعلان ID {listing_id}. {('السبب: ' + reason) if reason else ''}")
+    apply_bulk_status(msg, "reject", "rejected", "⛔️ تم رفض", extra_usage="[سبب]", reason=True)
 
 @bot.message_handler(commands=["mark_sold"])
 def on_mark_sold(msg: types.Message):
     if msg.from_user.id != ADMIN_ID:
         return
-    parts = msg.text.strip().split()
-    if len(parts) not in (2, 3) or not parts[1].isdigit():
-        bot.reply_to(msg, "الاستخدام: /mark_sold <listing_id> [order_seq]")
-        return
-    listing_id = int(parts[1])
-    update_listing_status(listing_id, "sold")
-    bot.reply_to(msg, f"🏁 تم وسم الإعلان {listing_id} كمباع.")
+    apply_bulk_status(msg, "mark_sold", "sold", "🏁 تم وسم كمباع", extra_usage="[order_seq]", order_seq=True)
 
 # =========================[ أزرار الشراء (Inline) ]===================
 @bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("buy_"))
@@ -694,523 +3007,874 @@ def on_buy_now(call: types.CallbackQuery):
     try:
         listing_id = int(call.data.split("_", 1)[1])
     except:
-        bot.answer_callback_query(call.id, "خطأ في معرف الإعلان.")
+        outbox.answer_callback_query(call.id, "خطأ في معرف الإعلان.")
         return
 
     listing = get_listing_by_id(listing_id)
     if not listing or listing["status"] != "active":
-        bot.answer_callback_query(call.id, "العرض غير متاح.")
+        outbox.answer_callback_query(call.id, "العرض غير متاح.")
         return
 
+    prev = user_states.get(uid) or {}
     user_states[uid] = {
         "flow": "buy",
         "step": "choose_payment",
-        "listing_id": listing_id
+        "listing_id": listing_id,
+        "browse": prev.get("browse"),   # حتى تبقى أزرار التالي/السابق في صفحة التصفح صالحة
     }
-    bot.send_message(call.message.chat.id, "💳 اختر طريقة الدفع:", reply_markup=payment_methods_kb(multi=False))
-    bot.answer_callback_query(call.id, "اختر طريقة الدفع.")
+    outbox.send_message(call.message.chat.id, "💳 اختر طريقة الدفع:", reply_markup=payment_methods_kb(multi=False))
+    outbox.answer_callback_query(call.id, "اختر طريقة الدفع.")
 
-# =====================[ استقبال الصور (إثبات/صور عرض) ]================
-@bot.message_handler(content_types=["photo"])
-def on_photo(msg: types.Message):
-    uid = msg.from_user.id
-    state = user_states.get(uid)
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("photos_"))
+def on_all_photos(call: types.CallbackQuery):
+    try:
+        listing_id = int(call.data.split("_", 1)[1])
+    except ValueError:
+        outbox.answer_callback_query(call.id, "خطأ في معرف الإعلان.")
+        return
+
+    listing = get_listing_by_id(listing_id)
+    if not listing or listing["status"] != "active":
+        outbox.answer_callback_query(call.id, "العرض غير متاح.")
+        return
+
+    send_listing_media(call.message.chat.id, listing["images"], f"🖼 صور العرض {listing['tracking_code']}")
+    outbox.answer_callback_query(call.id)
+
+# =========================[ تصفح العروض (صفحات) ]=====================
+BROWSE_PAGE_SIZE = int(os.getenv("BROWSE_PAGE_SIZE", "5"))
+BROWSE_DESC_CHARS = 90
+
+def listing_caption(r) -> str:
+    return (
+        f"🔖 عرض للبيع\n"
+        f"SEQ: {r['seq']:03d}\n"
+        f"رمز: {r['tracking_code']}\n"
+        f"فئة: {r['category']}/{r['subcategory']}\n"
+        f"💰 السعر: {r['price']}\n\n"
+        f"{r['description']}"
+    )
 
-    if not state:
+def fetch_browse_page(browse: Dict[str, Any], before_id: Optional[int]=None,
+                      after_id: Optional[int]=None) -> Tuple[List[Dict[str, Any]], bool, bool]:
+    """يعيد (صفوف الصفحة، يوجد سابق، يوجد تالٍ) — نطلب صفاً إضافياً لمعرفة وجود المزيد."""
+    rows = get_active_listings_by_cat_sub(browse["category"], browse["subcategory"],
+                                          limit=BROWSE_PAGE_SIZE + 1, before_id=before_id, after_id=after_id,
+                                          pay_method=browse.get("pay"), sort=browse.get("sort") or "new",
+                                          max_price=browse.get("max"))
+    more = len(rows) > BROWSE_PAGE_SIZE
+    if after_id is not None:
+        if not rows:
+            # لا شيء أحدث (حُذف ما كان قبلها) — نعود للصفحة الأولى
+            return fetch_browse_page(browse)
+        return rows[-BROWSE_PAGE_SIZE:], more, True
+    return rows[:BROWSE_PAGE_SIZE], before_id is not None, more
+
+def browse_title(browse: Dict[str, Any]) -> str:
+    if browse.get("kind") == "search":
+        title = f"🔎 <b>نتائج البحث عن: {html.escape(browse['q'])}</b>"
+    else:
+        title = f"🔖 <b>عروض {html.escape(browse['category'])} / {html.escape(browse['subcategory'])}</b>"
+    if browse.get("pay"):
+        title += f"\n💳 تقبل: {html.escape(method_display_short(browse['pay']))}"
+    if browse.get("max"):
+        amount, currency = browse["max"]
+        title += f"\n💵 حتى {format_amount(amount)} {currency}"
+    if browse.get("sort") == "price":
+        title += "\n↕️ مرتبة حسب السعر (الأرخص أولاً)"
+    return title
+
+def browse_page_text(browse: Dict[str, Any], rows: List[Dict[str, Any]]) -> str:
+    lines = [browse_title(browse)]
+    for r in rows:
+        desc = (r["description"] or "").replace("\n", " ")
+        if len(desc) > BROWSE_DESC_CHARS:
+            desc = desc[:BROWSE_DESC_CHARS].rstrip() + "…"
+        n_images = len(r["images"])
+        lines.append(
+            f"\n<b>#{r['seq']:03d}</b> | 💰 {html.escape(r['price'] or '-')}" + (f" | 🖼 {n_images}" if n_images else "") +
+            f"\n{html.escape(desc)}"
+        )
+    return "\n".join(lines)
+
+def browse_page_kb(browse: Dict[str, Any], rows: List[Dict[str, Any]],
+                   prev_data: Optional[str], next_data: Optional[str]) -> types.InlineKeyboardMarkup:
+    ikb = types.InlineKeyboardMarkup()
+    for r in rows:
+        ikb.row(
+            types.InlineKeyboardButton(f"📥 شراء #{r['seq']:03d}", callback_data=f"buy_{r['id']}"),
+            types.InlineKeyboardButton(f"ℹ️ تفاصيل #{r['seq']:03d}", callback_data=f"det_{r['id']}"),
+        )
+    nav = []
+    if prev_data:
+        nav.append(types.InlineKeyboardButton("⬅️ السابق", callback_data=prev_data))
+    if next_data:
+        nav.append(types.InlineKeyboardButton("التالي ➡️", callback_data=next_data))
+    if nav:
+        ikb.row(*nav)
+    tools = []
+    if browse.get("kind") != "search":
+        tools.append(types.InlineKeyboardButton("🆕 الأحدث أولاً", callback_data="bs_new")
+                     if browse.get("sort") == "price" else
+                     types.InlineKeyboardButton("⬆️ الأرخص أولاً", callback_data="bs_price"))
+    tools.append(types.InlineKeyboardButton("💵 حد أقصى للسعر", callback_data="bmax"))
+    ikb.row(*tools)
+    pay = browse.get("pay")
+    ikb.row(types.InlineKeyboardButton(
+        f"💳 الدفع: {method_display_short(pay)}" if pay else "💳 تصفية حسب طريقة الدفع", callback_data="pfm"))
+    return ikb
+
+def pay_filter_kb() -> types.InlineKeyboardMarkup:
+    ikb = types.InlineKeyboardMarkup()
+    for key in PAYMENT_LABELS:
+        ikb.row(types.InlineKeyboardButton(method_display_short(key), callback_data=f"pf_{key}"))
+    ikb.row(types.InlineKeyboardButton("✖️ كل الطرق", callback_data="pf_*"))
+    return ikb
+
+def _send_page(chat_id: int, text: str, kb: types.InlineKeyboardMarkup, message_id: Optional[int]):
+    if message_id:
+        outbox.edit_message_text(chat_id, message_id, text, reply_markup=kb)
+    else:
+        outbox.send_message(chat_id, text, reply_markup=kb)
+
+def show_browse_page(chat_id: int, browse: Dict[str, Any], before_id: Optional[int]=None,
+                     after_id: Optional[int]=None, message_id: Optional[int]=None) -> bool:
+    """يرسل صفحة تصفح (أو يعدّل رسالة الصفحة الحالية عند التنقل). يعيد False إن لم توجد عروض."""
+    rows, has_prev, has_next = fetch_browse_page(browse, before_id, after_id)
+    if not rows:
+        return False
+    kb = browse_page_kb(browse, rows,
+                        f"pg_p_{rows[0]['id']}" if has_prev else None,
+                        f"pg_n_{rows[-1]['id']}" if has_next else None)
+    _send_page(chat_id, browse_page_text(browse, rows), kb, message_id)
+    return True
+
+def show_search_page(chat_id: int, browse: Dict[str, Any], offset: int=0, message_id: Optional[int]=None) -> bool:
+    """صفحة من نتائج البحث النصي؛ الترتيب حسب الصلة لذا يكون الترقيم بالإزاحة (OFFSET)."""
+    rows = search_active_listings(browse["q"], limit=BROWSE_PAGE_SIZE + 1, offset=offset,
+                                  pay_method=browse.get("pay"), max_price=browse.get("max"))
+    if not rows:
+        return False
+    has_next = len(rows) > BROWSE_PAGE_SIZE
+    rows = rows[:BROWSE_PAGE_SIZE]
+    kb = browse_page_kb(browse, rows,
+                        f"sr_{max(0, offset - BROWSE_PAGE_SIZE)}" if offset > 0 else None,
+                        f"sr_{offset + BROWSE_PAGE_SIZE}" if has_next else None)
+    _send_page(chat_id, browse_page_text(browse, rows), kb, message_id)
+    return True
+
+def run_search(msg: types.Message, state: Dict[str, Any], query: str):
+    """ينفّذ بحثاً جديداً ويُبقي المستخدم في خطوة البحث ليكتب استعلاماً آخر."""
+    state["flow"] = "buy"
+    state["step"] = "search_query"
+    state["browse"] = {"kind": "search", "q": query[:100]}
+    if not show_search_page(msg.chat.id, state["browse"]):
+        outbox.send_message(msg.chat.id, "لا توجد نتائج مطابقة. جرّب كلمات أخرى أو اضغط رجوع.",
+                            reply_markup=back_only_kb())
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("sr_"))
+def on_search_page(call: types.CallbackQuery):
+    state = user_states.get(call.from_user.id) or {}
+    browse = state.get("browse")
+    if not browse or browse.get("kind") != "search":
+        outbox.answer_callback_query(call.id, "انتهت صلاحية البحث. ابحث من جديد.")
+        return
+    try:
+        offset = max(0, int(call.data.split("_", 1)[1]))
+    except ValueError:
+        outbox.answer_callback_query(call.id)
+        return
+    shown = show_search_page(call.message.chat.id, browse, offset, message_id=call.message.message_id)
+    outbox.answer_callback_query(call.id, None if shown else "لا توجد نتائج أخرى.")
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("pg_"))
+def on_browse_page(call: types.CallbackQuery):
+    state = user_states.get(call.from_user.id) or {}
+    browse = state.get("browse")
+    if not browse or browse.get("kind") == "search":
+        outbox.answer_callback_query(call.id, "انتهت صلاحية التصفح. اختر الفئة من جديد.")
+        return
+    try:
+        _, direction, cursor = call.data.split("_", 2)
+        cursor = int(cursor)
+    except ValueError:
+        outbox.answer_callback_query(call.id)
         return
 
-    # صور مسار البيع
-    if state.get("flow") == "sell" and state.get("step") == "photos":
-        file_id = msg.photo[-1].file_id
-        imgs = state.get("images", [])
-        imgs.append(file_id)
-        state["images"] = imgs
-        user_states[uid] = state
-        bot.reply_to(msg, "✅ تم حفظ الصورة. أرسل المزيد أو اكتب <b>تم</b> للمتابعة.")
+    if direction == "n":
+        shown = show_browse_page(call.message.chat.id, browse, before_id=cursor, message_id=call.message.message_id)
+    else:
+        shown = show_browse_page(call.message.chat.id, browse, after_id=cursor, message_id=call.message.message_id)
+    outbox.answer_callback_query(call.id, None if shown else "لا توجد عروض أخرى.")
+
+@bot.callback_query_handler(func=lambda call: call.data == "pfm")
+def on_pay_filter_menu(call: types.CallbackQuery):
+    state = user_states.get(call.from_user.id) or {}
+    if not state.get("browse"):
+        outbox.answer_callback_query(call.id, "انتهت صلاحية التصفح. اختر الفئة من جديد.")
+        return
+    outbox.edit_message_text(call.message.chat.id, call.message.message_id,
+                             "💳 اعرض فقط العروض التي تقبل:", reply_markup=pay_filter_kb())
+    outbox.answer_callback_query(call.id)
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("pf_"))
+def on_pay_filter(call: types.CallbackQuery):
+    """يضبط تصفية طريقة الدفع على التصفح/البحث الحالي ويعرض الصفحة الأولى من جديد."""
+    state = user_states.get(call.from_user.id) or {}
+    browse = state.get("browse")
+    if not browse:
+        outbox.answer_callback_query(call.id, "انتهت صلاحية التصفح. اختر الفئة من جديد.")
+        return
+    key = call.data.split("_", 1)[1]
+    if key != "*" and key not in PAYMENT_LABELS:
+        outbox.answer_callback_query(call.id)
+        return
+    browse["pay"] = None if key == "*" else key
+    chat_id, message_id = call.message.chat.id, call.message.message_id
+    if browse.get("kind") == "search":
+        shown = show_search_page(chat_id, browse, message_id=message_id)
+    else:
+        shown = show_browse_page(chat_id, browse, message_id=message_id)
+    outbox.answer_callback_query(call.id, None if shown else "لا توجد عروض تقبل هذه الطريقة.")
+
+@bot.callback_query_handler(func=lambda call: call.data in ("bs_new", "bs_price"))
+def on_browse_sort(call: types.CallbackQuery):
+    state = user_states.get(call.from_user.id) or {}
+    browse = state.get("browse")
+    if not browse or browse.get("kind") == "search":
+        outbox.answer_callback_query(call.id, "انتهت صلاحية التصفح. اختر الفئة من جديد.")
+        return
+    browse["sort"] = call.data[3:]
+    shown = show_browse_page(call.message.chat.id, browse, message_id=call.message.message_id)
+    outbox.answer_callback_query(call.id, None if shown else "لا توجد عروض بسعر محدد.")
+
+@bot.callback_query_handler(func=lambda call: call.data == "bmax")
+def on_browse_max_price(call: types.CallbackQuery):
+    state = user_states.get(call.from_user.id) or {}
+    if state.get("flow") != "buy" or not state.get("browse"):
+        outbox.answer_callback_query(call.id, "انتهت صلاحية التصفح. اختر الفئة من جديد.")
+        return
+    if state.get("step") != "max_price":
+        state["return_step"] = state.get("step")
+    state["step"] = "max_price"
+    outbox.send_message(call.message.chat.id,
+                        "💵 اكتب أعلى سعر مع العملة (مثال: 50 USDT أو 100000 SYP).\nأرسل 0 لإلغاء الحد.",
+                        reply_markup=back_only_kb())
+    outbox.answer_callback_query(call.id)
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith("det_"))
+def on_listing_details(call: types.CallbackQuery):
+    try:
+        listing_id = int(call.data.split("_", 1)[1])
+    except ValueError:
+        outbox.answer_callback_query(call.id, "خطأ في معرف الإعلان.")
         return
 
-    # إثبات دفع المشتري
-    if state.get("flow") == "buy" and state.get("step") == "await_payment_proof":
-        file_id = msg.photo[-1].file_id
-        state["payment_proof_file_id"] = file_id
-        state["step"] = "await_buyer_contact"
-        user_states[uid] = state
-        bot.send_message(msg.chat.id, "✅ تم استلام إثبات الدفع.\nالآن أرسل <b>وسيلة تواصل</b> بك (بريد إلكتروني أو رقم واتساب أو @يوزر تلغرام).")
+    listing = get_listing_by_id(listing_id)
+    if not listing or listing["status"] != "active":
+        outbox.answer_callback_query(call.id, "العرض غير متاح.")
         return
 
+    ikb = types.InlineKeyboardMarkup()
+    ikb.add(types.InlineKeyboardButton("📥 شراء الآن", callback_data=f"buy_{listing['id']}"))
+    send_listing_media(call.message.chat.id, listing["images"], listing_caption(listing), reply_markup=ikb)
+    outbox.answer_callback_query(call.id)
+
+# =========================[ جداول التوجيه ]===========================
+class Router:
+    """
+    توجيه تصريحي بدل سلاسل if: نص الزر -> معالج، ولكل مسار جدول {step: معالج}،
+    فيكون الإرسال O(1). الجداول مكشوفة (buttons / flows / photo_steps) للفحص،
+    وكل معالج يُقاس زمنه تحت مفتاح (flow, step) — راجع stats().
+    """
+    def __init__(self):
+        self.buttons: Dict[str, Dict[str, Callable]] = {}           # scope -> {نص الزر: fn(msg, state)}
+        self.flows: Dict[str, Dict[str, Callable]] = {}             # flow -> {step: fn(msg, state)}
+        self.photo_steps: Dict[Tuple[str, str], Callable] = {}      # (flow, step) -> fn(msg, state)
+        self.back_steps: set = set()                                # (flow, step) تعالج BACK_BTN بنفسها
+        self._timings: Dict[Tuple[str, str], List[float]] = {}      # (flow, step) -> [count, total, max]
+        self._lock = threading.Lock()
+
+    # ---------- التسجيل ----------
+    def button(self, scope: str, *texts: str):
+        def deco(fn):
+            for t in texts:
+                self.buttons.setdefault(scope, {})[t] = fn
+            return fn
+        return deco
+
+    def step(self, flow: str, *steps: str, handles_back: bool = False):
+        """handles_back=True: زر الرجوع يصل إلى الخطوة (رجوع داخل المسار) بدل زر القائمة الرئيسية."""
+        def deco(fn):
+            for s in steps:
+                self.flows.setdefault(flow, {})[s] = fn
+                if handles_back:
+                    self.back_steps.add((flow, s))
+            return fn
+        return deco
+
+    def photo(self, flow: str, step: str):
+        def deco(fn):
+            self.photo_steps[(flow, step)] = fn
+            return fn
+        return deco
+
+    # ---------- الإرسال ----------
+    def press(self, scope: str, msg: types.Message, state: Optional[Dict[str, Any]]) -> bool:
+        text = (msg.text or "").strip()
+        fn = self.buttons.get(scope, {}).get(text)
+        if fn is None:
+            return False
+        self.run(scope, text, fn, msg, state)
+        return True
+
+    def handles_back(self, msg: types.Message, state: Optional[Dict[str, Any]]) -> bool:
+        return (bool(state) and (msg.text or "").strip() == BACK_BTN
+                and (state.get("flow"), state.get("step")) in self.back_steps)
+
+    def dispatch(self, msg: types.Message, state: Optional[Dict[str, Any]]) -> bool:
+        if not state:
+            return False
+        steps = self.flows.get(state.get("flow"))
+        if steps is None:
+            return False
+        fn = steps.get(state.get("step"))
+        # خطوة لا تنتظر نصاً (مثل انتظار صورة) تبتلع الرسالة بصمت كما كانت سلاسل if
+        if fn is not None:
+            self.run(state["flow"], state["step"], fn, msg, state)
+        return True
+
+    def dispatch_photo(self, msg: types.Message, state: Optional[Dict[str, Any]]) -> bool:
+        if not state:
+            return False
+        fn = self.photo_steps.get((state.get("flow"), state.get("step")))
+        if fn is None:
+            return False
+        self.run(state["flow"], state["step"], fn, msg, state)
+        return True
+
+    def run(self, flow: str, step: str, fn: Callable, *args):
+        t0 = time.perf_counter()
+        try:
+            fn(*args)
+        finally:
+            self._record(flow, step, time.perf_counter() - t0)
+
+    def _record(self, flow: str, step: str, elapsed: float):
+        M_HANDLER_SECONDS.observe((flow, step), elapsed)
+        with self._lock:
+            t = self._timings.get((flow, step))
+            if t is None:
+                self._timings[(flow, step)] = [1, elapsed, elapsed]
+            else:
+                t[0] += 1
+                t[1] += elapsed
+                t[2] = max(t[2], elapsed)
+
+    def stats(self) -> Dict[Tuple[str, str], Dict[str, float]]:
+        with self._lock:
+            return {k: {"count": v[0], "avg_ms": v[1] / v[0] * 1000, "max_ms": v[2] * 1000}
+                    for k, v in self._timings.items()}
+
+router = Router()
+
+def _text(msg: types.Message) -> str:
+    return (msg.text or "").strip()
+
+# =====================[ استقبال الصور (إثبات/صور عرض) ]================
+@bot.message_handler(content_types=["photo"])
+def on_photo(msg: types.Message):
+    router.dispatch_photo(msg, user_states.get(msg.from_user.id))
+
+# صور مسار البيع
+@router.photo("sell", "photos")
+def sell_photo_received(msg: types.Message, state: Dict[str, Any]):
+    file_id = msg.photo[-1].file_id
+    imgs = state.get("images", [])
+    imgs.append(file_id)
+    state["images"] = imgs
+    user_states[msg.from_user.id] = state
+    outbox.reply_to(msg, "✅ تم حفظ الصورة. أرسل المزيد أو اكتب <b>تم</b> للمتابعة.")
+
+# إثبات دفع المشتري
+@router.photo("buy", "await_payment_proof")
+def buy_payment_proof_received(msg: types.Message, state: Dict[str, Any]):
+    file_id = msg.photo[-1].file_id
+    state["payment_proof_file_id"] = file_id
+    state["step"] = "await_buyer_contact"
+    user_states[msg.from_user.id] = state
+    outbox.send_message(msg.chat.id, "✅ تم استلام إثبات الدفع.\nالآن أرسل <b>وسيلة تواصل</b> بك (بريد إلكتروني أو رقم واتساب أو @يوزر تلغرام).")
+
 # =====================[ الموجّه العام للنصوص ]========================
 @bot.message_handler(func=lambda m: True, content_types=["text"])
 def on_text(msg: types.Message):
-    text = (msg.text or "").strip()
-    uid  = msg.from_user.id
+    uid = msg.from_user.id
     state = user_states.get(uid)
 
     # -------- ضمن تدفق إدمن تفاعلي ----------
     if state and state.get("flow") == "admin":
-        handle_admin_flow(msg, state)
+        if uid != ADMIN_ID:
+            reset_state(uid)
+            return
+        router.dispatch(msg, state)
         return
 
-    # --------- / رجوع عام ---------
-    if text == BACK_BTN:
-        reset_state(uid)
-        bot.send_message(msg.chat.id, "عدنا إلى القائمة الرئيسية.", reply_markup=main_menu_kb())
+    # --------- خطوات ترجع داخل مسارها (قبل زر الرجوع العام الذي يمسح الحالة) ----------
+    if router.handles_back(msg, state) and router.dispatch(msg, state):
         return
 
-    # --------- القوائم الرئيسية ----------
-    if text == "📄 شروط الخدمة":
-        bot.send_message(msg.chat.id, TERMS_TEXT, reply_markup=main_menu_kb())
+    # --------- أزرار القائمة الرئيسية (لها الأولوية على أي مسار جارٍ) ----------
+    if router.press("main", msg, state):
         return
 
-    if text == "☎️ تواصل مع الدعم":
-        user_states[uid] = {"flow": "support", "step": "await_message"}
-        bot.send_message(msg.chat.id, SUPPORT_HOWTO, reply_markup=types.ReplyKeyboardMarkup(resize_keyboard=True).row(BACK_BTN))
+    # --------- المسارات (بيع / شراء / دعم) ----------
+    if router.dispatch(msg, state):
         return
 
-    if state and state.get("flow") == "support":
-        if text == "إلغاء":
-            reset_state(uid)
-            bot.send_message(msg.chat.id, "تم الإلغاء.", reply_markup=main_menu_kb())
-            return
-        # حفظ تذكرة
-        conn = db_conn()
-        c = conn.cursor()
-        c.execute("INSERT INTO support_tickets (user_telegram_id, message, created_at) VALUES (?,?,?)",
-                  (uid, text, now_utc_str()))
-        conn.commit()
-        conn.close()
-        bot.send_message(msg.chat.id, "✅ تم استلام طلب الدعم. سنرد عليك قريباً.", reply_markup=main_menu_kb())
-        bot.send_message(ADMIN_ID, f"رسالة دعم من {uid}:\n{text}")
-        reset_state(uid)
-        return
+    # أي كتابة خارج المسارات
+    outbox.send_message(msg.chat.id, "أهلاً — استخدم الأزرار أسفل لوحة المفاتيح للبدء أو اكتب /start للعودة.", reply_markup=main_menu_kb())
 
-    if text == "📤 بيع حساب":
-        ensure_user(msg.from_user)
-        user_states[uid] = {"flow": "sell", "step": "choose_category"}
-        bot.send_message(msg.chat.id, "اختر الفئة:", reply_markup=sell_category_kb())
-        return
+# ------------------------ القائمة الرئيسية ------------------------
+@router.button("main", BACK_BTN)
+def menu_back(msg: types.Message, state):
+    reset_state(msg.from_user.id)
+    outbox.send_message(msg.chat.id, "عدنا إلى القائمة الرئيسية.", reply_markup=main_menu_kb())
 
-    if text == "📥 شراء حساب":
-        ensure_user(msg.from_user)
-        user_states[uid] = {"flow": "buy", "step": "choose_category"}
-        bot.send_message(msg.chat.id, "🔍 اختر فئة العروض:", reply_markup=buy_flow_kb())
-        return
+@router.button("main", "📄 شروط الخدمة")
+def menu_terms(msg: types.Message, state):
+    outbox.send_message(msg.chat.id, TERMS_TEXT, reply_markup=main_menu_kb())
 
-    if text == "👤 حساباتي":
-        ensure_user(msg.from_user)
-        show_my_items(msg)
-        return
+@router.button("main", "☎️ تواصل مع الدعم")
+def menu_support(msg: types.Message, state):
+    user_states[msg.from_user.id] = {"flow": "support", "step": "await_message"}
+    outbox.send_message(msg.chat.id, SUPPORT_HOWTO, reply_markup=back_only_kb())
 
-    # --------- مسار البيع ----------
-    if state and state.get("flow") == "sell":
-        handle_sell_flow(msg, state)
-        return
+@router.button("main", "📤 بيع حساب")
+def menu_sell(msg: types.Message, state):
+    ensure_user(msg.from_user)
+    user_states[msg.from_user.id] = {"flow": "sell", "step": "choose_category"}
+    outbox.send_message(msg.chat.id, "اختر الفئة:", reply_markup=sell_category_kb())
 
-    # --------- مسار الشراء ----------
-    if state and state.get("flow") == "buy":
-        handle_buy_flow(msg, state)
-        return
+@router.button("main", "📥 شراء حساب")
+def menu_buy(msg: types.Message, state):
+    ensure_user(msg.from_user)
+    user_states[msg.from_user.id] = {"flow": "buy", "step": "choose_category"}
+    outbox.send_message(msg.chat.id, "🔍 اختر فئة العروض:", reply_markup=buy_flow_kb())
 
-    # أي كتابة خارج المسارات
-    bot.send_message(msg.chat.id, "أهلاً — استخدم الأزرار أسفل لوحة المفاتيح للبدء أو اكتب /start للعودة.", reply_markup=main_menu_kb())
+@router.button("main", "👤 حساباتي")
+def menu_my_items(msg: types.Message, state):
+    ensure_user(msg.from_user)
+    show_my_items(msg)
 
 # =========================[ دوال المسارات ]===========================
-def handle_sell_flow(msg: types.Message, state: Dict[str, Any]):
+# ------------------------------ الدعم ------------------------------
+@router.step("support", "await_message")
+def support_message(msg: types.Message, state: Dict[str, Any]):
     uid = msg.from_user.id
-    text = (msg.text or "").strip()
-
-    step = state.get("step")
-    # 1) اختيار الفئة
-    if step == "choose_category":
-        if text == "📱 تواصل اجتماعي":
-            state["category"] = "social"
-            state["step"] = "choose_sub"
-            bot.send_message(msg.chat.id, "اختر المنصة:", reply_markup=social_sub_kb())
-            return
-        elif text == "🎮 ألعاب":
-            state["category"] = "games"
-            state["step"] = "choose_sub"
-            bot.send_message(msg.chat.id, "اختر اللعبة:", reply_markup=games_sub_kb())
-            return
-        elif text == "✏️ غير ذلك":
-            state["category"] = "other"
-            state["subcategory"] = "Other"
-            state["step"] = "desc"
-            bot.send_message(msg.chat.id, "✏️ أرسل وصف الحساب بالتفصيل:", reply_markup=types.ReplyKeyboardRemove())
-            return
-        else:
-            bot.send_message(msg.chat.id, "اختر من الأزرار.", reply_markup=sell_category_kb())
-            return
+    text = _text(msg)
+    if text == "إلغاء":
+        reset_state(uid)
+        outbox.send_message(msg.chat.id, "تم الإلغاء.", reply_markup=main_menu_kb())
+        return
+    # حفظ تذكرة (غير حرج: عبر الكاتب المؤجل حتى لا ينتظر المعالج الـ commit)
+    write_behind.submit("INSERT INTO support_tickets (user_telegram_id, message, created_at) VALUES (?,?,?)",
+                        (uid, text, now_utc_str()))
+    outbox.send_message(msg.chat.id, "✅ تم استلام طلب الدعم. سنرد عليك قريباً.", reply_markup=main_menu_kb())
+    outbox.send_message(ADMIN_ID, f"رسالة دعم من {uid}:\n{text}")
+    reset_state(uid)
+
+# ------------------------------ البيع ------------------------------
+# زر الفئة -> (المفتاح الداخلي، نص السؤال التالي، لوحة المنصات) — None = بلا منصات (غير ذلك)
+SELL_CATEGORIES = {
+    "📱 تواصل اجتماعي": ("social", "اختر المنصة:", social_sub_kb),
+    "🎮 ألعاب":         ("games", "اختر اللعبة:", games_sub_kb),
+    "✏️ غير ذلك":       ("other", None, None),
+}
 
-    # 2) اختيار المنصة/اللعبة
-    if step == "choose_sub":
-        if text == BACK_BTN:
-            state["step"] = "choose_category"
-            bot.send_message(msg.chat.id, "رجعناك لاختيار الفئة:", reply_markup=sell_category_kb())
-            return
-        state["subcategory"] = text
+# 1) اختيار الفئة
+@router.step("sell", "choose_category")
+def sell_choose_category(msg: types.Message, state: Dict[str, Any]):
+    choice = SELL_CATEGORIES.get(_text(msg))
+    if choice is None:
+        outbox.send_message(msg.chat.id, "اختر من الأزرار.", reply_markup=sell_category_kb())
+        return
+    category, prompt, sub_kb = choice
+    state["category"] = category
+    if sub_kb is None:
+        state["subcategory"] = "Other"
         state["step"] = "desc"
-        bot.send_message(msg.chat.id, "✏️ أرسل وصف الحساب بالتفصيل:", reply_markup=types.ReplyKeyboardRemove())
+        outbox.send_message(msg.chat.id, "✏️ أرسل وصف الحساب بالتفصيل:", reply_markup=remove_kb())
         return
+    state["step"] = "choose_sub"
+    outbox.send_message(msg.chat.id, prompt, reply_markup=sub_kb())
 
-    # 3) الوصف
-    if step == "desc":
-        state["description"] = text
-        state["images"] = []
-        state["step"] = "photos"
-        bot.send_message(msg.chat.id, "📸 أرسل صورة واحدة على الأقل (ملف/صورة تيليجرام). عند الانتهاء اكتب <b>تم</b>.")
+# 2) اختيار المنصة/اللعبة
+@router.step("sell", "choose_sub")
+def sell_choose_sub(msg: types.Message, state: Dict[str, Any]):
+    text = _text(msg)
+    if text == BACK_BTN:
+        state["step"] = "choose_category"
+        outbox.send_message(msg.chat.id, "رجعناك لاختيار الفئة:", reply_markup=sell_category_kb())
         return
-
-    # 4) استقبال صور أو كلمة "تم" ضمن on_photo؛ هنا نعالج كلمة تم
-    if step == "photos":
-        if text.lower() in ("تم", "done"):
-            imgs = state.get("images", [])
-            if not imgs:
-                bot.send_message(msg.chat.id, "⚠️ أرسل صورة واحدة على الأقل ثم اكتب <b>تم</b>.")
-                return
-            state["step"] = "price"
-            # ⬇️ تنبيه العمولة 5%
-            bot.send_message(
-                msg.chat.id,
-                "💰 اكتب السعر المطلوب (مثال: 25 USDT أو 1000 SYP).\n"
-                "⚠️ <b>تنبيه:</b> عمولة البوت <b>5%</b> تُخصم عند إتمام البيع."
-            )
-            return
-        else:
-            bot.send_message(msg.chat.id, "أرسل الصور ثم اكتب <b>تم</b> للمتابعة.")
-            return
-
-    # 5) السعر
-    if step == "price":
-        state["price"] = text
-        state["payments"] = []
-        state["payment_details"] = {}
-        state["step"] = "payments"
-        bot.send_message(
-            msg.chat.id,
-            "💵 اختر طرق الاستلام التي تقبلها (يمكن عدة طرق) ثم اضغط <b>✅ انتهيت</b>.",
-            reply_markup=payment_methods_kb(multi=True)
-        )
+    state["subcategory"] = text
+    state["step"] = "desc"
+    outbox.send_message(msg.chat.id, "✏️ أرسل وصف الحساب بالتفصيل:", reply_markup=remove_kb())
+
+# 3) الوصف
+@router.step("sell", "desc")
+def sell_description(msg: types.Message, state: Dict[str, Any]):
+    state["description"] = _text(msg)
+    state["images"] = []
+    state["step"] = "photos"
+    outbox.send_message(msg.chat.id, "📸 أرسل صورة واحدة على الأقل (ملف/صورة تيليجرام). عند الانتهاء اكتب <b>تم</b>.")
+
+# 4) استقبال صور أو كلمة "تم" ضمن on_photo؛ هنا نعالج كلمة تم
+@router.step("sell", "photos")
+def sell_photos_done(msg: types.Message, state: Dict[str, Any]):
+    if _text(msg).lower() not in ("تم", "done"):
+        outbox.send_message(msg.chat.id, "أرسل الصور ثم اكتب <b>تم</b> للمتابعة.")
         return
+    imgs = state.get("images", [])
+    if not imgs:
+        outbox.send_message(msg.chat.id, "⚠️ أرسل صورة واحدة على الأقل ثم اكتب <b>تم</b>.")
+        return
+    state["step"] = "price"
+    # ⬇️ تنبيه العمولة 5%
+    outbox.send_message(
+        msg.chat.id,
+        "💰 اكتب السعر المطلوب (مثال: 25 USDT أو 1000 SYP).\n"
+        "⚠️ <b>تنبيه:</b> عمولة البوت <b>5%</b> تُخصم عند إتمام البيع."
+    )
 
-    # 6) اختيار طرق الدفع (متعددة)
-    if step == "payments":
-        if text == CANCEL_BTN:
-            reset_state(uid)
-            bot.send_message(msg.chat.id, "تم الإلغاء.", reply_markup=main_menu_kb())
-            return
-        if text == DONE_BTN:
-            if not state.get("payments"):
-                bot.send_message(msg.chat.id, "اختر طريقة دفع واحدة على الأقل ثم اضغط <b>✅ انتهيت</b>.")
-                return
-            state["step"] = "seller_contact"
-            bot.send_message(msg.chat.id, "📞 أرسل وسيلة تواصل بك (بريد/واتساب/@يوزر) ليتمكن الإدمن من التواصل:")
-            return
-
-        method_key = parse_payment_selection(text)
-        if method_key:
-            if method_key not in state["payments"]:
-                state["payments"].append(method_key)
-            state["await_detail_method"] = method_key
-            state["step"] = "await_pay_detail"
-            prompt = "رقم الهاتف" if method_key in ("SyriaTel", "MTN", "Madfouati") else "عنوان المحفظة (USDT-TRC20)"
-            # عرض الملاحظة الخاصة بالطريقة عند طلب التفاصيل
-            note = MANAGER_PAYMENT_NOTE.get(method_key)
-            note_line = f"\n⚠️ ملاحظة: {note}" if note else ""
-            bot.send_message(msg.chat.id, f"✏️ أدخل {prompt} لطريقة <b>{method_display_short(method_key)}</b>{note_line}:")
-            return
-
-        bot.send_message(msg.chat.id, "اختر من الأزرار أو اضغط <b>✅ انتهيت</b> عند الانتهاء.", reply_markup=payment_methods_kb(multi=True))
+# 5) السعر
+@router.step("sell", "price")
+def sell_price(msg: types.Message, state: Dict[str, Any]):
+    price = _text(msg)
+    if not parse_price(price):
+        outbox.send_message(msg.chat.id, "⚠️ اكتب السعر كرقم مع العملة (مثال: 25 USDT أو 1000 SYP).")
         return
+    state["price"] = price
+    state["payments"] = []
+    state["payment_details"] = {}
+    state["step"] = "payments"
+    outbox.send_message(
+        msg.chat.id,
+        "💵 اختر طرق الاستلام التي تقبلها (يمكن عدة طرق) ثم اضغط <b>✅ انتهيت</b>.",
+        reply_markup=payment_methods_kb(multi=True)
+    )
 
-    if step == "await_pay_detail":
-        method = state.get("await_detail_method")
-        if not method:
-            state["step"] = "payments"
-            bot.send_message(msg.chat.id, "حالة غير متوقعة. عدنا لاختيار الطرق.", reply_markup=payment_methods_kb(multi=True))
+# 6) اختيار طرق الدفع (متعددة)
+@router.step("sell", "payments")
+def sell_payments(msg: types.Message, state: Dict[str, Any]):
+    text = _text(msg)
+    if text == CANCEL_BTN:
+        reset_state(msg.from_user.id)
+        outbox.send_message(msg.chat.id, "تم الإلغاء.", reply_markup=main_menu_kb())
+        return
+    if text == DONE_BTN:
+        if not state.get("payments"):
+            outbox.send_message(msg.chat.id, "اختر طريقة دفع واحدة على الأقل ثم اضغط <b>✅ انتهيت</b>.")
             return
-        value = text
-        pd = state.get("payment_details", {})
-        pd[method] = value
-        state["payment_details"] = pd
-        state["await_detail_method"] = None
-        state["step"] = "payments"
-        bot.send_message(
-            msg.chat.id,
-            f"✅ تم حفظ بيانات <b>{method_display_short(method)}</b>.\n"
-            f"يمكنك اختيار طرق أخرى أو اضغط <b>✅ انتهيت</b>.",
-            reply_markup=payment_methods_kb(multi=True)
-        )
+        state["step"] = "seller_contact"
+        outbox.send_message(msg.chat.id, "📞 أرسل وسيلة تواصل بك (بريد/واتساب/@يوزر) ليتمكن الإدمن من التواصل:")
         return
 
-    # 7) وسيلة تواصل البائع
-    if step == "seller_contact":
-        state["seller_contact"] = text
-        # إنشاء الإعلان وحفظه
-        try:
-            listing = create_listing(
-                seller_id=uid,
-                category=state["category"],
-                subcategory=state["subcategory"],
-                description=state["description"],
-                images=state.get("images", []),
-                price=state["price"],
-                pay_methods=state.get("payments", []),
-                pay_details=state.get("payment_details", {}),
-                seller_contact=state.get("seller_contact", ""),
-                status="active"
-            )
-            bot.send_message(
-                msg.chat.id,
-                f"✅ تم إنشاء إعلانك.\nرمز الإعلان: <code>{listing['tracking_code']}</code>\n"
-                "أرسل /start للعودة للقائمة.",
-                reply_markup=main_menu_kb()
-            )
-            notify_admin_new_listing(listing)
-        except Exception as e:
-            logging.exception("create listing failed: %s", e)
-            bot.send_message(msg.chat.id, "⚠️ حدث خطأ أثناء حفظ الإعلان. حاول لاحقاً.")
-        finally:
-            reset_state(uid)
+    method_key = parse_payment_selection(text)
+    if not method_key:
+        outbox.send_message(msg.chat.id, "اختر من الأزرار أو اضغط <b>✅ انتهيت</b> عند الانتهاء.", reply_markup=payment_methods_kb(multi=True))
+        return
+    if method_key not in state["payments"]:
+        state["payments"].append(method_key)
+    state["await_detail_method"] = method_key
+    state["step"] = "await_pay_detail"
+    prompt = "رقم الهاتف" if method_key in ("SyriaTel", "MTN", "Madfouati") else "عنوان المحفظة (USDT-TRC20)"
+    # عرض الملاحظة الخاصة بالطريقة عند طلب التفاصيل
+    note = MANAGER_PAYMENT_NOTE.get(method_key)
+    note_line = f"\n⚠️ ملاحظة: {note}" if note else ""
+    outbox.send_message(msg.chat.id, f"✏️ أدخل {prompt} لطريقة <b>{method_display_short(method_key)}</b>{note_line}:")
+
+@router.step("sell", "await_pay_detail")
+def sell_payment_detail(msg: types.Message, state: Dict[str, Any]):
+    method = state.get("await_detail_method")
+    if not method:
+        state["step"] = "payments"
+        outbox.send_message(msg.chat.id, "حالة غير متوقعة. عدنا لاختيار الطرق.", reply_markup=payment_methods_kb(multi=True))
         return
+    pd = state.get("payment_details", {})
+    pd[method] = _text(msg)
+    state["payment_details"] = pd
+    state["await_detail_method"] = None
+    state["step"] = "payments"
+    outbox.send_message(
+        msg.chat.id,
+        f"✅ تم حفظ بيانات <b>{method_display_short(method)}</b>.\n"
+        f"يمكنك اختيار طرق أخرى أو اضغط <b>✅ انتهيت</b>.",
+        reply_markup=payment_methods_kb(multi=True)
+    )
 
-def handle_buy_flow(msg: types.Message, state: Dict[str, Any]):
+# 7) وسيلة تواصل البائع
+@router.step("sell", "seller_contact")
+def sell_seller_contact(msg: types.Message, state: Dict[str, Any]):
     uid = msg.from_user.id
-    text = (msg.text or "").strip()
-    step = state.get("step")
-
-    # 1) اختيار الفئة
-    if step == "choose_category":
-        if text == "📱 تواصل اجتماعي":
-            state["category"] = "social"
-            state["step"] = "choose_sub"
-            bot.send_message(msg.chat.id, "اختر منصة الحساب الذي تريد شراءه:", reply_markup=social_sub_kb())
-            return
-        elif text == "🎮 ألعاب":
-            state["category"] = "games"
-            state["step"] = "choose_sub"
-            bot.send_message(msg.chat.id, "اختر اللعبة:", reply_markup=games_sub_kb())
-            return
-        elif text == "✏️ غير ذلك":
-            state["category"] = "other"
-            state["step"] = "choose_sub_other"
-            bot.send_message(msg.chat.id, "اكتب نوع الحساب المطلوب (كلمة واحدة أو جملة قصيرة):", reply_markup=types.ReplyKeyboardMarkup(resize_keyboard=True).row(BACK_BTN))
-            return
-        else:
-            bot.send_message(msg.chat.id, "اختر من الأزرار.", reply_markup=buy_flow_kb())
-            return
-
-    # 2) اختيار المنصة/اللعبة
-    if step == "choose_sub":
-        if text == BACK_BTN:
-            state["step"] = "choose_category"
-            bot.send_message(msg.chat.id, "اختر الفئة:", reply_markup=buy_flow_kb())
-            return
-        state["subcategory"] = text
-        # عرض العروض
-        rows = get_active_listings_by_cat_sub(state["category"], state["subcategory"])
-        if not rows:
-            bot.send_message(msg.chat.id, "لا توجد عروض حالياً لهذه الفئة/المنصة.", reply_markup=main_menu_kb())
-            reset_state(uid)
-            return
+    state["seller_contact"] = _text(msg)
+    # إنشاء الإعلان وحفظه
+    try:
+        listing = create_listing(
+            seller_id=uid,
+            category=state["category"],
+            subcategory=state["subcategory"],
+            description=state["description"],
+            images=state.get("images", []),
+            price=state["price"],
+            pay_methods=state.get("payments", []),
+            pay_details=state.get("payment_details", {}),
+            seller_contact=state.get("seller_contact", ""),
+            status="active"
+        )
+        outbox.send_message(
+            msg.chat.id,
+            f"✅ تم إنشاء إعلانك.\nرمز الإعلان: <code>{listing['tracking_code']}</code>\n"
+            "أرسل /start للعودة للقائمة.",
+            reply_markup=main_menu_kb()
+        )
+        notify_admin_new_listing(listing)
+    except Exception as e:
+        logging.exception("create listing failed: %s", e)
+        outbox.send_message(msg.chat.id, "⚠️ حدث خطأ أثناء حفظ الإعلان. حاول لاحقاً.")
+    finally:
+        reset_state(uid)
 
-        for r in rows:
-            caption = (
-                f"🔖 عرض للبيع\n"
-                f"SEQ: {r['seq']:03d}\n"
-                f"رمز: {r['tracking_code']}\n"
-                f"فئة: {r['category']}/{r['subcategory']}\n"
-                f"💰 السعر: {r['price']}\n\n"
-                f"{r['description']}"
-            )
-            images = json.loads(r["images_json"] or "[]")
-            ikb = types.InlineKeyboardMarkup()
-            ikb.add(types.InlineKeyboardButton("📥 شراء الآن", callback_data=f"buy_{r['id']}"))
-            try:
-                if images:
-                    bot.send_photo(msg.chat.id, images[0], caption=caption, reply_markup=ikb)
-                else:
-                    bot.send_message(msg.chat.id, caption, reply_markup=ikb)
-            except Exception:
-                bot.send_message(msg.chat.id, caption, reply_markup=ikb)
+# ------------------------------ الشراء ------------------------------
+# زر الفئة -> (المفتاح الداخلي، الخطوة التالية، نص السؤال، لوحة المنصات)
+BUY_CATEGORIES = {
+    "📱 تواصل اجتماعي": ("social", "choose_sub", "اختر منصة الحساب الذي تريد شراءه:", social_sub_kb),
+    "🎮 ألعاب":         ("games", "choose_sub", "اختر اللعبة:", games_sub_kb),
+    "🔎 بحث":           (None, "search_query", "🔎 اكتب ما تبحث عنه (اسم اللعبة، المستوى، المنصة...):", None),
+    "✏️ غير ذلك":       ("other", "choose_sub_other", "اكتب نوع الحساب المطلوب (كلمة واحدة أو جملة قصيرة):", None),
+}
 
+# 1) اختيار الفئة
+@router.step("buy", "choose_category")
+def buy_choose_category(msg: types.Message, state: Dict[str, Any]):
+    choice = BUY_CATEGORIES.get(_text(msg))
+    if choice is None:
+        outbox.send_message(msg.chat.id, "اختر من الأزرار.", reply_markup=buy_flow_kb())
         return
-
-    if step == "choose_sub_other":
-        if text == BACK_BTN:
-            state["step"] = "choose_category"
-            bot.send_message(msg.chat.id, "اختر الفئة:", reply_markup=buy_flow_kb())
-            return
-        bot.send_message(msg.chat.id, "حالياً لا توجد عروض لفئة 'غير ذلك' مفلترة. استخدم الفئات المحدّدة.", reply_markup=main_menu_kb())
+    category, next_step, prompt, sub_kb = choice
+    if category:
+        state["category"] = category
+    state["step"] = next_step
+    kb = sub_kb() if sub_kb else back_only_kb()
+    outbox.send_message(msg.chat.id, prompt, reply_markup=kb)
+
+# 2) اختيار المنصة/اللعبة
+@router.step("buy", "choose_sub")
+def buy_choose_sub(msg: types.Message, state: Dict[str, Any]):
+    text = _text(msg)
+    if text == BACK_BTN:
+        state["step"] = "choose_category"
+        outbox.send_message(msg.chat.id, "اختر الفئة:", reply_markup=buy_flow_kb())
+        return
+    state["subcategory"] = text
+    # عرض العروض: رسالة واحدة لكل صفحة بدلاً من رسالة لكل عرض
+    state["browse"] = {"kind": "cat", "category": state["category"], "subcategory": text}
+    if not show_browse_page(msg.chat.id, state["browse"]):
+        outbox.send_message(msg.chat.id, "لا توجد عروض حالياً لهذه الفئة/المنصة.", reply_markup=main_menu_kb())
+        reset_state(msg.from_user.id)
+
+# "غير ذلك" أو "🔎 بحث": النص المكتوب يصبح بحثاً نصياً في كل العروض النشطة
+@router.step("buy", "choose_sub_other", "search_query", handles_back=True)
+def buy_search_query(msg: types.Message, state: Dict[str, Any]):
+    text = _text(msg)
+    if text == BACK_BTN:
+        state["step"] = "choose_category"
+        outbox.send_message(msg.chat.id, "اختر الفئة:", reply_markup=buy_flow_kb())
+        return
+    run_search(msg, state, text)
+
+# حد أقصى للسعر على التصفح/البحث الحالي (من زر 💵 في صفحة العروض)
+@router.step("buy", "max_price", handles_back=True)
+def buy_max_price(msg: types.Message, state: Dict[str, Any]):
+    text = _text(msg)
+    browse = state.get("browse") or {}
+    state["step"] = state.pop("return_step", None) or "choose_sub"
+    if text == BACK_BTN:
+        # الحد لم يتغيّر والتصفح باقٍ: أزرار الصفحة المعروضة أعلاه ما زالت تعمل
+        outbox.send_message(msg.chat.id, "تم. استخدم أزرار صفحة العروض للمتابعة.", reply_markup=back_only_kb())
+        return
+    parsed = parse_price(text)
+    if not parsed:
+        state["return_step"], state["step"] = state["step"], "max_price"
+        outbox.send_message(msg.chat.id, "⚠️ اكتب رقماً مع العملة (مثال: 50 USDT) أو 0 لإلغاء الحد.")
+        return
+    browse["max"] = list(parsed) if parsed[0] > 0 else None
+    if browse.get("kind") == "search":
+        shown = show_search_page(msg.chat.id, browse)
+    else:
+        shown = show_browse_page(msg.chat.id, browse)
+    if not shown:
+        outbox.send_message(msg.chat.id, "لا توجد عروض ضمن هذا السعر. اضغط 💵 لتغيير الحد.",
+                            reply_markup=back_only_kb())
+
+# 3) اختيار طريقة الدفع
+@router.step("buy", "choose_payment")
+def buy_choose_payment(msg: types.Message, state: Dict[str, Any]):
+    uid = msg.from_user.id
+    text = _text(msg)
+    if text == BACK_BTN:
         reset_state(uid)
+        outbox.send_message(msg.chat.id, "ألغينا العملية.", reply_markup=main_menu_kb())
         return
 
-    # 3) اختيار طريقة الدفع
-    if step == "choose_payment":
-        if text == BACK_BTN:
-            reset_state(uid)
-            bot.send_message(msg.chat.id, "ألغينا العملية.", reply_markup=main_menu_kb())
-            return
-
-        method_key = parse_payment_selection(text)
-        if not method_key:
-            bot.send_message(msg.chat.id, "اختر طريقة صحيحة من الأزرار:", reply_markup=payment_methods_kb(multi=False))
-            return
-
-        state["payment_method"] = method_key
-        state["step"] = "await_payment_proof"
-        user_states[uid] = state
-
-        bot.send_message(
-            msg.chat.id,
-            f"📌 الطريقة: <b>{method_display_short(method_key)}</b>\n"
-            f"{get_manager_payment_text(method_key)}\n\n"
-            "بعد التحويل، أرسل <b>صورة</b> إثبات الدفع هنا."
-        )
+    method_key = parse_payment_selection(text)
+    if not method_key:
+        outbox.send_message(msg.chat.id, "اختر طريقة صحيحة من الأزرار:", reply_markup=payment_methods_kb(multi=False))
         return
 
-    # 4) بعد استقبال الصورة — نطلب وسيلة تواصل، ثم ننشئ الطلب في الخطوة التالية
-    if step == "await_buyer_contact":
-        contact = text
-        listing_id = state.get("listing_id")
-        method = state.get("payment_method")
-        proof = state.get("payment_proof_file_id")
+    state["payment_method"] = method_key
+    state["step"] = "await_payment_proof"
+    user_states[uid] = state
 
-        if not all([listing_id, method, proof]):
-            reset_state(uid)
-            bot.send_message(msg.chat.id, "حالة غير متوقعة. أعد المحاولة من جديد.", reply_markup=main_menu_kb())
-            return
-
-        try:
-            order = create_order(
-                listing_id=listing_id,
-                buyer_id=uid,
-                payment_method=method,
-                proof_file_id=proof,
-                buyer_contact=contact,
-                status="paid"
-            )
-            bot.send_message(msg.chat.id, f"✅ تم تسجيل طلبك.\nرقم الطلب: <code>{order['tracking_code']}</code>", reply_markup=main_menu_kb())
-            notify_admin_new_order(order)
-        except Exception as e:
-            logging.exception("create order failed: %s", e)
-            bot.send_message(msg.chat.id, "⚠️ حدث خطأ أثناء تسجيل الطلب. حاول لاحقاً.", reply_markup=main_menu_kb())
-        finally:
-            reset_state(uid)
-        return
+    outbox.send_message(
+        msg.chat.id,
+        f"📌 الطريقة: <b>{method_display_short(method_key)}</b>\n"
+        f"{get_manager_payment_text(method_key)}\n\n"
+        "بعد التحويل، أرسل <b>صورة</b> إثبات الدفع هنا."
+    )
 
-def handle_admin_flow(msg: types.Message, state: Dict[str, Any]):
+# 4) بعد استقبال الصورة — نطلب وسيلة تواصل، ثم ننشئ الطلب في الخطوة التالية
+@router.step("buy", "await_buyer_contact")
+def buy_buyer_contact(msg: types.Message, state: Dict[str, Any]):
     uid = msg.from_user.id
-    if uid != ADMIN_ID:
+    contact = _text(msg)
+    listing_id = state.get("listing_id")
+    method = state.get("payment_method")
+    proof = state.get("payment_proof_file_id")
+
+    if not all([listing_id, method, proof]):
         reset_state(uid)
+        outbox.send_message(msg.chat.id, "حالة غير متوقعة. أعد المحاولة من جديد.", reply_markup=main_menu_kb())
         return
 
-    text = (msg.text or "").strip()
-    step = state.get("step")
+    try:
+        order = create_order(
+            listing_id=listing_id,
+            buyer_id=uid,
+            payment_method=method,
+            proof_file_id=proof,
+            buyer_contact=contact,
+            status="paid"
+        )
+        outbox.send_message(msg.chat.id, f"✅ تم تسجيل طلبك.\nرقم الطلب: <code>{order['tracking_code']}</code>", reply_markup=main_menu_kb())
+        notify_admin_new_order(order)
+    except Exception as e:
+        logging.exception("create order failed: %s", e)
+        outbox.send_message(msg.chat.id, "⚠️ حدث خطأ أثناء تسجيل الطلب. حاول لاحقاً.", reply_markup=main_menu_kb())
+    finally:
+        reset_state(uid)
 
-    if step == "menu":
-        if text == BACK_BTN:
-            reset_state(uid)
-            bot.send_message(msg.chat.id, "خروج من لوحة التحكم.", reply_markup=main_menu_kb())
-            return
-        if text == "🔎 بحث عرض":
-            state["step"] = "await_find_listing_seq"
-            bot.send_message(msg.chat.id, "أدخل رقم التسلسل (seq) للإعلان:")
-            return
-        if text == "🔎 بحث طلب":
-            state["step"] = "await_find_order_seq"
-            bot.send_message(msg.chat.id, "أدخل رقم التسلسل (seq) للطلب:")
-            return
-        if text == "📦 عروض قيد الانتظار":
-            conn = db_conn()
-            c = conn.cursor()
-            c.execute("SELECT id, seq, tracking_code, category, subcategory, price FROM listings WHERE status='pending' ORDER BY id DESC LIMIT 30")
-            rows = c.fetchall()
-            conn.close()
-            if not rows:
-                bot.send_message(msg.chat.id, "لا توجد عروض قيد الانتظار.", reply_markup=admin_menu_kb())
-            else:
-                lines = ["قيد الانتظار:"]
-                for r in rows:
-                    lines.append(f"- ID {r['id']} | SEQ {r['seq']:03d} | {r['tracking_code']} | {r['category']}/{r['subcategory']} | {r['price']}")
-                bot.send_message(msg.chat.id, "\n".join(lines), reply_markup=admin_menu_kb())
-            return
-        if text == "🧾 طلبات مدفوعة":
-            conn = db_conn()
-            c = conn.cursor()
-            c.execute("SELECT id, seq, tracking_code, listing_id, payment_method FROM orders WHERE status='paid' ORDER BY id DESC LIMIT 30")
-            rows = c.fetchall()
-            conn.close()
-            if not rows:
-                bot.send_message(msg.chat.id, "لا توجد طلبات مدفوعة حالياً.", reply_markup=admin_menu_kb())
-            else:
-                lines = ["طلبات مدفوعة:"]
-                for r in rows:
-                    lines.append(f"- ORDER SEQ {r['seq']:03d} | {r['tracking_code']} | Listing {r['listing_id']} | {method_display_short(r['payment_method'])}")
-                bot.send_message(msg.chat.id, "\n".join(lines), reply_markup=admin_menu_kb())
-            return
-        if text == "📥 نسخ DB احتياطية":
-            path = backup_db_copy()
-            bot.send_message(msg.chat.id, f"✅ تم إنشاء نسخة: <code>{path}</code>", reply_markup=admin_menu_kb())
-            return
+# ------------------------------ الإدمن ------------------------------
+@router.step("admin", "menu")
+def admin_menu(msg: types.Message, state: Dict[str, Any]):
+    if not router.press("admin", msg, state):
+        outbox.send_message(msg.chat.id, "اختر من القائمة:", reply_markup=admin_menu_kb())
 
-        bot.send_message(msg.chat.id, "اختر من القائمة:", reply_markup=admin_menu_kb())
+@router.button("admin", BACK_BTN)
+def admin_exit(msg: types.Message, state: Dict[str, Any]):
+    reset_state(msg.from_user.id)
+    outbox.send_message(msg.chat.id, "خروج من لوحة التحكم.", reply_markup=main_menu_kb())
+
+@router.button("admin", "🔎 بحث عرض")
+def admin_find_listing(msg: types.Message, state: Dict[str, Any]):
+    state["step"] = "await_find_listing_seq"
+    outbox.send_message(msg.chat.id, "أدخل رقم التسلسل (seq) للإعلان:")
+
+@router.button("admin", "🔎 بحث طلب")
+def admin_find_order(msg: types.Message, state: Dict[str, Any]):
+    state["step"] = "await_find_order_seq"
+    outbox.send_message(msg.chat.id, "أدخل رقم التسلسل (seq) للطلب:")
+
+@router.button("admin", "📦 عروض قيد الانتظار")
+def admin_pending_listings(msg: types.Message, state: Dict[str, Any]):
+    rows = get_pending_listings()
+    if not rows:
+        outbox.send_message(msg.chat.id, "لا توجد عروض قيد الانتظار.", reply_markup=admin_menu_kb())
         return
-
-    if step == "await_find_listing_seq":
-        if not text.isdigit():
-            bot.send_message(msg.chat.id, "أدخل رقمًا صحيحًا.")
-            return
-        seq = int(text)
-        row = get_listing_by_seq(seq)
-        if not row:
-            bot.send_message(msg.chat.id, "لا يوجد إعلان بهذا الرقم.", reply_markup=admin_menu_kb())
-            state["step"] = "menu"
-            return
-        images = json.loads(row["images_json"] or "[]")
-        caption = (
-            f"📦 عرض\n"
-            f"SEQ: {row['seq']:03d} | رمز: {row['tracking_code']}\n"
-            f"ID: {row['id']}\n"
-            f"فئة: {row['category']}/{row['subcategory']}\n"
-            f"السعر: {row['price']} | الحالة: {row['status']}\n\n"
-            f"{row['description']}"
-        )
-        if images:
-            bot.send_photo(msg.chat.id, images[0], caption=caption)
-            for f in images[1:]:
-                bot.send_photo(msg.chat.id, f)
-        else:
-            bot.send_message(msg.chat.id, caption)
+    lines = ["قيد الانتظار:"]
+    for r in rows:
+        lines.append(f"- ID {r['id']} | SEQ {r['seq']:03d} | {r['tracking_code']} | {r['category']}/{r['subcategory']} | {r['price']}")
+    outbox.send_message(msg.chat.id, "\n".join(lines), reply_markup=admin_menu_kb())
+
+@router.button("admin", "🧾 طلبات مدفوعة")
+def admin_paid_orders(msg: types.Message, state: Dict[str, Any]):
+    rows = get_paid_orders()
+    if not rows:
+        outbox.send_message(msg.chat.id, "لا توجد طلبات مدفوعة حالياً.", reply_markup=admin_menu_kb())
+        return
+    lines = ["طلبات مدفوعة:"]
+    for r in rows:
+        lines.append(f"- ORDER SEQ {r['seq']:03d} | {r['tracking_code']} | Listing {r['listing_id']} | {method_display_short(r['payment_method'])}")
+    outbox.send_message(msg.chat.id, "\n".join(lines), reply_markup=admin_menu_kb())
+
+@router.button("admin", "📊 الإحصائيات")
+def admin_stats(msg: types.Message, state: Dict[str, Any]):
+    outbox.send_message(msg.chat.id, stats_text(get_stats()), reply_markup=admin_menu_kb())
+
+@router.button("admin", "📥 نسخ DB احتياطية")
+def admin_backup(msg: types.Message, state: Dict[str, Any]):
+    jid = backups.submit("manual", notify_chat=msg.chat.id)
+    outbox.send_message(msg.chat.id, f"⏳ بدأ النسخ الاحتياطي — رقم المهمة: <code>{jid}</code>", reply_markup=admin_menu_kb())
+
+@router.step("admin", "await_find_listing_seq")
+def admin_listing_by_seq(msg: types.Message, state: Dict[str, Any]):
+    text = _text(msg)
+    if not text.isdigit():
+        outbox.send_message(msg.chat.id, "أدخل رقمًا صحيحًا.")
+        return
+    row = get_listing_by_seq(int(text))
+    if not row:
+        outbox.send_message(msg.chat.id, "لا يوجد إعلان بهذا الرقم.", reply_markup=admin_menu_kb())
         state["step"] = "menu"
-        bot.send_message(msg.chat.id, "رجعناك لقائمة الإدمن.", reply_markup=admin_menu_kb())
         return
-
-    if step == "await_find_order_seq":
-        if not text.isdigit():
-            bot.send_message(msg.chat.id, "أدخل رقمًا صحيحًا.")
-            return
-        seq = int(text)
-        row = get_order_by_seq(seq)
-        if not row:
-            bot.send_message(msg.chat.id, "لا يوجد طلب بهذا الرقم.", reply_markup=admin_menu_kb())
-            state["step"] = "menu"
-            return
-        caption = (
-            f"🧾 طلب\n"
-            f"SEQ: {row['seq']:03d} | رمز: {row['tracking_code']}\n"
-            f"Listing ID: {row['listing_id']}\n"
-            f"مشتري: <code>{row['buyer_telegram_id']}</code>\n"
-            f"طريقة الدفع: {method_display_short(row['payment_method'])} | الحالة: {row['status']}\n"
-            f"وسيلة تواصل: {row['buyer_contact'] or '-'}\n"
-            f"تاريخ: {row['created_at']}"
-        )
-        if row["payment_proof_file_id"]:
-            bot.send_photo(msg.chat.id, row["payment_proof_file_id"], caption=caption)
-        else:
-            bot.send_message(msg.chat.id, caption)
+    images = row["images"]
+    caption = (
+        f"📦 عرض\n"
+        f"SEQ: {row['seq']:03d} | رمز: {row['tracking_code']}\n"
+        f"ID: {row['id']}\n"
+        f"فئة: {row['category']}/{row['subcategory']}\n"
+        f"السعر: {row['price']} | الحالة: {row['status']}\n\n"
+        f"{row['description']}"
+    )
+    send_listing_media(msg.chat.id, images, caption)
+    state["step"] = "menu"
+    outbox.send_message(msg.chat.id, "رجعناك لقائمة الإدمن.", reply_markup=admin_menu_kb())
+
+@router.step("admin", "await_find_order_seq")
+def admin_order_by_seq(msg: types.Message, state: Dict[str, Any]):
+    text = _text(msg)
+    if not text.isdigit():
+        outbox.send_message(msg.chat.id, "أدخل رقمًا صحيحًا.")
+        return
+    row = get_order_by_seq(int(text))
+    if not row:
+        outbox.send_message(msg.chat.id, "لا يوجد طلب بهذا الرقم.", reply_markup=admin_menu_kb())
         state["step"] = "menu"
-        bot.send_message(msg.chat.id, "رجعناك لقائمة الإدمن.", reply_markup=admin_menu_kb())
         return
+    caption = (
+        f"🧾 طلب\n"
+        f"SEQ: {row['seq']:03d} | رمز: {row['tracking_code']}\n"
+        f"Listing ID: {row['listing_id']}\n"
+        f"مشتري: <code>{row['buyer_telegram_id']}</code>\n"
+        f"طريقة الدفع: {method_display_short(row['payment_method'])} | الحالة: {row['status']}\n"
+        f"وسيلة تواصل: {row['buyer_contact'] or '-'}\n"
+        f"تاريخ: {row['created_at']}"
+    )
+    if row["payment_proof_file_id"]:
+        outbox.send_photo(msg.chat.id, row["payment_proof_file_id"], caption=caption)
+    else:
+        outbox.send_message(msg.chat.id, caption)
+    state["step"] = "menu"
+    outbox.send_message(msg.chat.id, "رجعناك لقائمة الإدمن.", reply_markup=admin_menu_kb())
 
 def show_my_items(msg: types.Message):
     uid = msg.from_user.id
@@ -1234,12 +3898,209 @@ def show_my_items(msg: types.Message):
         for r in my_orders:
             lines.append(f"- SEQ {r['seq']:03d} | {r['tracking_code']} | Listing {r['listing_id']} | {method_display_short(r['payment_method'])} | {r['status']}")
 
-    bot.send_message(msg.chat.id, "\n".join(lines), reply_markup=main_menu_kb())
+    outbox.send_message(msg.chat.id, "\n".join(lines), reply_markup=main_menu_kb())
+
+# ====================[ وضع asyncio (AsyncTeleBot) ]====================
+# BOT_RUNTIME=async: الاستقبال وكل طلبات تيليجرام الصادرة تجري على حلقة asyncio عبر AsyncTeleBot (aiohttp)،
+# بينما تبقى دوال المسارات نفسها (المشتركة مع الوضع المتزامن) وتُنفَّذ مع وصولها لـ SQLite في
+# مُنفِّذ خيوط محدود. المحادثات المنتظرة لا تحجز خيطاً: كل محادثة حالة في user_states وكوروتين قصير.
+ASYNC_HANDLER_THREADS = int(os.getenv("ASYNC_HANDLER_THREADS", "16"))
+
+class AsyncBridge:
+    """
+    يقدّم واجهة TeleBot المتزامنة (send_message ...) للطابور الصادر، وينفّذ كل استدعاء
+    كوروتيناً على حلقة AsyncTeleBot. يُستدعى من خيوط الطابور/المُنفِّذ فقط، لا من الحلقة نفسها.
+    """
+    def __init__(self, abot, loop: asyncio.AbstractEventLoop):
+        from telebot import asyncio_helper   # يتطلب aiohttp
+        self.abot = abot
+        self.loop = loop
+        self._api_error = asyncio_helper.ApiTelegramException
+
+    def __getattr__(self, name: str):
+        method = getattr(self.abot, name)
+
+        def call(*args, **kwargs):
+            try:
+                return asyncio.run_coroutine_threadsafe(method(*args, **kwargs), self.loop).result()
+            except self._api_error as e:
+                # نفس صنف الوضع المتزامن حتى يعمل منطق 429/retry_after في OutboundDispatcher كما هو
+                raise ApiTelegramException(e.function_name, e.result, e.result_json) from e
+        return call
+
+class AsyncUpdateRunner:
+    """
+    نظير UpdateEngine على asyncio: طابور لكل مستخدم يفرّغه كوروتين واحد بالترتيب، ويُنفَّذ كل
+    تحديث بمعالجات TeleBot المتزامنة في المُنفِّذ. مستخدمون مختلفون يتقدمون بالتوازي.
+    """
+    def __init__(self, process, executor: ThreadPoolExecutor):
+        self._process = process
+        self._executor = executor
+        self._queues: Dict[Any, deque] = {}
+        self._tasks: set = set()
+        self._processed = 0
+
+    async def submit(self, updates: List[types.Update]):
+        for u in updates:
+            uid = _update_user_id(u)
+            key = uid if uid is not None else ("update", u.update_id)
+            q = self._queues.get(key)
+            if q is not None:
+                q.append(u)          # يوجد كوروتين يفرّغ طابور هذا المستخدم
+                continue
+            self._queues[key] = deque([u])
+            task = asyncio.create_task(self._drain(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key):
+        loop = asyncio.get_running_loop()
+        q = self._queues[key]
+        while q:
+            update = q.popleft()
+            try:
+                await loop.run_in_executor(self._executor, self._process, [update])
+            except Exception as e:
+                logging.exception("update %s failed: %s", update.update_id, e)
+            self._processed += 1
+        del self._queues[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"users_active": len(self._queues),
+                "queued": sum(len(q) for q in self._queues.values()),
+                "processed": self._processed}
+
+    async def join(self):
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+async def async_main():
+    # AsyncTeleBot يتطلب aiohttp؛ نستورده هنا حتى لا يصبح شرطاً للوضع المتزامن
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+    if TELEGRAM_API_URL:
+        asyncio_helper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+
+    print("🚀 Amanex bot starting (asyncio mode).")
+    report = bootstrap("async")
+
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=ASYNC_HANDLER_THREADS, thread_name_prefix="handlers")
+    abot = AsyncTeleBot(BOT_TOKEN, parse_mode="HTML")
+    # الطابور الصادر يرسل عبر aiohttp على الحلقة بدل requests المتزامن
+    outbox.tg = AsyncBridge(abot, loop)
+    with report.phase("outbox"):
+        outbox.start()
+    global async_runner
+    runner = async_runner = AsyncUpdateRunner(update_engine.process, executor)
+    abot.process_new_updates = runner.submit
+
+    with report.phase("delete_webhook"):
+        await abot.delete_webhook()
+    report.log()
+    try:
+        await abot.infinity_polling(timeout=30, request_timeout=40, skip_pending=True,
+                                    allowed_updates=["message", "callback_query"])
+    finally:
+        await runner.join()
+        await loop.run_in_executor(None, outbox.join, 10)
+        executor.shutdown(wait=True)
+        await abot.close_session()
 
 # ===========================[ تشغيل البوت ]===========================
+# استيراد الوحدة لا يفتح قاعدة البيانات ولا يشغّل خيوطاً ولا يتصل بتيليجرام (ولا ينهي العملية
+# عند نقص الإعداد)؛ كل ذلك يحدث في bootstrap() عند البدء الفعلي، مع تقرير زمن كل مرحلة.
+
+class StartupReport:
+    """أزمنة مراحل الإقلاع؛ تُطبع سطراً واحداً عند اكتمال التشغيل."""
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.phases: List[Tuple[str, float]] = []
+        self.notes: List[str] = []
+        self._t0 = time.perf_counter()
+
+    @contextmanager
+    def phase(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - t0))
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"mode": self.mode, "import_ms": round(_IMPORT_SECS * 1000, 1),
+                "phases_ms": {name: round(secs * 1000, 1) for name, secs in self.phases},
+                "total_ms": round((time.perf_counter() - self._t0) * 1000, 1), "notes": self.notes}
+
+    def log(self):
+        # print مثل رسائل البدء الأخرى (لا إعداد لـ logging الجذري فلا تظهر رسائل info)
+        d = self.as_dict()
+        phases = ", ".join(f"{k} {v:.1f}ms" for k, v in d["phases_ms"].items())
+        notes = (" | " + "; ".join(self.notes)) if self.notes else ""
+        print(f"⏱ Startup ({d['mode']}): import {d['import_ms']:.1f}ms | {phases} | total {d['total_ms']:.1f}ms{notes}",
+              flush=True)
+
+startup_report: Optional[StartupReport] = None
+
+def bootstrap(mode: str) -> StartupReport:
+    """المراحل المشتركة بين أوضاع التشغيل: فحص الإعداد، القاعدة والهجرة، الجلسات، اللوحات، النسخ الاحتياطي."""
+    global startup_report
+    check_config()
+    report = startup_report = StartupReport(mode)
+    if TELEGRAM_API_URL:
+        telebot.apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    with report.phase("init_db"):
+        init_db()
+    with report.phase("migrate_db"):
+        before, after = migrate_db()
+    report.notes.append(f"schema v{after}" + (f" (migrated from v{before})" if before != after else ""))
+    with report.phase("sessions"):
+        write_behind.start()
+        user_states.start()
+        known_users.start()
+    with report.phase("keyboards"):
+        keyboards.warm()
+    with report.phase("backups"):
+        backups.start()
+    return report
+
+def _start_sync_engines(report: StartupReport):
+    with report.phase("outbox"):
+        outbox.start()
+    with report.phase("update_engine"):
+        update_engine.start()
+
+def start_webhook():
+    """تهيئة وضع webhook: قاعدة البيانات + تسجيل العنوان لدى تيليجرام (العملية idempotent)."""
+    print("🚀 Amanex bot starting (webhook mode).")
+    report = bootstrap("webhook")
+    _start_sync_engines(report)
+    with report.phase("set_webhook"):
+        bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                        allowed_updates=["message", "callback_query"])
+    report.log()
+
+def process_webhook_update(body: str):
+    """يمرّر تحديثاً واحداً وصل عبر webhook إلى طابور مستخدمه في UpdateEngine."""
+    update = types.Update.de_json(body)
+    if update:
+        bot.process_new_updates([update])
+
 def main():
+    if BOT_MODE == "webhook":
+        start_webhook()
+        return
+    if BOT_RUNTIME == "async":
+        asyncio.run(async_main())
+        return
+
     print("🚀 Amanex bot starting (Render ready).")
-    migrate_db()
+    report = bootstrap("polling")
+    _start_sync_engines(report)
+    # إن بقي webhook مسجّلاً من تشغيل سابق فإن getUpdates يفشل بـ 409
+    with report.phase("remove_webhook"):
+        bot.remove_webhook()
+    report.log()
 
     while True:  # نحاول نعيد التشغيل إذا وقع خطأ
         try:
@@ -1258,3 +4119,5 @@ def main():
         except Exception as e:
             logging.exception("Polling crashed: %s", e)
             time.sleep(5)
+
+_IMPORT_SECS = time.perf_counter() - _IMPORT_T0
@@ -1,13 +1,65 @@
 import os
+import hmac
 from threading import Thread
-from flask import Flask
+from typing import Optional
+from flask import Flask, Response, request, abort, jsonify
+from dotenv import load_dotenv
+
+# قبل استيراد bot: إعداداته تُقرأ من البيئة عند الاستيراد (bot لا يحمّل .env بنفسه عند استيراده)
+load_dotenv()
 from bot import main as run_bot  # نستورد دالة تشغيل البوت
+from bot import BOT_MODE, WEBHOOK_PATH, WEBHOOK_SECRET, start_webhook, process_webhook_update
+from bot import METRICS_ENABLED, metrics, check_config, STATS_TOKEN, STATS_DAYS, get_stats
+
+def create_app() -> Flask:
+    """ينشئ تطبيق Flask؛ في وضع webhook يهيّئ البوت أيضاً (قاعدة البيانات + تسجيل العنوان)."""
+    app = Flask(__name__)
+
+    @app.get("/")
+    def health():
+        return "OK", 200
+
+    @app.get("/metrics")
+    def prometheus_metrics():
+        if not METRICS_ENABLED:
+            abort(404)
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    @app.get("/stats")
+    def stats():
+        # عدّادات جاهزة من stats_counters (لا تجميع على جداول الطلبات)
+        if not STATS_TOKEN:
+            abort(404)
+        if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {STATS_TOKEN}"):
+            abort(403)
+        return jsonify(get_stats(request.args.get("days", type=int) or STATS_DAYS))
+
+    if BOT_MODE == "webhook":
+        @app.post(WEBHOOK_PATH)
+        def telegram_webhook():
+            # تيليجرام يرسل السر الذي سجّلناه في set_webhook ضمن هذا الترويسة
+            token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token, WEBHOOK_SECRET):
+                abort(403)
+            process_webhook_update(request.get_data(as_text=True))
+            return "", 200
+
+        # تحت gunicorn لا يُنفّذ __main__، لذلك نهيّئ الـ webhook عند إنشاء التطبيق.
+        # worker واحد فقط (gunicorn -w 1 --threads N): الحالة في ذاكرة العملية، وworker ثانٍ
+        # يفشل عند الإقلاع لأن مخزن الجلسات مملوك (انظر SessionStore.start)
+        start_webhook()
+    return app
 
-app = Flask(__name__)
+_app: Optional[Flask] = None
 
-@app.get("/")
-def health():
-    return "OK", 200
+def __getattr__(name: str):
+    # "gunicorn server:app" يطلب app فيُنشأ عندها فقط؛ استيراد server للأدوات لا يهيّئ شيئاً
+    global _app
+    if name == "app":
+        if _app is None:
+            _app = create_app()
+        return _app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def _start_bot():
     print("[server] starting bot polling...", flush=True)
@@ -18,9 +70,11 @@ def _start_bot():
         print(f"[server] bot crashed: {e}", flush=True)
 
 if __name__ == "__main__":
-    # شغّل البوت في ثريد منفصل
-    Thread(target=_start_bot, daemon=True).start()
+    check_config()   # قبل تشغيل الخيط: خطأ الإعداد يُنهي العملية لا الخيط فقط
+    if BOT_MODE == "polling":
+        # شغّل البوت في ثريد منفصل
+        Thread(target=_start_bot, daemon=True).start()
     # افتح بورت كما تطلب Render (من متغير البيئة PORT)
     port = int(os.environ.get("PORT", "10000"))
-    print(f"[server] Flask starting on port {port}", flush=True)
-    app.run(host="0.0.0.0", port=port)
+    print(f"[server] Flask starting on port {port} ({BOT_MODE} mode)", flush=True)
+    create_app().run(host="0.0.0.0", port=port)